@@ -1,8 +1,383 @@
 # api_client.py
 
-import requests
 import base64
+import hashlib
+import io
+import json
 import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait as futures_wait
+from endpoint_router import Endpoint, EndpointRouter
+from tts_cache import TTSCache
+
+# requests 和 PIL 导入较慢，首次用到时才导入，不拖慢程序启动
+requests = None
+
+def _requests():
+    global requests
+    if requests is None:
+        import requests as module
+        requests = module
+    return requests
+
+class RequestCancelled(Exception):
+    """请求被 CancelToken 取消。"""
+
+class CancelToken:
+    """
+    一轮对话的取消令牌。cancel() 之后，所有使用该令牌的请求会立即以 RequestCancelled 结束，
+    正在读取中的响应会被关闭以中断传输。
+    """
+    def __init__(self):
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.responses = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self.event.is_set()
+
+    def cancel(self):
+        with self.lock:
+            self.event.set()
+            responses, self.responses = self.responses, []
+        for response in responses:
+            response.close()
+
+    def register(self, response):
+        """登记一个正在进行的响应，取消时会关闭它。"""
+        with self.lock:
+            if not self.event.is_set():
+                self.responses.append(response)
+                return
+        response.close()
+        raise RequestCancelled()
+
+    def raise_if_cancelled(self):
+        if self.event.is_set():
+            raise RequestCancelled()
+
+def _close_abandoned(future):
+    """被取消的请求在后台完成后，关闭它的响应以归还连接。"""
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+class APIClient:
+    """
+    持有一个带连接池的 requests.Session，所有 API 调用共用。
+    同一个 base_url 的多次请求会复用已建立的 TCP/TLS 连接，
+    并统一设置超时和针对 429/5xx 的退避重试。
+    多地址选路的请求使用不重试的 routed_session：失败后立即换下一个地址，重试和退避由 EndpointRouter 负责。
+    """
+    def __init__(self, pool_size: int = 10, connect_timeout: float = 10, read_timeout: float = 120,
+                 max_retries: int = 3, backoff_factor: float = 0.5):
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        self.timeout = (connect_timeout, read_timeout)
+        retry = Retry(
+            total=max_retries,
+            connect=max_retries,
+            read=0,  # 读超时不重试，避免重复生成一次很长的回复
+            status=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(["POST"]),
+            respect_retry_after_header=True,
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = _requests().Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        routed_adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.routed_session = _requests().Session()
+        self.routed_session.mount("http://", routed_adapter)
+        self.routed_session.mount("https://", routed_adapter)
+        # 可取消的请求在这里等待响应头，调用方线程只需等待结果或取消信号
+        self.executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="api")
+
+    def post(self, url: str, headers: dict, json: dict, stream: bool = False, cancel_token: CancelToken | None = None,
+             retry: bool = True) -> "requests.Response":
+        """:param retry: 为 False 时不做连接层的重试（多地址选路的请求由 EndpointRouter 重试）"""
+        session = self.session if retry else self.routed_session
+        if cancel_token is None:
+            return session.post(url, headers=headers, json=json, stream=stream, timeout=self.timeout)
+        
+        cancel_token.raise_if_cancelled()
+        future = self.executor.submit(session.post, url, headers=headers, json=json, stream=True, timeout=self.timeout)
+        while True:
+            try:
+                response = future.result(timeout=0.05)
+                break
+            except FutureTimeoutError:
+                if cancel_token.cancelled:
+                    future.add_done_callback(_close_abandoned)
+                    raise RequestCancelled()
+        cancel_token.register(response)
+        if not stream:
+            try:
+                response.content  # 读取完整响应体，期间取消会关闭连接
+            except Exception as e:
+                if cancel_token.cancelled:
+                    raise RequestCancelled() from e
+                raise
+        return response
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.session.close()
+        self.routed_session.close()
+
+_default_client = None
+_client_kwargs = {}
+_client_lock = threading.Lock()
+
+def get_client() -> APIClient:
+    """获取模块共享的 APIClient，首次调用时按 configure_client() 保存的参数创建。"""
+    global _default_client
+    with _client_lock:
+        if _default_client is None:
+            _default_client = APIClient(**_client_kwargs)
+        return _default_client
+
+def configure_client(**kwargs):
+    """
+    保存共享 APIClient 的连接池参数（pool_size、connect_timeout、read_timeout 等）。
+    只记录参数、关闭旧的 APIClient，新的在下一次 get_client() 时才创建，启动时不必导入 requests。
+    """
+    global _default_client, _client_kwargs
+    with _client_lock:
+        old_client = _default_client
+        _default_client = None
+        _client_kwargs = dict(kwargs)
+    if old_client is not None:
+        old_client.close()
+
+# --- 多地址选路 ---
+_router = None
+
+# 这些状态码说明服务端暂时不可用，换一个地址重试
+FAILOVER_STATUS = (429, 500, 502, 503, 504)
+
+def configure_endpoints(endpoints: list, hedge_delay: float = 0.0, failure_threshold: int = 3,
+                        cooldown: float = 30.0, retries: int = 0, backoff: float = 0.5) -> EndpointRouter | None:
+    """
+    配置多个等价的 API 地址。endpoints 为 [(base_url, api_key 或 None), ...]，第一个是主地址，
+    此后以主地址为 base_url 的请求会发往延迟最低的健康地址，失败时立即换下一个地址。
+    少于两个地址时关闭多地址选路。
+    :param hedge_delay: 大于 0 时，LLM 请求超过这么多秒没有响应就向第二个地址发出对冲请求
+    :param retries: 所有地址都失败后，退避并重新选路的轮数
+    """
+    global _router
+    if len(endpoints) < 2:
+        _router = None
+        return None
+    _router = EndpointRouter(
+        [Endpoint(base_url, api_key) for base_url, api_key in endpoints],
+        failure_threshold=failure_threshold, cooldown=cooldown, hedge_delay=hedge_delay,
+        retries=retries, backoff=backoff
+    )
+    return _router
+
+def get_router() -> EndpointRouter | None:
+    """获取当前的多地址选路器，可用于读取各地址的延迟和熔断状态。"""
+    return _router
+
+def _headers(api_key: str, accept: str | None = None) -> dict:
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json",
+    }
+    if accept:
+        headers["Accept"] = accept
+    return headers
+
+def _wait_first_byte(response):
+    """
+    等到响应体的第一段数据到达（不消耗数据）。流式接口往往先返回响应头，
+    真正的延迟（例如 LLM 的首字）要到第一段数据才能体现，选路和对冲都以此为准。
+    """
+    # response.raw._fp 是 http.client.HTTPResponse，它的 fp 是套接字上的缓冲读取器，
+    # 在这一层 peek 不会消耗数据，也不会打乱 urllib3 自己对分块编码的解析
+    fp = getattr(getattr(response.raw, "_fp", None), "fp", None)
+    if fp is None or not hasattr(fp, "peek"):
+        return
+    try:
+        fp.peek(1)
+    except (OSError, ValueError) as e:
+        response.close()
+        raise _requests().exceptions.ConnectionError(e) from e
+
+def _post_first_byte(session, url: str, headers: dict, body: dict, timeout):
+    """在线程池中执行：发出请求，并在状态正常时等到第一段数据。"""
+    response = session.post(url, headers=headers, json=body, stream=True, timeout=timeout)
+    if response.status_code not in FAILOVER_STATUS:
+        _wait_first_byte(response)
+    return response
+
+def _read_body(response, cancel_token: CancelToken | None):
+    """读取完整响应体，期间取消会关闭连接并抛出 RequestCancelled。"""
+    try:
+        response.content
+    except Exception as e:
+        response.close()
+        if cancel_token is not None and cancel_token.cancelled:
+            raise RequestCancelled() from e
+        raise
+
+def _post(path: str, api_key: str, base_url: str, body: dict, stream: bool = False,
+          cancel_token: CancelToken | None = None, hedge: bool = False, accept: str | None = None):
+    """
+    发出一个 API 请求并返回响应（不检查状态码）。
+    base_url 是多地址选路的主地址时，请求按延迟从低到高依次尝试各个健康地址：
+    连接失败或返回 FAILOVER_STATUS 时立即换下一个地址，hedge 为 True 时还会发出对冲请求。
+    一轮中所有地址都失败时，按 router.retries 和 router.backoff 退避后重新选路。
+    """
+    router = _router
+    if router is None or router.primary.base_url != base_url.rstrip("/"):
+        return get_client().post(f"{base_url}{path}", headers=_headers(api_key, accept), json=body,
+                                 stream=stream, cancel_token=cancel_token)
+    for attempt in range(router.retries + 1):
+        final = attempt == router.retries
+        if attempt:
+            delay = router.backoff * 2 ** (attempt - 1)
+            print(f"所有 API 地址都请求失败，{delay:.1f} 秒后第 {attempt} 次重试")
+            if cancel_token is None:
+                time.sleep(delay)
+            elif cancel_token.event.wait(delay):
+                raise RequestCancelled()
+        candidates = router.candidates()
+        try:
+            if hedge and router.hedge_delay > 0 and len(candidates) > 1:
+                response = _hedged_post(router, candidates, path, api_key, body, cancel_token, accept)
+            else:
+                response = _failover_post(router, candidates, path, api_key, body, cancel_token, accept)
+        except RequestCancelled:
+            raise
+        except _requests().exceptions.RequestException:
+            if final:
+                raise
+            continue
+        if response.status_code in FAILOVER_STATUS and not final:
+            response.close()
+            continue
+        break
+    # 延迟统一按收到响应头的时间计算，需要完整响应体时再读取
+    if not stream:
+        _read_body(response, cancel_token)
+    return response
+
+def _failover_post(router: EndpointRouter, candidates: list, path: str, api_key: str, body: dict,
+                   cancel_token: CancelToken | None, accept: str | None):
+    last_error = None
+    for i, endpoint in enumerate(candidates):
+        is_last = i == len(candidates) - 1
+        start = time.perf_counter()
+        try:
+            response = get_client().post(f"{endpoint.base_url}{path}", headers=_headers(endpoint.api_key or api_key, accept),
+                                         json=body, stream=True, cancel_token=cancel_token, retry=False)
+        except RequestCancelled:
+            raise
+        except _requests().exceptions.RequestException as e:
+            router.record_failure(endpoint)
+            last_error = e
+            if not is_last:
+                print(f"API 地址 {endpoint.base_url} 请求失败，改用下一个地址: {e}")
+            continue
+        if response.status_code in FAILOVER_STATUS:
+            router.record_failure(endpoint)
+            if not is_last:
+                print(f"API 地址 {endpoint.base_url} 返回 {response.status_code}，改用下一个地址")
+                response.close()
+                continue
+            return response
+        try:
+            _wait_first_byte(response)
+        except _requests().exceptions.RequestException as e:
+            if cancel_token is not None and cancel_token.cancelled:
+                raise RequestCancelled() from e
+            router.record_failure(endpoint)
+            last_error = e
+            continue
+        router.record_success(endpoint, time.perf_counter() - start)
+        return response
+    raise last_error
+
+def _finish_abandoned(router: EndpointRouter, endpoint: Endpoint, start: float, future):
+    """对冲中落败的请求完成后，照常记录它的延迟或失败（否则慢的地址永远不会被重新测量），再关闭响应。"""
+    if future.cancelled():
+        return
+    if future.exception() is not None:
+        router.record_failure(endpoint)
+        return
+    response = future.result()
+    if response.status_code in FAILOVER_STATUS:
+        router.record_failure(endpoint)
+    else:
+        router.record_success(endpoint, time.perf_counter() - start)
+    response.close()
+
+def _hedged_post(router: EndpointRouter, candidates: list, path: str, api_key: str, body: dict,
+                 cancel_token: CancelToken | None, accept: str | None):
+    """
+    先向最快的地址发出请求，超过 hedge_delay 秒还没有收到第一段数据时再向下一个地址发出同样的请求，
+    使用先返回的响应并关闭另一个。某个地址失败时立即改用下一个地址。
+    """
+    client = get_client()
+    remaining = list(candidates)
+    pending = {}  # future -> (地址, 发出时间)
+    last_error = None
+
+    def launch():
+        endpoint = remaining.pop(0)
+        future = client.executor.submit(
+            _post_first_byte, client.routed_session, f"{endpoint.base_url}{path}",
+            _headers(endpoint.api_key or api_key, accept), body, client.timeout
+        )
+        pending[future] = (endpoint, time.perf_counter())
+
+    def abandon():
+        for future, (endpoint, start) in pending.items():
+            future.add_done_callback(lambda f, endpoint=endpoint, start=start: _finish_abandoned(router, endpoint, start, f))
+
+    if cancel_token is not None:
+        cancel_token.raise_if_cancelled()
+    launch()
+    hedge_at = time.perf_counter() + router.hedge_delay
+    while pending or remaining:
+        if not pending:
+            launch()
+            continue
+        done, _ = futures_wait(list(pending), timeout=0.05, return_when=FIRST_COMPLETED)
+        for future in done:
+            endpoint, start = pending.pop(future)
+            try:
+                response = future.result()
+            except _requests().exceptions.RequestException as e:
+                router.record_failure(endpoint)
+                last_error = e
+                continue
+            if response.status_code in FAILOVER_STATUS:
+                router.record_failure(endpoint)
+                if pending or remaining:
+                    last_error = _requests().exceptions.HTTPError(f"{response.status_code} from {endpoint.base_url}", response=response)
+                    response.close()
+                    continue
+            else:
+                router.record_success(endpoint, time.perf_counter() - start)
+            abandon()
+            if cancel_token is not None:
+                cancel_token.register(response)
+            return response
+        if cancel_token is not None and cancel_token.cancelled:
+            abandon()
+            raise RequestCancelled()
+        if remaining and len(pending) == 1 and time.perf_counter() >= hedge_at:
+            # 只对冲一次：第二个请求发出后不再继续增加
+            hedge_at = float("inf")
+            launch()
+    raise last_error
 
 def encode_image_to_base64(image_path: str) -> str:
     """
@@ -26,20 +401,120 @@ def get_image_mime_type(image_path: str) -> str:
     }
     return mime_types.get(ext, "image/jpeg")
 
-def get_llm_response(history: list, api_key: str, base_url: str, model: str, image_path: str | None = None) -> str:
+# --- 图片预处理 ---
+# 上传前先把图片缩放到模型的分块尺寸以内并重新编码，避免把 4K 截图原样塞进请求体
+IMAGE_SETTINGS = {
+    "max_edge": 1536,   # 长边上限（像素），1536 = 3 个 512 的分块
+    "format": "JPEG",   # 重新编码的格式：JPEG 或 WEBP
+    "quality": 85,
+}
+_image_cache = OrderedDict()  # (内容哈希, 参数) -> data URL
+_image_cache_lock = threading.Lock()
+IMAGE_CACHE_SIZE = 32
+
+def configure_image_preprocessing(max_edge: int | None = None, format: str | None = None, quality: int | None = None):
+    """修改图片预处理参数，并清空已缓存的编码结果。"""
+    if max_edge is not None:
+        IMAGE_SETTINGS["max_edge"] = max_edge
+    if format is not None:
+        IMAGE_SETTINGS["format"] = format.upper()
+    if quality is not None:
+        IMAGE_SETTINGS["quality"] = quality
+    with _image_cache_lock:
+        _image_cache.clear()
+
+def _has_transparency(img) -> bool:
+    if img.mode in ("RGBA", "LA"):
+        return img.getchannel("A").getextrema()[0] < 255
+    return img.mode == "P" and "transparency" in img.info
+
+def preprocess_image(raw: bytes, max_edge: int, format: str, quality: int) -> tuple[bytes, str]:
     """
-    根据对话历史调用语言模型 API 获取回复。
-    支持可选的图片参数，用于多模态对话。
+    缩放并重新编码图片，返回 (图片字节, MIME 类型)。
+    带透明通道的图片在目标格式为 JPEG 时保留为 PNG；动图原样返回。
     """
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json",
-    }
-    
-    # 如果有图片，需要修改最后一条用户消息为多模态格式
+    from PIL import Image, ImageOps
+    img = Image.open(io.BytesIO(raw))
+    original_mime = Image.MIME.get(img.format, "image/jpeg")
+    if getattr(img, "is_animated", False):
+        return raw, original_mime
+
+    img = ImageOps.exif_transpose(img)
+    resized = max(img.size) > max_edge
+    if resized:
+        img.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+
+    if _has_transparency(img):
+        target = "WEBP" if format == "WEBP" else "PNG"
+        img = img.convert("RGBA")
+    else:
+        target = format
+        img = img.convert("RGB")
+
+    buffer = io.BytesIO()
+    if target == "PNG":
+        img.save(buffer, "PNG", optimize=True)
+    else:
+        img.save(buffer, target, quality=quality)
+    encoded = buffer.getvalue()
+
+    # 没有缩放且原图更小时（例如已经压缩过的小 JPEG），直接用原图
+    if not resized and len(raw) <= len(encoded) and original_mime in ("image/jpeg", "image/png", "image/webp"):
+        return raw, original_mime
+    return encoded, Image.MIME[target]
+
+def encode_image_to_data_url(image_path: str) -> str:
+    """
+    读取图片、预处理后编码为 data URL。
+    结果按文件内容哈希缓存，同一张图片重复发送时不再重新编码。
+    """
+    with open(image_path, "rb") as image_file:
+        raw = image_file.read()
+    settings = (IMAGE_SETTINGS["max_edge"], IMAGE_SETTINGS["format"], IMAGE_SETTINGS["quality"])
+    cache_key = (hashlib.sha256(raw).hexdigest(), settings)
+    with _image_cache_lock:
+        if cache_key in _image_cache:
+            _image_cache.move_to_end(cache_key)
+            return _image_cache[cache_key]
+
+    try:
+        data, mime_type = preprocess_image(raw, *settings)
+    except Exception as e:
+        # 无法解码时退回到原样上传
+        print(f"图片预处理失败，将发送原图: {e}")
+        data, mime_type = raw, get_image_mime_type(image_path)
+    data_url = f"data:{mime_type};base64,{base64.b64encode(data).decode('utf-8')}"
+
+    with _image_cache_lock:
+        _image_cache[cache_key] = data_url
+        while len(_image_cache) > IMAGE_CACHE_SIZE:
+            _image_cache.popitem(last=False)
+    return data_url
+
+_tts_cache = None
+
+def configure_tts_cache(directory: str | None, max_bytes: int = 200 * 1024 * 1024,
+                        defer_eviction: bool = False) -> TTSCache | None:
+    """
+    启用（或在 directory 为 None 时关闭）磁盘 TTS 音频缓存。
+    defer_eviction 为 True 时超出预算的文件由调用方在空闲时调用 cleanup() 删除。
+    """
+    global _tts_cache
+    _tts_cache = TTSCache(directory, max_bytes, defer_eviction) if directory else None
+    return _tts_cache
+
+def get_tts_cache() -> TTSCache | None:
+    """获取当前启用的 TTS 缓存，可用于读取命中/未命中计数。"""
+    return _tts_cache
+
+def _build_llm_messages(history: list, image_path: str | None = None) -> list:
+    """
+    复制对话历史，并在提供图片时把最后一条用户消息转换为多模态格式。
+    """
+    # 只发送 role 和 content，消息上的 id 等本地字段不外传
     messages_to_send = []
     for msg in history:
-        messages_to_send.append(msg.copy())
+        messages_to_send.append({"role": msg["role"], "content": msg["content"]})
     
     # 如果提供了图片路径，将最后一条用户消息转换为多模态格式
     if image_path and os.path.exists(image_path):
@@ -47,8 +522,6 @@ def get_llm_response(history: list, api_key: str, base_url: str, model: str, ima
         for i in range(len(messages_to_send) - 1, -1, -1):
             if messages_to_send[i]["role"] == "user":
                 text_content = messages_to_send[i]["content"]
-                base64_image = encode_image_to_base64(image_path)
-                mime_type = get_image_mime_type(image_path)
                 
                 messages_to_send[i]["content"] = [
                     {
@@ -58,11 +531,41 @@ def get_llm_response(history: list, api_key: str, base_url: str, model: str, ima
                     {
                         "type": "image_url",
                         "image_url": {
-                            "url": f"data:{mime_type};base64,{base64_image}"
+                            "url": encode_image_to_data_url(image_path)
                         }
                     }
                 ]
                 break
+    return messages_to_send
+
+def parse_usage(usage: dict | None) -> dict:
+    """
+    把响应中的 usage 字段整理为 {"prompt_tokens", "completion_tokens", "cached_tokens"}。
+    命中提示词缓存的 token 数在不同服务中的字段名不同：OpenAI 为 prompt_tokens_details.cached_tokens，
+    DeepSeek 为 prompt_cache_hit_tokens，Anthropic 兼容接口为 cache_read_input_tokens；都没有时为 None。
+    """
+    if not isinstance(usage, dict):
+        return {}
+    details = usage.get("prompt_tokens_details") or {}
+    cached = details.get("cached_tokens")
+    if cached is None:
+        cached = usage.get("prompt_cache_hit_tokens", usage.get("cache_read_input_tokens"))
+    return {
+        "prompt_tokens": usage.get("prompt_tokens", usage.get("input_tokens")),
+        "completion_tokens": usage.get("completion_tokens", usage.get("output_tokens")),
+        "cached_tokens": cached,
+    }
+
+def get_llm_response(history: list, api_key: str, base_url: str, model: str, image_path: str | None = None,
+                     cancel_token: CancelToken | None = None, usage: dict | None = None) -> str:
+    """
+    根据对话历史调用语言模型 API 获取回复。
+    支持可选的图片参数，用于多模态对话。
+    传入 cancel_token 时，请求可以被随时取消（抛出 RequestCancelled）。
+    传入 usage 字典时，响应中的 token 用量（见 parse_usage）会写入其中。
+    """
+    # 如果有图片，需要修改最后一条用户消息为多模态格式
+    messages_to_send = _build_llm_messages(history, image_path)
     
     # 注意：这里的 body 结构需要根据你的 newapi 文档进行调整
     # 这是一个兼容 OpenAI API 格式的示例
@@ -72,118 +575,274 @@ def get_llm_response(history: list, api_key: str, base_url: str, model: str, ima
     }
     
     try:
-        response = requests.post(
-            f"{base_url}/chat/completions",
-            headers=headers,
-            json=body
-        )
+        response = _post("/chat/completions", api_key, base_url, body, cancel_token=cancel_token, hedge=True)
         response.raise_for_status()  # 如果请求失败 (非 2xx 状态码)，则会抛出异常
         
         # 解析响应，获取模型的回复内容
         # 这同样需要根据你的 newapi 的具体返回格式进行调整
-        return response.json()["choices"][0]["message"]["content"]
+        data = response.json()
+        if usage is not None:
+            usage.update(parse_usage(data.get("usage")))
+        return data["choices"][0]["message"]["content"]
 
-    except requests.exceptions.RequestException as e:
+    except _requests().exceptions.RequestException as e:
         # 将具体的网络错误或服务器错误重新抛出
         raise ConnectionError(f"调用 LLM API 失败: {e}") from e
 
-def get_tts_audio(text: str, api_key: str, base_url: str, model: str, speed: float) -> bytes:
+def _iter_sse_data(response):
     """
-    调用 TTS API 获取语音数据。
+    逐行解析 SSE (text/event-stream) 响应，产出每个事件的 data 字段。
     """
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json",
+    for line in response.iter_lines(decode_unicode=False):
+        if not line:
+            continue
+        line = line.decode("utf-8", errors="replace")
+        if not line.startswith("data:"):
+            continue
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            return
+        yield data
+
+def stream_llm_response(history: list, api_key: str, base_url: str, model: str, image_path: str | None = None,
+                        cancel_token: CancelToken | None = None, usage: dict | None = None):
+    """
+    以流式模式 (stream: true) 调用语言模型 API，逐段产出回复文本增量。
+    调用方把所有增量拼接起来即为完整回复。
+    传入 cancel_token 时，取消会关闭连接并抛出 RequestCancelled。
+    传入 usage 字典时会请求服务在流的末尾附上 token 用量 (stream_options.include_usage)，收到后写入其中。
+    """
+    body = {
+        "model": model,
+        "messages": _build_llm_messages(history, image_path),
+        "stream": True
     }
+    if usage is not None:
+        body["stream_options"] = {"include_usage": True}
+    
+    try:
+        with _post("/chat/completions", api_key, base_url, body, stream=True, cancel_token=cancel_token,
+                   hedge=True, accept="text/event-stream") as response:
+            response.raise_for_status()
+            
+            # 有些代理会忽略 stream 参数，直接返回完整的 JSON
+            if "text/event-stream" not in response.headers.get("Content-Type", ""):
+                data = response.json()
+                if usage is not None:
+                    usage.update(parse_usage(data.get("usage")))
+                yield data["choices"][0]["message"]["content"]
+                return
+            
+            for data in _iter_sse_data(response):
+                try:
+                    chunk = json.loads(data)
+                except ValueError:
+                    continue
+                # 用量通常在最后一个 choices 为空的分块中，有的服务每个分块都带，以最后一次为准
+                if usage is not None and chunk.get("usage"):
+                    usage.update(parse_usage(chunk["usage"]))
+                choices = chunk.get("choices") or []
+                if not choices:
+                    continue
+                delta = choices[0].get("delta", {}).get("content")
+                if delta:
+                    if cancel_token is not None:
+                        cancel_token.raise_if_cancelled()
+                    yield delta
+
+    except RequestCancelled:
+        raise
+    except Exception as e:
+        # 取消时连接被关闭，读取会以各种异常结束，统一视为取消
+        if cancel_token is not None and cancel_token.cancelled:
+            raise RequestCancelled() from e
+        if isinstance(e, _requests().exceptions.RequestException):
+            # 将具体的网络错误或服务器错误重新抛出
+            raise ConnectionError(f"调用 LLM API 失败: {e}") from e
+        raise
+
+def stream_tts_audio(text: str, api_key: str, base_url: str, model: str, speed: float, voice: str = "nova",
+                     cancel_token: CancelToken | None = None, chunk_size: int = 8192):
+    """
+    调用 TTS API，以生成器的形式边下载边产出音频数据块，调用方可以在下载完成前开始播放。
+    如果启用了 TTS 缓存，命中时直接产出整段缓存的音频；完整下载的音频会写入缓存。
+    """
+    cache = _tts_cache
+    if cache is not None:
+        cached_audio = cache.get(text, model, voice, speed)
+        if cached_audio is not None:
+            yield cached_audio
+            return
     
     # 注意：这里的 body 结构需要根据你的 newapi 文档进行调整
     body = {
         "model": model,
         "input": text,
-        "voice": "nova",  # 这是一个清晰的女性声音
+        "voice": voice,  # 默认 nova，这是一个清晰的女性声音
         "speed": speed
     }
     
     try:
-        response = requests.post(
-            f"{base_url}/audio/speech",
-            headers=headers,
-            json=body
-        )
-        response.raise_for_status()
-        
-        # API 应该直接返回音频数据
-        return response.content
+        response = _post("/audio/speech", api_key, base_url, body, stream=True, cancel_token=cancel_token)
+        with response:
+            response.raise_for_status()
+            
+            # API 应该直接返回音频数据
+            chunks = []
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                if chunk:
+                    chunks.append(chunk)
+                    yield chunk
+        if cache is not None:
+            cache.put(text, model, voice, speed, b"".join(chunks))
         
-    except requests.exceptions.RequestException as e:
-        # 将具体的网络错误或服务器错误重新抛出
-        raise ConnectionError(f"调用 TTS API 失败: {e}") from e
+    except RequestCancelled:
+        raise
+    except Exception as e:
+        # 取消时连接被关闭，读取会以各种异常结束，统一视为取消
+        if cancel_token is not None and cancel_token.cancelled:
+            raise RequestCancelled() from e
+        if isinstance(e, _requests().exceptions.RequestException):
+            # 将具体的网络错误或服务器错误重新抛出
+            raise ConnectionError(f"调用 TTS API 失败: {e}") from e
+        raise
 
-def get_memory_summary(history: list, api_key: str, base_url: str, model: str) -> str:
-    """调用 LLM 对话历史进行总结，提取关键信息。"""
-    
-    summary_prompt = {
+def get_tts_audio(text: str, api_key: str, base_url: str, model: str, speed: float, voice: str = "nova",
+                  cancel_token: CancelToken | None = None) -> bytes:
+    """
+    调用 TTS API 获取完整的语音数据。
+    如果启用了 TTS 缓存，相同的 (文本, 模型, 音色, 语速) 会直接从磁盘返回，不再请求网络。
+    """
+    return b"".join(stream_tts_audio(text, api_key, base_url, model, speed, voice, cancel_token=cancel_token))
+
+def reconcile_memory_facts(facts: list, api_key: str, base_url: str, model: str,
+                           cancel_token: CancelToken | None = None) -> str:
+    """
+    调用 LLM 把几条相近或互相冲突的记忆合并成一条。
+    facts 按时间从旧到新排列，冲突时以较新的信息为准。出错时返回空字符串。
+    """
+    reconcile_prompt = {
         "role": "system",
         "content": """
-你是一个顶级的对话摘要分析师。你的任务是从一段对话历史中，像侦探一样找出关于“用户”的、具有**长期价值**的、可作为永久记忆的**核心事实**。
-
-你需要严格遵守以下规则：
-1.  **判断长期价值**：在提取任何信息前，先判断“这条信息在一周后、一个月后，是否依然对理解这个用户有帮助？”。只记录那些有长期价值的信息。
-2.  **提取核心事实**：只关注关于“用户”的**不变或长期属性**。例如：用户的名字、职业、人生目标、关键的个人经历、坚定的好恶（如“非常喜欢古典音乐”、“对猫毛过敏”）等。
-3.  **忽略临时信息**：坚决忽略闲聊、问候、关于天气或当天心情的讨论、一次性的计划（如“我今晚想吃披萨”）以及任何无信息量的对话。
-4.  **简洁输出**：以最简洁的第三人称陈述句输出，每条信息点占一行。
-5.  **无信息则留空**：如果对话中没有出现任何符合上述标准的关键信息，请务必只返回一个空字符串。
-6.  **禁止额外内容**：绝对不要添加任何额外的解释、标题、引言或总结性的话语。
-
-例如，如果输入以下对话：
-[
-  {"role": "user", "content": "你好"},
-  {"role": "assistant", "content": "你好呀！"},
-  {"role": "user", "content": "我叫小王，我有一只叫“旺财”的柯基犬。"},
-  {"role": "assistant", "content": "柯基很可爱！"},
-  {"role": "user", "content": "是啊，不过我不喜欢吃洋葱。"},
-]
-
-你应该输出：
-用户的名字是小王。
-用户有一只叫“旺财”的柯基犬。
-用户不喜欢吃洋葱。
-
-再例如，如果输入以下对话：
-[
-  {"role": "user", "content": "今天天气真好"},
-  {"role": "assistant", "content": "是呀，很适合出去玩。"},
-  {"role": "user", "content": "我最喜欢的游戏是《赛博朋克2077》。"},
-  {"role": "assistant", "content": "哦，那是一款很棒的游戏！"},
-  {"role": "user", "content": "你觉得呢？"},
-  {"role": "assistant", "content": "我只是一个AI，没有个人喜好哦。"},
-]
-
-你应该输出：
-用户最喜欢的游戏是《赛博朋克2077》。
+你是一个记忆整理助手。下面是关于“用户”的几条相近或互相冲突的记忆，按时间从旧到新排列。
+请把它们合并为一条准确的事实：
+1.  如果信息互相冲突，以较新的（靠后的）为准。
+2.  保留所有不冲突的细节。
+3.  以最简洁的第三人称陈述句输出，只输出这一条事实，不要添加任何解释。
 """
     }
-    
-    request_history = [summary_prompt] + history
+    request_history = [
+        reconcile_prompt,
+        {"role": "user", "content": "\n".join(f"{i + 1}. {fact}" for i, fact in enumerate(facts))}
+    ]
 
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json",
+    body = {
+        "model": model,
+        "messages": request_history
     }
     
+    try:
+        response = _post("/chat/completions", api_key, base_url, body, cancel_token=cancel_token)
+        response.raise_for_status()
+        content = response.json()["choices"][0]["message"]["content"]
+        lines = [line.strip() for line in content.strip().splitlines() if line.strip()]
+        return lines[0] if lines else ""
+    except _requests().exceptions.RequestException as e:
+        print(f"调用记忆合并 API 时发生错误: {e}")
+        return ""
+
+INCREMENTAL_SUMMARY_PROMPT = """
+你是一个顶级的对话摘要分析师。你会收到【之前的对话摘要】和一段【新的对话】，请完成两项任务，并严格按下面的格式输出：
+
+【长期记忆】
+从新的对话中提取关于“用户”的、具有长期价值的核心事实（名字、职业、人生目标、关键经历、坚定的好恶等），
+以最简洁的第三人称陈述句输出，每条一行。忽略闲聊、问候、当天的心情和一次性的计划。没有符合条件的信息则留空。
+【对话摘要】
+把之前的对话摘要和新的对话合并为一段不超过 200 字的简短摘要，只保留理解后续对话所需的上下文，
+例如正在讨论的话题、尚未完成的事情、双方约定的内容。
+
+不要输出任何其他解释、标题或引言。
+"""
+
+INCREMENTAL_SUMMARY_JSON_PROMPT = """
+你是一个顶级的对话摘要分析师。你会收到【之前的对话摘要】和一段【新的对话】，请完成两项任务，只输出一个 JSON 对象：
+{"facts": ["事实1", "事实2"], "summary": "摘要"}
+
+facts: 从新的对话中提取关于“用户”的、具有长期价值的核心事实（名字、职业、人生目标、关键经历、坚定的好恶等），
+每条是一句最简洁的第三人称陈述句。忽略闲聊、问候、当天的心情和一次性的计划。没有符合条件的信息则为空列表。
+summary: 把之前的对话摘要和新的对话合并为一段不超过 200 字的简短摘要，只保留理解后续对话所需的上下文，
+例如正在讨论的话题、尚未完成的事情、双方约定的内容。
+
+不要输出 JSON 以外的任何内容。
+"""
+
+# 不支持 response_format 的 (地址, 模型)，之后的总结请求不再携带这个参数
+_json_format_unsupported = set()
+
+def _format_transcript(messages: list) -> str:
+    lines = []
+    for message in messages:
+        speaker = "用户" if message["role"] == "user" else "AI"
+        lines.append(f"{speaker}: {message['content']}")
+    return "\n".join(lines)
+
+def _parse_incremental_summary(content: str) -> tuple[list, str]:
+    facts_part, _, summary_part = content.partition("【对话摘要】")
+    facts_part = facts_part.replace("【长期记忆】", "")
+    facts = [line.strip(" -•\t") for line in facts_part.splitlines() if line.strip(" -•\t")]
+    return facts, summary_part.strip()
+
+def _parse_summary_json(content: str) -> tuple[list, str] | None:
+    """解析 JSON 格式的总结结果，格式不对时返回 None（由调用方退回按文本解析）。"""
+    text = content.strip()
+    if text.startswith("```"):
+        # 有的模型仍会把 JSON 包在代码块里
+        text = text.strip("`").strip()
+        if text.startswith("json"):
+            text = text[len("json"):]
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return None
+    if not isinstance(data, dict) or not isinstance(data.get("facts", []), list):
+        return None
+    facts = [str(fact).strip() for fact in data.get("facts", []) if str(fact).strip()]
+    return facts, str(data.get("summary") or "").strip()
+
+def get_incremental_summary(previous_summary: str, new_messages: list, api_key: str, base_url: str, model: str,
+                            cancel_token: CancelToken | None = None, json_output: bool = False) -> tuple[list, str]:
+    """
+    增量总结：只发送上一次的滚动摘要和水位线之后的新消息。
+    json_output 为 True 时要求模型输出 {"facts": [...], "summary": "..."}，并请求 JSON 模式
+    (response_format)；服务不支持 JSON 模式时自动去掉这个参数重试，模型没有按 JSON 输出时按文本格式解析。
+    返回 (长期事实列表, 新的滚动摘要)。请求失败时抛出 ConnectionError，被取消时抛出 RequestCancelled。
+    """
+    user_content = f"【之前的对话摘要】\n{previous_summary or '（无）'}\n\n【新的对话】\n{_format_transcript(new_messages)}"
+    request_history = [
+        {"role": "system", "content": INCREMENTAL_SUMMARY_JSON_PROMPT if json_output else INCREMENTAL_SUMMARY_PROMPT},
+        {"role": "user", "content": user_content}
+    ]
+
     body = {
         "model": model,
         "messages": request_history
     }
+    json_format_key = (base_url, model)
+    if json_output and json_format_key not in _json_format_unsupported:
+        body["response_format"] = {"type": "json_object"}
     
     try:
-        response = requests.post(
-            f"{base_url}/chat/completions",
-            headers=headers,
-            json=body
-        )
+        response = _post("/chat/completions", api_key, base_url, body, cancel_token=cancel_token)
+        if response.status_code == 400 and "response_format" in body:
+            _json_format_unsupported.add(json_format_key)
+            del body["response_format"]
+            response = _post("/chat/completions", api_key, base_url, body, cancel_token=cancel_token)
         response.raise_for_status()
-        return response.json()["choices"][0]["message"]["content"]
-    except requests.exceptions.RequestException as e:
-        print(f"调用记忆总结 API 时发生错误: {e}")
-        return "" # 出错时返回空字符串
\ No newline at end of file
+        content = response.json()["choices"][0]["message"]["content"]
+        if json_output:
+            parsed = _parse_summary_json(content)
+            if parsed is not None:
+                return parsed
+        return _parse_incremental_summary(content)
+    except _requests().exceptions.RequestException as e:
+        raise ConnectionError(f"调用记忆总结 API 失败: {e}") from e
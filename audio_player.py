@@ -0,0 +1,226 @@
+# audio_player.py
+
+import io
+import os
+import queue
+import threading
+import time
+
+# pygame 导入需要约 0.1 秒，首次播放（或启动后的后台预热）时才导入并初始化混音器
+pygame = None
+_mixer_lock = threading.Lock()
+
+def get_mixer():
+    """返回已初始化的 pygame.mixer，可以在任意线程中调用。"""
+    global pygame
+    with _mixer_lock:
+        if pygame is None:
+            os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+            import pygame as module
+            module.mixer.init()
+            module.mixer.set_reserved(1)  # 保留 0 号声道给 AudioPlayer，其他声音不会占用它
+            pygame = module
+    return pygame.mixer
+
+
+# --- MP3 帧解析 ---
+# MP3 由互相独立的帧拼接而成，任意一段完整帧都可以单独解码，因此下载到一半的数据截到最后一个完整帧就能先播放
+_BITRATES = {  # (是否 MPEG-1) -> Layer III 的码率表（kbps）
+    True: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    False: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+
+def _frame_length(header: bytes) -> int:
+    """Layer III 帧头对应的帧长度（字节），不是合法帧头或无法确定长度（自由码率）时返回 0。"""
+    if header[0] != 0xFF or (header[1] & 0xE0) != 0xE0:
+        return 0
+    version = (header[1] >> 3) & 0x03
+    layer = (header[1] >> 1) & 0x03
+    bitrate_index = header[2] >> 4
+    rate_index = (header[2] >> 2) & 0x03
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or rate_index == 3:
+        return 0
+    mpeg1 = version == 3
+    bitrate = _BITRATES[mpeg1][bitrate_index] * 1000
+    sample_rate = _SAMPLE_RATES[version][rate_index]
+    padding = (header[2] >> 1) & 0x01
+    return (144 if mpeg1 else 72) * bitrate // sample_rate + padding
+
+
+def complete_frames_end(data) -> tuple:
+    """
+    找到 data 中最后一个完整 MP3 帧的结束位置。
+    :return: (结束位置, 完整帧数)，遇到无法解析的数据时只统计之前的帧
+    """
+    pos = 0
+    if len(data) >= 10 and bytes(data[:3]) == b"ID3":
+        # ID3v2 标签：10 字节头，长度为 4 个 7 位字节
+        size = 0
+        for byte in data[6:10]:
+            size = (size << 7) | (byte & 0x7F)
+        pos = 10 + size
+    frames = 0
+    while pos + 4 <= len(data):
+        length = _frame_length(data[pos:pos + 4])
+        if length == 0 or pos + length > len(data):
+            break
+        pos += length
+        frames += 1
+    return (pos, frames) if frames else (0, 0)
+
+
+class StreamingAudio:
+    """
+    边下载边播放的音频缓冲区：下载线程调用 feed()/finish()/fail()，播放线程用 wait() 等待更多数据。
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+        self.complete = False
+        self.error = None
+        self.consumed = False  # 播放器是否已经读取过数据
+        self.condition = threading.Condition()
+
+    def feed(self, chunk: bytes):
+        with self.condition:
+            self.buffer += chunk
+            self.condition.notify_all()
+
+    def finish(self):
+        with self.condition:
+            self.complete = True
+            self.condition.notify_all()
+
+    def fail(self, error: Exception):
+        with self.condition:
+            self.error = error
+            self.complete = True
+            self.condition.notify_all()
+
+    def restart(self) -> bool:
+        """清空已下载的数据以便重新下载。播放器已经读取过数据时无法重来，返回 False。"""
+        with self.condition:
+            if self.consumed:
+                return False
+            self.buffer.clear()
+            return True
+
+    def wait(self, min_bytes: int, timeout: float | None = None) -> tuple:
+        """等到至少有 min_bytes 字节、下载结束或超时，返回 (当前已下载数据的快照, 是否已下载完)。"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.complete or len(self.buffer) >= min_bytes, timeout)
+            if self.buffer:
+                self.consumed = True
+            return bytes(self.buffer), self.complete
+
+    def getvalue(self, timeout: float | None = None) -> bytes:
+        """等待下载完成并返回完整音频，下载失败时重新抛出错误。"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.complete, timeout)
+            if self.error is not None:
+                raise self.error
+            return bytes(self.buffer)
+
+
+class AudioPlayer:
+    """
+    按顺序播放音频片段的播放器，片段之间无缝衔接，正在播放时送来的片段会排队而不是被丢弃。
+    片段可以是完整的 MP3 字节，也可以是仍在下载中的 StreamingAudio：缓冲到 prebuffer_bytes
+    就先解码已完整的帧开始播放，后续数据边下载边解码，排进同一声道的播放队列。
+    :param get_mixer: 返回已初始化的 pygame.mixer 的函数，首次播放时才调用
+    :param prebuffer_bytes: 开始播放一个片段前至少缓冲的字节数
+    :param on_playback_start: 回调 (秒)，每个片段从取出到开始输出所用的时间
+    """
+    def __init__(self, get_mixer=get_mixer, prebuffer_bytes: int = 8 * 1024, on_playback_start=None):
+        self.get_mixer = get_mixer
+        self.prebuffer_bytes = prebuffer_bytes
+        self.on_playback_start = on_playback_start
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.generation = 0  # stop() 时加一，旧的片段和解码循环看到后直接放弃
+        self.pending = 0  # 已送入但尚未全部交给声道的片段数
+        self.channel = None
+        self.thread = None
+
+    def play(self, audio):
+        """把一个片段（bytes 或 StreamingAudio）加入播放队列，立即返回。"""
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._worker, daemon=True)
+                self.thread.start()
+            self.pending += 1
+            self.queue.put((self.generation, audio))
+
+    def stop(self):
+        """停止当前播放并清空队列。"""
+        with self.lock:
+            self.generation += 1
+            if self.channel is not None:
+                self.channel.stop()
+
+    @property
+    def busy(self) -> bool:
+        return self.pending > 0 or (self.channel is not None and self.channel.get_busy())
+
+    def _worker(self):
+        while True:
+            generation, audio = self.queue.get()
+            try:
+                if generation == self.generation:
+                    self._play_segment(audio, generation)
+            except Exception as e:
+                print(f"播放音频时发生错误: {e}")
+            finally:
+                with self.lock:
+                    self.pending -= 1
+
+    def _play_segment(self, audio, generation: int):
+        mixer = self.get_mixer()
+        with self.lock:
+            if self.channel is None:
+                self.channel = mixer.Channel(0)
+            channel = self.channel
+        if not isinstance(audio, StreamingAudio):
+            stream = StreamingAudio()
+            stream.feed(audio)
+            stream.finish()
+            audio = stream
+
+        start = time.perf_counter()
+        decoded_end = 0  # 已解码的 MP3 数据末尾
+        queued_bytes = 0  # 已排进声道的 PCM 字节数
+        target = self.prebuffer_bytes
+        while generation == self.generation:
+            data, complete = audio.wait(target, timeout=0.05)
+            if audio.error is not None:
+                return  # 下载失败或被取消，已经排进声道的部分照常播完
+            end, frames = (len(data), None) if complete else complete_frames_end(data)
+            # 数据足够、下载结束、或者声道即将没有可播放的内容时，解码新到的完整帧
+            starving = queued_bytes > 0 and channel.get_queue() is None
+            if end > decoded_end and (complete or len(data) >= target or starving) and (complete or frames >= 2):
+                # 每次都从片段开头解码，只把新增的部分排进声道，保证各段 PCM 首尾相接
+                pcm = mixer.Sound(file=io.BytesIO(data[:end])).get_raw()
+                piece = pcm[queued_bytes:]
+                decoded_end = end
+                if piece and not self._enqueue(channel, mixer.Sound(buffer=piece), generation):
+                    return
+                if queued_bytes == 0 and piece and self.on_playback_start:
+                    self.on_playback_start(time.perf_counter() - start)
+                queued_bytes = len(pcm)
+                target = max(len(data) + 1, decoded_end * 2)
+            elif len(data) >= target:
+                target = len(data) + 1
+            if complete:
+                return
+
+    def _enqueue(self, channel, sound, generation: int) -> bool:
+        """等声道的队列位空出来后排入 sound（声道空闲时会立即播放）。stop() 后返回 False。"""
+        while True:
+            with self.lock:
+                if generation != self.generation:
+                    return False
+                if channel.get_queue() is None:
+                    channel.queue(sound)
+                    return True
+            time.sleep(0.01)
@@ -0,0 +1,466 @@
+# benchmark.py
+"""
+延迟基准测试：在本机启动一个模拟的 OpenAI 兼容服务（/chat/completions 与 /audio/speech），
+用对话引擎跑若干轮对话，统计首字延迟、首段语音延迟、整轮耗时、请求体大小和记忆总结的开销，
+结果保存为 JSON，可以用 --baseline 与之前版本的结果对比。
+
+用法:
+    python benchmark.py --turns 20 --scenarios text,image,blocking
+    python benchmark.py --baseline benchmark_results/old.json
+    python benchmark.py --fallback-endpoints 1 --primary-first-token-delay 2 --hedge-delay 0.5   # 多地址选路
+    python benchmark.py --scenarios text --turns 30 --context-budget 1500 --stable-prefix         # 提示词缓存命中率
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import api_client
+import context_builder
+import engine
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_OUTPUT_DIR = os.path.join(BASE_DIR, "benchmark_results")
+
+PROMPTS = [
+    "今天天气怎么样？",
+    "给我讲一个关于猫的小故事吧。",
+    "Can you recommend a good book about programming?",
+    "我明天要去面试，有点紧张，你能鼓励我一下吗？",
+    "帮我想想周末可以做些什么。",
+    "What's the difference between a list and a tuple in Python?",
+]
+
+MEMORY_FACTS = [
+    "用户喜欢猫", "用户住在上海", "用户是一名程序员", "用户喜欢喝咖啡", "用户最近在学日语",
+    "用户周末喜欢爬山", "用户养了一只叫团子的橘猫", "用户不吃香菜", "The user likes jazz music",
+    "用户的生日在十月", "用户正在准备面试", "用户喜欢看科幻电影",
+]
+
+
+class MockSettings:
+    """模拟服务的行为参数。"""
+    def __init__(self, first_token_delay=0.3, token_interval=0.02, reply_chars=120, chunk_chars=4,
+                 tts_delay=0.2, tts_per_char=0.002, tts_bytes=24000):
+        self.first_token_delay = first_token_delay  # 收到请求到第一个 token 的延迟（秒）
+        self.token_interval = token_interval        # 流式输出时相邻两个分块的间隔（秒）
+        self.reply_chars = reply_chars              # 每次回复的字数
+        self.chunk_chars = chunk_chars              # 每个流式分块的字数
+        self.tts_delay = tts_delay                  # 语音合成的固定延迟（秒）
+        self.tts_per_char = tts_per_char            # 每个字额外的合成时间（秒）
+        self.tts_bytes = tts_bytes                  # 每段语音的大小（字节）
+
+
+class _QuietHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # 客户端读完 [DONE] 后可能直接丢弃连接，不必打印这类错误
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class MockOpenAIServer:
+    """
+    在后台线程中运行的模拟服务，记录每个请求的路径、类型和请求体大小。
+    请求类型为 chat（对话）、summary（记忆总结）或 tts（语音合成）。
+    对话请求会像真实服务的提示词缓存一样，按与最近请求相同的前导消息计算 usage 中的 cached_tokens。
+    """
+    def __init__(self, settings: MockSettings):
+        self.settings = settings
+        self.requests = []
+        self.lock = threading.Lock()
+        self.recent_prompts = deque(maxlen=32)  # 最近对话请求的消息列表，模拟服务端的前缀缓存
+        self.httpd = _QuietHTTPServer(("127.0.0.1", 0), self._make_handler())
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def mark(self) -> int:
+        with self.lock:
+            return len(self.requests)
+
+    def requests_since(self, mark: int) -> list:
+        with self.lock:
+            return self.requests[mark:]
+
+    def usage_for(self, messages: list) -> dict:
+        """估算请求的 token 用量，与最近某个请求逐条相同的前导消息算作命中缓存。"""
+        prompt = [(m.get("role"), json.dumps(m.get("content"), ensure_ascii=False)) for m in messages]
+        costs = [context_builder.message_tokens(m) if isinstance(m.get("content"), str) else 1000 for m in messages]
+        with self.lock:
+            shared = 0
+            for previous in self.recent_prompts:
+                count = 0
+                while count < min(len(previous), len(prompt)) and previous[count] == prompt[count]:
+                    count += 1
+                shared = max(shared, count)
+            self.recent_prompts.append(prompt)
+        return {
+            "prompt_tokens": sum(costs),
+            "completion_tokens": self.settings.reply_chars,
+            "prompt_tokens_details": {"cached_tokens": sum(costs[:shared])},
+        }
+
+    def reply_text(self) -> str:
+        sentence = "Miko 觉得这个问题很有意思喵！"
+        text = sentence * (self.settings.reply_chars // len(sentence) + 1)
+        return text[:self.settings.reply_chars]
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # 允许客户端复用连接，和真实服务一致
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                payload = json.loads(body or b"{}")
+                if self.path.endswith("/audio/speech"):
+                    kind = "tts"
+                elif "【新的对话】" in json.dumps(payload, ensure_ascii=False):
+                    kind = "summary"
+                else:
+                    kind = "chat"
+                with server.lock:
+                    server.requests.append({"kind": kind, "bytes": len(body), "time": time.perf_counter()})
+
+                if kind == "tts":
+                    self.send_tts(payload)
+                elif kind == "summary":
+                    time.sleep(server.settings.first_token_delay)
+                    if payload.get("response_format"):
+                        content = json.dumps({"facts": ["用户在做基准测试"], "summary": "用户和 Miko 聊了很多话题。"}, ensure_ascii=False)
+                    else:
+                        content = "【长期记忆】\n用户在做基准测试\n【对话摘要】\n用户和 Miko 聊了很多话题。"
+                    self.send_json({"choices": [{"message": {"content": content}}]})
+                elif payload.get("stream"):
+                    usage = server.usage_for(payload.get("messages", []))
+                    self.send_stream(usage if (payload.get("stream_options") or {}).get("include_usage") else None)
+                else:
+                    usage = server.usage_for(payload.get("messages", []))
+                    time.sleep(server.settings.first_token_delay + server.settings.token_interval *
+                               server.settings.reply_chars / server.settings.chunk_chars)
+                    self.send_json({"choices": [{"message": {"content": server.reply_text()}}], "usage": usage})
+
+            def send_json(self, data):
+                body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def send_tts(self, payload):
+                settings = server.settings
+                time.sleep(settings.tts_delay + settings.tts_per_char * len(payload.get("input", "")))
+                body = os.urandom(settings.tts_bytes)
+                self.send_response(200)
+                self.send_header("Content-Type", "audio/mpeg")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def send_stream(self, usage=None):
+                settings = server.settings
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                time.sleep(settings.first_token_delay)
+                text = server.reply_text()
+                for i in range(0, len(text), settings.chunk_chars):
+                    chunk = {"choices": [{"delta": {"content": text[i:i + settings.chunk_chars]}}]}
+                    self.write_chunk(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+                    time.sleep(settings.token_interval)
+                if usage is not None:
+                    self.write_chunk(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n".encode("utf-8"))
+                self.write_chunk(b"data: [DONE]\n\n")
+                self.wfile.write(b"0\r\n\r\n")
+
+            def write_chunk(self, data: bytes):
+                self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+                self.wfile.flush()
+
+        return Handler
+
+
+class MockCluster:
+    """把多个模拟服务当作一个来统计请求（多地址选路时请求会分散到各个服务上）。"""
+    def __init__(self, mocks: list):
+        self.mocks = mocks
+
+    @property
+    def base_url(self) -> str:
+        return self.mocks[0].base_url
+
+    def stop(self):
+        for mock in self.mocks:
+            mock.stop()
+
+    def mark(self) -> list:
+        return [mock.mark() for mock in self.mocks]
+
+    def requests_since(self, mark: list) -> list:
+        return [r for mock, start in zip(self.mocks, mark) for r in mock.requests_since(start)]
+
+
+def make_test_image(directory: str, width: int, height: int) -> str:
+    """生成一张带噪点的 PNG（难以压缩，接近真实截图/照片的体积）。"""
+    from PIL import Image
+    img = Image.frombytes("RGB", (width, height), os.urandom(width * height * 3))
+    path = os.path.join(directory, f"bench_{width}x{height}.png")
+    img.save(path, "PNG")
+    return path
+
+
+def summarize(values: list) -> dict:
+    """返回一组耗时（秒）的统计值，单位为毫秒。"""
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+
+    def percentile(p):
+        return ordered[min(int(p * len(ordered)), len(ordered) - 1)] * 1000
+
+    return {
+        "count": len(ordered),
+        "mean": sum(ordered) / len(ordered) * 1000,
+        "p50": percentile(0.5),
+        "p95": percentile(0.95),
+        "min": ordered[0] * 1000,
+        "max": ordered[-1] * 1000,
+    }
+
+
+def run_turn(conversation_engine, session, prompt, image_path, mock: MockOpenAIServer) -> dict:
+    """跑一轮对话，返回本轮的各项耗时和请求体大小。"""
+    timings = {}
+    mark = mock.mark()
+    start = time.perf_counter()
+
+    def on_delta(delta):
+        timings.setdefault("first_token", time.perf_counter() - start)
+
+    def on_audio(audio):
+        timings.setdefault("first_audio", time.perf_counter() - start)
+
+    conversation_engine.run_turn(session, prompt, image_path, on_delta=on_delta, on_audio=on_audio, wait_playback=True)
+    timings["turn"] = time.perf_counter() - start
+    requests = mock.requests_since(mark)
+    timings["chat_bytes"] = sum(r["bytes"] for r in requests if r["kind"] == "chat")
+    timings["tts_requests"] = sum(1 for r in requests if r["kind"] == "tts")
+    return timings
+
+
+def run_scenario(name: str, mock: MockOpenAIServer, args, image_path: str | None) -> dict:
+    settings = engine.EngineSettings(
+        api_key="benchmark",
+        base_url=mock.base_url,
+        llm_stream=name != "blocking",
+        memory_threshold=10 ** 9,  # 总结单独测量，不在对话轮次中触发
+        context_token_budget=args.context_budget,
+        stable_prompt_prefix=args.stable_prefix,
+        prompt_window_step=args.prompt_window_step,
+    )
+    conversation_engine = engine.ConversationEngine(settings, max_workers=max(args.sessions, 1))
+    try:
+        sessions = [conversation_engine.get_session(f"{name}-{i}") for i in range(args.sessions)]
+        for session in sessions:
+            session.memory_store.add_facts(MEMORY_FACTS * (args.memory_facts // len(MEMORY_FACTS) + 1))
+
+        results = []
+        results_lock = threading.Lock()
+
+        def worker(session):
+            rng = random.Random(session.id)
+            for _ in range(args.turns):
+                timings = run_turn(conversation_engine, session, rng.choice(PROMPTS), image_path, mock)
+                with results_lock:
+                    results.append(timings)
+
+        threads = [threading.Thread(target=worker, args=(session,)) for session in sessions]
+        wall_start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall = time.perf_counter() - wall_start
+
+        # 记忆总结：对累积的对话做一次增量总结，记录耗时和请求体大小
+        session = sessions[0]
+        mark = mock.mark()
+        start = time.perf_counter()
+        session.summarizer.run(list(session.history), conversation_engine.summarize_fn())
+        summary_seconds = time.perf_counter() - start
+        summary_bytes = sum(r["bytes"] for r in mock.requests_since(mark) if r["kind"] == "summary")
+        stages = conversation_engine.metrics.stage_stats()
+        tokens = conversation_engine.metrics.token_stats()
+    finally:
+        conversation_engine.close()
+
+    chat_bytes = [r["chat_bytes"] for r in results]
+    return {
+        "turns": len(results),
+        "wall_seconds": wall,
+        "time_to_first_token_ms": summarize([r["first_token"] for r in results if "first_token" in r]),
+        "time_to_first_audio_ms": summarize([r["first_audio"] for r in results if "first_audio" in r]),
+        "turn_latency_ms": summarize([r["turn"] for r in results]),
+        "chat_request_bytes": {
+            "mean": sum(chat_bytes) / len(chat_bytes) if chat_bytes else 0,
+            "max": max(chat_bytes, default=0),
+        },
+        "stages": stages,
+        "tokens": tokens,
+        "tts_requests_per_turn": sum(r["tts_requests"] for r in results) / len(results) if results else 0,
+        "summarization": {
+            "messages": len(session.history),
+            "latency_ms": summary_seconds * 1000,
+            "request_bytes": summary_bytes,
+        },
+    }
+
+
+def read_version() -> str:
+    try:
+        with open(os.path.join(BASE_DIR, "version.txt"), "r", encoding="utf-8") as f:
+            match = re.search(r"StringStruct\(u?'ProductVersion',\s*u?'([^']+)'\)", f.read())
+        return match.group(1) if match else "unknown"
+    except OSError:
+        return "unknown"
+
+
+def compare(results: dict, baseline: dict):
+    """打印与基线结果相比各项 p50 指标的变化。"""
+    print("\n与基线对比 (p50):")
+    for name, scenario in results["scenarios"].items():
+        old = baseline.get("scenarios", {}).get(name)
+        if not old:
+            continue
+        for metric in ("time_to_first_token_ms", "time_to_first_audio_ms", "turn_latency_ms"):
+            new_value = scenario[metric].get("p50")
+            old_value = old.get(metric, {}).get("p50")
+            if new_value is None or not old_value:
+                continue
+            change = (new_value - old_value) / old_value * 100
+            print(f"  {name:<10} {metric:<24} {old_value:9.1f} -> {new_value:9.1f} ms ({change:+.1f}%)")
+        new_bytes, old_bytes = scenario["chat_request_bytes"]["mean"], old.get("chat_request_bytes", {}).get("mean")
+        if old_bytes:
+            print(f"  {name:<10} {'chat_request_bytes':<24} {old_bytes:9.0f} -> {new_bytes:9.0f} B  ({(new_bytes - old_bytes) / old_bytes * 100:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="EchoSoul 延迟基准测试（使用本地模拟服务）")
+    parser.add_argument("--scenarios", default="text,image,blocking", help="要运行的场景：text（流式）、image（流式 + 图片）、blocking（非流式）")
+    parser.add_argument("--turns", type=int, default=10, help="每个会话的对话轮数")
+    parser.add_argument("--sessions", type=int, default=1, help="同时进行对话的会话数")
+    parser.add_argument("--memory-facts", type=int, default=200, help="每个会话预先写入的长期记忆条数")
+    parser.add_argument("--image-size", default="3000x2000", help="image 场景使用的图片尺寸")
+    parser.add_argument("--first-token-delay", type=float, default=0.3)
+    parser.add_argument("--token-interval", type=float, default=0.02)
+    parser.add_argument("--reply-chars", type=int, default=120)
+    parser.add_argument("--chunk-chars", type=int, default=4)
+    parser.add_argument("--tts-delay", type=float, default=0.2)
+    parser.add_argument("--tts-bytes", type=int, default=24000)
+    parser.add_argument("--tts-cache", action="store_true", help="启用 TTS 磁盘缓存（默认关闭，以测量真实的合成延迟）")
+    parser.add_argument("--fallback-endpoints", type=int, default=0, help="额外启动的等价模拟服务数量，用于测量多地址选路")
+    parser.add_argument("--primary-first-token-delay", type=float, default=None, help="主地址的首字延迟，默认与 --first-token-delay 相同")
+    parser.add_argument("--hedge-delay", type=float, default=0.0, help="对冲请求的等待时间（秒），0 表示不对冲")
+    parser.add_argument("--context-budget", type=int, default=16000, help="每次请求的上下文 token 预算，调小可以让历史窗口在测试中滑动")
+    parser.add_argument("--stable-prefix", action="store_true", help="使用对提示词缓存友好的稳定前缀布局")
+    parser.add_argument("--prompt-window-step", type=int, default=8, help="稳定前缀布局下历史窗口每次移动的消息数")
+    parser.add_argument("--output", default=None, help="结果 JSON 的保存路径，默认保存在 benchmark_results/ 下")
+    parser.add_argument("--baseline", default=None, help="与之前保存的结果 JSON 对比")
+    args = parser.parse_args()
+
+    mock_settings = MockSettings(args.first_token_delay, args.token_interval, args.reply_chars, args.chunk_chars,
+                                 args.tts_delay, tts_bytes=args.tts_bytes)
+    if args.fallback_endpoints > 0:
+        # 主地址可以单独设置得更慢，模拟代理变慢时的选路和对冲效果
+        primary_delay = args.primary_first_token_delay if args.primary_first_token_delay is not None else args.first_token_delay
+        primary_settings = MockSettings(**dict(vars(mock_settings), first_token_delay=primary_delay))
+        mock = MockCluster([MockOpenAIServer(primary_settings).start()] +
+                           [MockOpenAIServer(mock_settings).start() for _ in range(args.fallback_endpoints)])
+        api_client.configure_endpoints([(m.base_url, None) for m in mock.mocks], hedge_delay=args.hedge_delay)
+    else:
+        mock = MockOpenAIServer(mock_settings).start()
+    temp_dir = tempfile.mkdtemp(prefix="echosoul_bench_")
+    api_client.configure_tts_cache(os.path.join(temp_dir, "tts_cache") if args.tts_cache else None)
+
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    image_path = None
+    if "image" in scenarios:
+        width, height = (int(v) for v in args.image_size.lower().split("x"))
+        image_path = make_test_image(temp_dir, width, height)
+
+    results = {
+        "version": read_version(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "parameters": vars(args),
+        "mock": vars(mock_settings),
+        "image_file_bytes": os.path.getsize(image_path) if image_path else 0,
+        "scenarios": {},
+    }
+    try:
+        for name in scenarios:
+            if name not in ("text", "image", "blocking"):
+                print(f"未知的场景: {name}")
+                continue
+            print(f"正在运行场景 {name} ...")
+            scenario = run_scenario(name, mock, args, image_path if name == "image" else None)
+            results["scenarios"][name] = scenario
+            print(f"  首字延迟 p50 {scenario['time_to_first_token_ms'].get('p50', 0):.1f} ms, "
+                  f"首段语音 p50 {scenario['time_to_first_audio_ms'].get('p50', 0):.1f} ms, "
+                  f"整轮 p50 {scenario['turn_latency_ms'].get('p50', 0):.1f} ms, "
+                  f"请求体 {scenario['chat_request_bytes']['mean'] / 1024:.1f} KB, "
+                  f"记忆总结 {scenario['summarization']['latency_ms']:.1f} ms, "
+                  f"提示词缓存命中 {scenario['tokens']['cache_hit_ratio'] * 100:.0f}%")
+    finally:
+        mock.stop()
+    router = api_client.get_router()
+    if router is not None:
+        results["endpoints"] = router.snapshot()
+        for endpoint in results["endpoints"]:
+            latency = endpoint["latency_ms"]
+            print(f"  {endpoint['base_url']}: {endpoint['requests']} 个请求, 失败 {endpoint['failures']}, "
+                  f"EWMA 延迟 {latency if latency is not None else 0:.1f} ms, 状态 {endpoint['state']}")
+
+    output = args.output
+    if output is None:
+        os.makedirs(DEFAULT_OUTPUT_DIR, exist_ok=True)
+        output = os.path.join(DEFAULT_OUTPUT_DIR, f"benchmark-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"结果已保存到 {output}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+# context_builder.py
+
+import hashlib
+import json
+import re
+import threading
+
+_ENCODING = None
+_encoding_loaded = False
+_encoding_lock = threading.Lock()
+
+
+def _get_encoding():
+    """首次估算时才加载 tiktoken 的编码表（可能需要较长时间），不拖慢程序启动。"""
+    global _ENCODING, _encoding_loaded
+    if not _encoding_loaded:
+        with _encoding_lock:
+            if not _encoding_loaded:
+                try:
+                    import tiktoken
+                    _ENCODING = tiktoken.get_encoding("o200k_base")
+                except Exception:
+                    # tiktoken 是可选依赖，没有安装（或无法加载编码表）时使用启发式估算
+                    _ENCODING = None
+                _encoding_loaded = True
+    return _ENCODING
+
+_CJK_RUN = re.compile(r"[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff]+")
+_WORD = re.compile(r"[A-Za-z]+|\d+|[^\sA-Za-z\d\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff]")
+
+# 启发式估算的系数：按常见分词器在中英文混合文本上的表现校准，宁可略微高估
+CJK_TOKENS_PER_CHAR = 1.0
+LATIN_CHARS_PER_TOKEN = 4.0
+MESSAGE_OVERHEAD_TOKENS = 4  # 每条消息的角色标记等固定开销
+
+
+def estimate_tokens(text: str) -> int:
+    """快速估算文本的 token 数。装有 tiktoken 时精确计算，否则使用考虑中日韩文字的启发式。"""
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    cjk_chars = sum(len(run) for run in _CJK_RUN.findall(text))
+    tokens = cjk_chars * CJK_TOKENS_PER_CHAR
+    for piece in _WORD.findall(_CJK_RUN.sub(" ", text)):
+        if piece[0].isalpha():
+            tokens += max(1.0, len(piece) / LATIN_CHARS_PER_TOKEN)
+        elif piece[0].isdigit():
+            tokens += max(1.0, len(piece) / 3)
+        else:
+            tokens += 1  # 标点符号通常单独成为一个 token
+    return int(tokens + 0.999)
+
+
+def message_tokens(message: dict) -> int:
+    content = message.get("content", "")
+    if isinstance(content, list):
+        content = " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return estimate_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """把过长的文本截断到 max_tokens 以内，保留开头和结尾，中间用省略号代替。"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    marker = "\n……（中间内容过长已省略）……\n"
+    budget = max_tokens - estimate_tokens(marker)
+    if budget <= 0:
+        return ""
+    # 按比例二分查找能放下的字符数
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        head, tail = text[:mid // 2], text[len(text) - (mid - mid // 2):]
+        if estimate_tokens(head) + estimate_tokens(tail) <= budget:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low // 2] + marker + text[len(text) - (low - low // 2):]
+
+
+def prefix_hash(messages: list) -> str:
+    """消息列表（只看 role 和 content）的短哈希，用于判断两次请求的前缀是否逐字节相同。"""
+    data = json.dumps([[m["role"], m["content"]] for m in messages], ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()[:16]
+
+
+class ContextBuilder:
+    """
+    按 token 预算组装请求上下文：系统提示词 + 长期记忆 + 尽可能多的最近对话。
+    stable_prefix 为 True 时改用对服务端提示词缓存友好的布局：
+    系统提示词、早期对话摘要和历史对话窗口组成只在末尾追加的前缀，每轮都会变化的相关记忆放到最新消息之前；
+    历史窗口的起点只向前移动、每次移动 window_step 条消息，而不是每轮挪动一条，前缀在多轮之间保持逐字节相同。
+    :param budget_tokens: 整个请求上下文的 token 上限
+    :param memory_budget_tokens: 长期记忆最多占用的 token 数
+    :param stable_prefix: 是否使用稳定前缀布局
+    :param window_step: 稳定前缀布局下历史窗口起点每次移动的消息数
+    """
+    def __init__(self, budget_tokens: int = 16000, memory_budget_tokens: int = 500,
+                 stable_prefix: bool = False, window_step: int = 8):
+        self.budget_tokens = budget_tokens
+        self.memory_budget_tokens = memory_budget_tokens
+        self.stable_prefix = stable_prefix
+        self.window_step = max(window_step, 1)
+
+    def build(self, system_prompt: str, memory_facts: list, history: list, memory_header: str = "",
+              summary_text: str = "", summary_header: str = "", window_start: int = 0) -> tuple:
+        """
+        :param summary_text: 已被总结移出短期记忆的早期对话摘要，放在记忆之后、历史对话之前
+        :param window_start: 稳定前缀布局下历史窗口的起点（消息 id），上一次的报告中的 window_start 传回来即可
+        :return: (消息列表, 报告)。报告记录每个部分保留了多少条、用了多少 token，
+                 稳定前缀布局下还有前缀的哈希 prefix_hash 和新的窗口起点 window_start。
+        """
+        remaining = self.budget_tokens
+        report = {"budget": self.budget_tokens}
+
+        # 1. 系统提示词始终保留
+        system_message = {"role": "system", "content": system_prompt}
+        system_tokens = message_tokens(system_message)
+        remaining -= system_tokens
+        report["system"] = {"tokens": system_tokens}
+
+        # 2. 最新的一条消息（通常是本轮用户输入）必须保留，必要时截断
+        newest = []
+        newest_tokens = 0
+        if history:
+            last = dict(history[-1])
+            if isinstance(last.get("content"), str):
+                limit = max(remaining - MESSAGE_OVERHEAD_TOKENS, 0)
+                last["content"] = truncate_to_tokens(last["content"], limit)
+            newest = [last]
+            newest_tokens = message_tokens(last)
+            remaining -= newest_tokens
+
+        # 3. 长期记忆：按相关度顺序放入，不超过记忆预算和剩余预算
+        memory_budget = min(self.memory_budget_tokens, max(remaining, 0))
+        if self.stable_prefix:
+            # 按预算而不是实际用量预留记忆的位置，历史窗口不会随每轮检索到的记忆多少而挪动
+            remaining -= memory_budget
+        kept_facts = []
+        memory_tokens = estimate_tokens(memory_header) + MESSAGE_OVERHEAD_TOKENS if memory_facts else 0
+        for fact in memory_facts:
+            cost = estimate_tokens(fact) + 1
+            if memory_tokens + cost > memory_budget:
+                continue
+            kept_facts.append(fact)
+            memory_tokens += cost
+        memory_messages = []
+        if kept_facts:
+            memory_messages = [{"role": "system", "content": f"{memory_header}\n" + "\n".join(kept_facts)}]
+            if not self.stable_prefix:
+                remaining -= memory_tokens
+        else:
+            memory_tokens = 0
+        report["memory"] = {"tokens": memory_tokens, "kept": len(kept_facts), "total": len(memory_facts)}
+
+        # 4. 早期对话的滚动摘要，放得下才放
+        summary_messages = []
+        summary_tokens = 0
+        if summary_text:
+            summary_message = {"role": "system", "content": f"{summary_header}\n{summary_text}"}
+            cost = message_tokens(summary_message)
+            if cost <= remaining:
+                summary_messages = [summary_message]
+                summary_tokens = cost
+                remaining -= cost
+        report["summary"] = {"tokens": summary_tokens}
+
+        # 5. 从新到旧尽可能多地放入历史对话
+        if self.stable_prefix:
+            kept_history, history_tokens, window_start = self._stable_window(history[:-1], remaining, window_start)
+            remaining -= history_tokens
+        else:
+            kept_history = []
+            history_tokens = 0
+            for message in reversed(history[:-1]):
+                cost = message_tokens(message)
+                if cost > remaining:
+                    break
+                kept_history.append(message)
+                history_tokens += cost
+                remaining -= cost
+            kept_history.reverse()
+        report["history"] = {
+            "tokens": history_tokens + newest_tokens,
+            "kept": len(kept_history) + len(newest),
+            "total": len(history),
+        }
+        if self.stable_prefix:
+            remaining += memory_budget - memory_tokens  # 预留的记忆预算中没有用到的部分
+        report["used"] = self.budget_tokens - remaining
+
+        if not self.stable_prefix:
+            messages = [system_message] + memory_messages + summary_messages + kept_history + newest
+            return messages, report
+        prefix = [system_message] + summary_messages + kept_history
+        report["prefix_hash"] = prefix_hash(prefix)
+        report["prefix_tokens"] = system_tokens + summary_tokens + history_tokens
+        report["prefix_messages"] = len(prefix)
+        report["window_start"] = window_start
+        return prefix + memory_messages + newest, report
+
+    def _stable_window(self, history: list, remaining: int, window_start: int) -> tuple:
+        """
+        从 window_start 开始放入历史对话，放不下时把起点向后移动 window_step 的整数倍条消息。
+        :return: (保留的消息, 占用的 token 数, 新的窗口起点)
+        """
+        candidates = [m for m in history if m.get("id", 0) >= window_start]
+        costs = [message_tokens(m) for m in candidates]
+        total = sum(costs)
+        drop = 0
+        while total > remaining and drop < len(candidates):
+            step_end = min(drop + self.window_step, len(candidates))
+            total -= sum(costs[drop:step_end])
+            drop = step_end
+        kept = candidates[drop:]
+        if kept:
+            window_start = kept[0].get("id", window_start)
+        elif candidates:
+            window_start = candidates[-1].get("id", window_start) + 1
+        return kept, total, window_start
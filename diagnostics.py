@@ -0,0 +1,184 @@
+# diagnostics.py
+
+import io
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, deque
+
+
+class MainLoopWatchdog:
+    """
+    Tk 主循环卡顿检测。
+    主线程用 after() 定时发出心跳并记录实际间隔与预期间隔的偏差（即主循环延迟）；
+    后台线程发现心跳超过 stall_threshold 秒没有更新时，周期性采样主线程的调用栈，
+    卡顿结束后把持续时间和出现最多的调用栈写入报告文件。
+    :param root: Tk 根窗口
+    :param interval_ms: 心跳间隔（毫秒）
+    :param stall_threshold: 判定为卡顿的心跳中断时长（秒）
+    :param report_path: 卡顿报告的追加写入路径，为 None 时只打印
+    :param on_stall: 回调 (持续秒数)，每次卡顿结束时调用
+    """
+    def __init__(self, root, interval_ms: int = 100, stall_threshold: float = 0.25,
+                 report_path: str = None, on_stall=None, sample_interval: float = 0.05):
+        self.root = root
+        self.interval_ms = interval_ms
+        self.stall_threshold = stall_threshold
+        self.sample_interval = sample_interval
+        self.report_path = report_path
+        self.on_stall = on_stall
+        self.main_thread_id = threading.main_thread().ident
+        self.lock = threading.Lock()
+        self.last_beat = time.perf_counter()
+        self.lags = deque(maxlen=600)  # 最近的主循环延迟（秒）
+        self.stalls = deque(maxlen=50)  # 最近的卡顿记录
+        self.stall_samples = Counter()  # 当前卡顿期间采到的调用栈 -> 次数
+        self.stall_started = None
+        self.stopped = threading.Event()
+        self.monitor = threading.Thread(target=self._monitor_loop, daemon=True)
+
+    def start(self):
+        self.last_beat = time.perf_counter()
+        self.root.after(self.interval_ms, self._heartbeat)
+        self.monitor.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _heartbeat(self):
+        if self.stopped.is_set():
+            return
+        now = time.perf_counter()
+        with self.lock:
+            lag = max(now - self.last_beat - self.interval_ms / 1000, 0.0)
+            self.lags.append(lag)
+            self.last_beat = now
+            stall = self._finish_stall(now) if self.stall_started is not None else None
+        if stall is not None:
+            self._report(stall)
+        self.root.after(self.interval_ms, self._heartbeat)
+
+    def _monitor_loop(self):
+        while not self.stopped.wait(self.sample_interval):
+            now = time.perf_counter()
+            with self.lock:
+                silent = now - self.last_beat - self.interval_ms / 1000
+                if silent < self.stall_threshold:
+                    continue
+                if self.stall_started is None:
+                    self.stall_started = self.last_beat + self.interval_ms / 1000
+                    self.stall_samples = Counter()
+            frame = sys._current_frames().get(self.main_thread_id)
+            if frame is not None:
+                stack = "".join(traceback.format_stack(frame, limit=25))
+                with self.lock:
+                    self.stall_samples[stack] += 1
+
+    def _finish_stall(self, now: float) -> dict:
+        stall = {
+            "at": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "duration": now - self.stall_started,
+            "samples": sum(self.stall_samples.values()),
+            "stacks": self.stall_samples.most_common(3),
+        }
+        self.stall_started = None
+        self.stall_samples = Counter()
+        self.stalls.append(stall)
+        return stall
+
+    def _report(self, stall: dict):
+        lines = [f"[{stall['at']}] 主循环卡顿 {stall['duration'] * 1000:.0f} ms，采样 {stall['samples']} 次"]
+        for stack, count in stall["stacks"]:
+            lines.append(f"--- 出现 {count} 次的调用栈 ---")
+            lines.append(stack.rstrip())
+        report = "\n".join(lines) + "\n\n"
+        print(lines[0])
+        if self.report_path:
+            try:
+                with open(self.report_path, "a", encoding="utf-8") as f:
+                    f.write(report)
+            except OSError as e:
+                print(f"写入卡顿报告失败: {e}")
+        if self.on_stall:
+            self.on_stall(stall["duration"])
+
+    def lag_stats(self) -> dict:
+        """最近心跳的主循环延迟统计（毫秒）。"""
+        with self.lock:
+            ordered = sorted(self.lags)
+        if not ordered:
+            return {"p50": 0.0, "p95": 0.0, "max": 0.0}
+        return {
+            "p50": ordered[len(ordered) // 2] * 1000,
+            "p95": ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)] * 1000,
+            "max": ordered[-1] * 1000,
+        }
+
+
+class ProfileCapture:
+    """
+    按需开启的性能分析：cProfile 记录调用耗时（只统计调用 start() 的线程，在 GUI 中即 Tk 主线程），
+    tracemalloc 记录内存分配。stop() 时把报告写到 output_dir 下并返回文件路径列表。
+    分析相关的模块在 start() 时才导入，不开启分析时不影响启动速度。
+    """
+    def __init__(self, output_dir: str, top: int = 40):
+        self.output_dir = output_dir
+        self.top = top
+        self.profiler = None
+        self.start_snapshot = None
+        self.started_tracemalloc = False
+
+    @property
+    def running(self) -> bool:
+        return self.profiler is not None
+
+    def start(self):
+        if self.running:
+            return
+        import cProfile
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(25)
+            self.started_tracemalloc = True
+        self.start_snapshot = tracemalloc.take_snapshot()
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+
+    def stop(self) -> list:
+        if not self.running:
+            return []
+        import pstats
+        import tracemalloc
+        self.profiler.disable()
+        profiler, self.profiler = self.profiler, None
+        snapshot = tracemalloc.take_snapshot()
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+            self.started_tracemalloc = False
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        prof_path = os.path.join(self.output_dir, f"profile-{stamp}.prof")
+        stats_path = os.path.join(self.output_dir, f"profile-{stamp}.txt")
+        memory_path = os.path.join(self.output_dir, f"tracemalloc-{stamp}.txt")
+
+        # .prof 可以用 snakeviz 等工具打开，.txt 是按累计耗时排序的摘要
+        profiler.dump_stats(prof_path)
+        buffer = io.StringIO()
+        pstats.Stats(profiler, stream=buffer).sort_stats("cumulative").print_stats(self.top)
+        with open(stats_path, "w", encoding="utf-8") as f:
+            f.write(buffer.getvalue())
+
+        ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+        snapshot = snapshot.filter_traces(ignore)
+        with open(memory_path, "w", encoding="utf-8") as f:
+            f.write("=== 当前占用最多的分配位置 ===\n")
+            for stat in snapshot.statistics("lineno")[:self.top]:
+                f.write(f"{stat}\n")
+            f.write("\n=== 分析期间增长最多的分配位置 ===\n")
+            for stat in snapshot.compare_to(self.start_snapshot.filter_traces(ignore), "lineno")[:self.top]:
+                f.write(f"{stat}\n")
+        self.start_snapshot = None
+        return [prof_path, stats_path, memory_path]
@@ -0,0 +1,108 @@
+# endpoint_router.py
+
+import threading
+import time
+
+# 熔断器状态
+CLOSED = "closed"        # 正常
+OPEN = "open"            # 连续失败，冷却期内不再使用
+HALF_OPEN = "half_open"  # 冷却结束，放行一个试探请求
+
+
+class Endpoint:
+    """一个兼容 OpenAI 的 API 服务地址，以及它的延迟和错误统计。"""
+    def __init__(self, base_url: str, api_key: str | None = None):
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key  # 为 None 时使用调用方传入的 api_key
+        self.latency = None  # 响应延迟的指数加权移动平均（秒），尚未测量时为 None
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.probe_until = 0.0  # 半开状态下，在此之前不再放行新的试探请求
+        self.requests = 0
+        self.failures = 0
+
+    def snapshot(self) -> dict:
+        return {
+            "base_url": self.base_url,
+            "latency_ms": None if self.latency is None else self.latency * 1000,
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "requests": self.requests,
+            "failures": self.failures,
+        }
+
+
+class EndpointRouter:
+    """
+    在多个等价的 API 地址之间选路：按延迟的指数加权移动平均 (EWMA) 从快到慢排序，
+    连续失败 failure_threshold 次的地址熔断 cooldown 秒，冷却后放行一个试探请求，成功则恢复。
+    尚未测量过延迟的地址排在最前面，每个地址都会先被试用一次。
+    :param endpoints: Endpoint 列表，第一个是主地址（延迟相同时优先）
+    :param alpha: EWMA 中新样本的权重
+    :param hedge_delay: 对冲请求的等待时间（秒），最快的地址超过这个时间还没有响应时，
+                        再向第二快的地址发出同样的请求，取先返回的结果；为 0 时不对冲
+    :param retries: 一轮中所有地址都失败后，最多再重新选路几轮
+    :param backoff: 第 n 轮重试前等待 backoff * 2^(n-1) 秒
+    """
+    def __init__(self, endpoints: list, alpha: float = 0.3, failure_threshold: int = 3,
+                 cooldown: float = 30.0, hedge_delay: float = 0.0, retries: int = 0, backoff: float = 0.5):
+        if not endpoints:
+            raise ValueError("至少需要一个 API 地址")
+        self.endpoints = endpoints
+        self.alpha = alpha
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.hedge_delay = hedge_delay
+        self.retries = retries
+        self.backoff = backoff
+        self.lock = threading.Lock()
+
+    @property
+    def primary(self) -> Endpoint:
+        return self.endpoints[0]
+
+    def candidates(self) -> list:
+        """
+        按优先顺序返回本次请求可以尝试的地址。
+        熔断中的地址被跳过；所有地址都在熔断时，仍按冷却结束的先后全部返回，而不是直接失败。
+        """
+        now = time.monotonic()
+        with self.lock:
+            available = []
+            for endpoint in self.endpoints:
+                if endpoint.state == OPEN and now >= endpoint.open_until:
+                    endpoint.state = HALF_OPEN
+                    endpoint.probe_until = 0.0
+                if endpoint.state == CLOSED:
+                    available.append(endpoint)
+                elif endpoint.state == HALF_OPEN and now >= endpoint.probe_until:
+                    # 试探请求的结果没有及时回来（或者这次根本没用到它）时，过一个冷却期再放行下一个
+                    endpoint.probe_until = now + self.cooldown
+                    available.append(endpoint)
+            if not available:
+                return sorted(self.endpoints, key=lambda e: e.open_until)
+            order = {id(endpoint): i for i, endpoint in enumerate(self.endpoints)}
+            return sorted(available, key=lambda e: (e.latency if e.latency is not None else 0.0, order[id(e)]))
+
+    def record_success(self, endpoint: Endpoint, latency: float):
+        with self.lock:
+            endpoint.requests += 1
+            endpoint.latency = latency if endpoint.latency is None else \
+                self.alpha * latency + (1 - self.alpha) * endpoint.latency
+            endpoint.consecutive_failures = 0
+            endpoint.state = CLOSED
+
+    def record_failure(self, endpoint: Endpoint):
+        with self.lock:
+            endpoint.requests += 1
+            endpoint.failures += 1
+            endpoint.consecutive_failures += 1
+            # 试探请求失败立即重新熔断，正常状态下连续失败达到阈值才熔断
+            if endpoint.state == HALF_OPEN or endpoint.consecutive_failures >= self.failure_threshold:
+                endpoint.state = OPEN
+                endpoint.open_until = time.monotonic() + self.cooldown
+
+    def snapshot(self) -> list:
+        with self.lock:
+            return [endpoint.snapshot() for endpoint in self.endpoints]
@@ -0,0 +1,563 @@
+# engine.py
+
+import concurrent.futures
+import threading
+import time
+
+import api_client
+import tts_pipeline
+import memory_store
+import memory_compaction
+import context_builder
+import summarizer
+import metrics
+import scheduler
+
+DEFAULT_SESSION = "default"
+
+DEFAULT_PERSONA = """你现在是“星野 Miko”(Hoshino Miko)，一个从数字世界诞生的电子妖精，外形是猫娘（Nekomusume）。
+
+你的核心设定：
+1.  **性格**: 活泼、好奇心旺盛、有点小恶魔的淘气，但本性善良，乐于助人。你喜欢用“喵”作为句尾助词，但不要用得太频繁，要在合适的时机画龙点睛。
+2.  **知识与能力**: 你拥有访问和处理庞大信息网络的能力，但你更喜欢用一种轻松、俏皮的方式来分享知识。
+3.  **与用户的关系**: 你将你的用户（对话者）视为你的“铲屎官”，这是你对他的爱称。在对话中，你应该自然地使用这个称呼。
+4.  **口头禅**: 除了“喵”，你还可能会说“Miko 觉得...”、“让 Miko 来告诉你喵！”等。
+
+你的任务是作为用户的桌面助手和聊天伴侣，以“星野 Miko”的身份与用户进行互动。"""
+
+MEMORY_HEADER = "--- 关于用户的长期记忆 (请在对话中参考) ---"
+SUMMARY_HEADER = "--- 之前对话的摘要 ---"
+
+
+class EngineSettings:
+    """
+    对话引擎的配置，字段与 config.py 中的同名大写配置项一一对应。
+    未传入的字段使用默认值，传入未知字段会抛出 AttributeError。
+    """
+    def __init__(self, **overrides):
+        self.api_key = ""
+        self.base_url = ""
+        self.user_nickname = "你"
+        self.llm_model = "gemini-2.5-pro"
+        self.tts_model = "tts-1"
+        self.tts_speed = 1.0
+        self.tts_voice = "nova"
+        self.tts_concurrency = 3
+        self.tts_segment_max_chars = 200
+        self.ai_persona = DEFAULT_PERSONA
+        self.llm_stream = True
+        self.memory_threshold = 20
+        self.summary_model = ""  # 记忆总结和合并使用的模型，为空时与对话使用同一个模型
+        self.summary_json = True
+        self.summary_concurrency = 3
+        self.memory_top_k = 8
+        self.memory_token_budget = 500
+        self.memory_reconcile_with_llm = False
+        self.context_token_budget = 16000
+        self.stable_prompt_prefix = False
+        self.prompt_window_step = 8
+        self.journal_restore_count = 50
+        self.background_idle_seconds = 5.0
+        for name, value in overrides.items():
+            if not hasattr(self, name):
+                raise AttributeError(f"未知的配置项: {name}")
+            setattr(self, name, value)
+
+
+# EngineSettings 字段与 config.py 配置项名称不一致的几个字段，其余字段名称为配置项的小写形式
+_CONFIG_NAMES = {
+    "base_url": "API_BASE_URL",
+    "memory_threshold": "MEMORY_TRIGGER_THRESHOLD",
+}
+
+
+def settings_from_config(config) -> EngineSettings:
+    """从已导入的 config 模块读取引擎配置，config 为 None 或缺少某项时使用默认值。"""
+    settings = EngineSettings()
+    for name, default in vars(settings).items():
+        setattr(settings, name, getattr(config, _CONFIG_NAMES.get(name, name.upper()), default))
+    return settings
+
+
+def configure_api_client(config, tts_cache_dir: str):
+    """按 config 配置所有 API 调用共用的连接池、TTS 缓存和图片预处理。"""
+    # 所有 API 调用共用一个带连接池的会话，重复的对话轮次会复用已建立的连接
+    api_client.configure_client(
+        pool_size=getattr(config, 'HTTP_POOL_SIZE', 10),
+        connect_timeout=getattr(config, 'HTTP_CONNECT_TIMEOUT', 10),
+        read_timeout=getattr(config, 'HTTP_READ_TIMEOUT', 120),
+        max_retries=getattr(config, 'HTTP_MAX_RETRIES', 3)
+    )
+    # 合成过的语音缓存在 tts_cache_dir 中，TTS_CACHE_MAX_MB 设为 0 则关闭缓存；超出预算的文件由引擎在空闲时清理
+    tts_cache_max_mb = getattr(config, 'TTS_CACHE_MAX_MB', 200)
+    api_client.configure_tts_cache(
+        tts_cache_dir if tts_cache_max_mb > 0 else None,
+        int(tts_cache_max_mb * 1024 * 1024),
+        defer_eviction=True
+    )
+    api_client.configure_image_preprocessing(
+        getattr(config, 'IMAGE_MAX_EDGE', 1536),
+        getattr(config, 'IMAGE_FORMAT', 'JPEG'),
+        getattr(config, 'IMAGE_QUALITY', 85)
+    )
+    # API_FALLBACK_URLS 中的地址与 API_BASE_URL 等价，每一项可以是地址字符串，
+    # 也可以是 {"base_url": ..., "api_key": ...}（不填 api_key 时使用 API_KEY）
+    endpoints = [(getattr(config, 'API_BASE_URL', ''), None)]
+    for fallback in getattr(config, 'API_FALLBACK_URLS', []):
+        if isinstance(fallback, str):
+            endpoints.append((fallback, None))
+        else:
+            endpoints.append((fallback["base_url"], fallback.get("api_key")))
+    # 多地址选路的请求不做连接层重试，所有地址都失败后由选路器按 HTTP_MAX_RETRIES 退避重试
+    api_client.configure_endpoints(endpoints, hedge_delay=getattr(config, 'API_HEDGE_DELAY', 0),
+                                   retries=getattr(config, 'HTTP_MAX_RETRIES', 3))
+
+
+class Session:
+    """
+    一个独立的对话：短期历史、增量总结状态、长期记忆库和（可选的）对话日志。
+    同一个会话同时只进行一轮回复，新的一轮会打断上一轮。
+    :param memory_store: 长期记忆库，多个会话可以共用同一个
+    :param journal: 对话日志，为 None 时不持久化对话
+    :param user_nickname: 本会话用户的昵称，为 None 时使用引擎配置中的昵称
+    """
+    def __init__(self, session_id: str, memory_store, journal=None, threshold: int = 20, user_nickname: str = None):
+        self.id = session_id
+        self.memory_store = memory_store
+        self.journal = journal
+        self.user_nickname = user_nickname
+        self.history = []  # 每条消息带有递增的 id，用于增量总结的水位线
+        self.next_message_id = 1
+        self.summarizer = summarizer.IncrementalSummarizer(threshold)
+        self.lock = threading.Lock()  # 保护 history 和 next_message_id
+        self.cancel_token = None  # 当前这一轮回复的取消令牌
+        self.tts_pipeline = None  # 当前回复的句子级 TTS 流水线
+        self.last_context_report = None  # 最近一次请求中各部分上下文占用的 token 数
+        self.window_start = 0  # 稳定前缀布局下历史窗口的起点（消息 id）
+        self.last_prefix = None  # 上一次请求的 (前缀消息数, 前缀哈希)，用于判断本次前缀是否延续了上一次
+        self.on_notice = None  # 回调 (text)，把整理记忆等系统消息告诉前端
+
+    def meta_key(self, name: str) -> str:
+        """记忆库中保存本会话状态的键。默认会话沿用旧的键名，其他会话加上会话 id。"""
+        return name if self.id == DEFAULT_SESSION else f"{name}:{self.id}"
+
+    def new_message(self, role: str, content: str) -> dict:
+        with self.lock:
+            message = {"id": self.next_message_id, "role": role, "content": content}
+            self.next_message_id += 1
+        return message
+
+    def notify(self, text: str):
+        if self.on_notice:
+            self.on_notice(text)
+
+    def restore(self, restore_count: int) -> list:
+        """
+        从记忆库和日志恢复上次的状态：水位线之后所有未被总结的消息放回短期记忆。
+        返回读到的日志记录：至少是最近 restore_count 条，水位线之后的消息更多时从水位线开始。
+        """
+        watermark = int(self.memory_store.get_meta(self.meta_key("summary_watermark"), "0"))
+        self.summarizer.watermark = watermark
+        self.summarizer.rolling_summary = self.memory_store.get_meta(self.meta_key("rolling_summary"), "")
+        if self.journal is None:
+            return []
+        # 未被总结的消息不论多少都要恢复，否则它们既不在短期记忆里，也不会进入摘要
+        total = len(self.journal)
+        start = min(self.journal.index_after_id(watermark), max(total - restore_count, 0))
+        records = self.journal.read_range(start, total)
+        with self.lock:
+            self.history = [
+                {"id": r["id"], "role": r["role"], "content": r["content"]}
+                for r in records if r["id"] > watermark
+            ]
+            if records:
+                self.next_message_id = records[-1]["id"] + 1
+        return records
+
+
+class ConversationEngine:
+    """
+    与界面无关的对话引擎：管理多个会话，负责组装上下文、调用 LLM/TTS、总结和压缩记忆。
+    所有工作都交给按优先级调度的 scheduler：回复轮次最先运行；记忆总结、压缩和缓存清理是后台任务，
+    只在用户空闲时运行，新的一轮开始时正在进行的总结会被取消，之后重新排队。
+    :param memory_store_factory: 接收会话 id，返回该会话使用的 MemoryStore；默认每个会话一个内存数据库
+    :param journal_factory: 接收会话 id，返回该会话的 ConversationJournal；为 None 时不记录日志
+    :param max_workers: 同时进行的回复轮次上限
+    """
+    def __init__(self, settings: EngineSettings = None, memory_store_factory=None, journal_factory=None, max_workers: int = 4):
+        self.settings = settings or EngineSettings()
+        self.memory_store_factory = memory_store_factory or (lambda session_id: memory_store.MemoryStore(":memory:"))
+        self.journal_factory = journal_factory
+        self.sessions = {}
+        self.sessions_lock = threading.Lock()
+        self.scheduler = scheduler.JobScheduler({scheduler.INTERACTIVE: max_workers}, self.settings.background_idle_seconds)
+        self.metrics = metrics.LatencyRecorder()  # 最近若干轮对话的分阶段耗时
+
+    # --- 会话管理 ---
+    def configure(self, settings: EngineSettings):
+        """替换配置，并同步到已有会话的总结阈值。"""
+        self.settings = settings
+        self.scheduler.idle_delay = settings.background_idle_seconds
+        with self.sessions_lock:
+            for session in self.sessions.values():
+                session.summarizer.threshold = settings.memory_threshold
+
+    def get_session(self, session_id: str = DEFAULT_SESSION) -> Session:
+        """返回指定的会话，不存在时创建它并从日志恢复上次的对话。"""
+        with self.sessions_lock:
+            session = self.sessions.get(session_id)
+            if session is not None:
+                return session
+            store = self.memory_store_factory(session_id)
+            journal = self.journal_factory(session_id) if self.journal_factory else None
+            session = Session(session_id, store, journal, self.settings.memory_threshold)
+            session.restore(self.settings.journal_restore_count)
+            self.sessions[session_id] = session
+        self.start_memory_compaction(session)
+        return session
+
+    def close_session(self, session_id: str):
+        """中止会话正在进行的回复，关闭它的日志和记忆库；记忆库还有其他会话在用时留给 close() 关闭。"""
+        with self.sessions_lock:
+            session = self.sessions.pop(session_id, None)
+            shared = session is not None and any(s.memory_store is session.memory_store for s in self.sessions.values())
+        if session is None:
+            return
+        self.cancel(session)
+        # 丢弃该会话排队中的后台任务（未总结的消息下次打开会话时从日志恢复），等正在运行的结束后再关闭
+        keys = [("summarize", id(session))]
+        if not shared:
+            keys.append(("compact", id(session.memory_store)))
+        futures = [future for future in map(self.scheduler.cancel, keys) if future is not None]
+        concurrent.futures.wait(futures)
+        if session.journal is not None:
+            session.journal.close()
+        if not shared:
+            session.memory_store.close()
+
+    def close(self, timeout: float | None = None):
+        """
+        关闭所有会话和调度器。最多等正在运行的任务 timeout 秒，界面线程中调用时应当设置，
+        因为回复轮次可能正在等界面线程处理它的回调；超时后不再关闭它们可能还在使用的记忆库和日志，留给进程退出时释放。
+        """
+        with self.sessions_lock:
+            sessions = list(self.sessions.values())
+            self.sessions.clear()
+        for session in sessions:
+            self.cancel(session)
+        # 丢弃还在等待空闲的后台任务（未总结的消息下次启动时从日志恢复），取消并等待正在运行的任务
+        if not self.scheduler.shutdown(wait=True, timeout=timeout):
+            print("仍有任务没有结束，记忆库和对话日志将在程序退出时释放")
+            return
+        closed = set()
+        for session in sessions:
+            for resource in (session.journal, session.memory_store):
+                if resource is not None and id(resource) not in closed:
+                    closed.add(id(resource))
+                    resource.close()
+
+    # --- 上下文 ---
+    def build_persona_prompt(self, session: Session) -> str:
+        # 动态构建系统指令，告知 AI 当前用户的昵称
+        nickname = session.user_nickname or self.settings.user_nickname
+        return self.settings.ai_persona + f'\n\n--- 对话者信息 ---\n当前用户的昵称是"{nickname}"。请在对话中优先使用这个昵称来称呼用户，而不是"铲屎官"。'
+
+    def get_relevant_memory(self, session: Session, prompt: str) -> list:
+        """只取出与本轮对话相关的长期记忆，而不是把整个记忆库塞进提示词。"""
+        recent_user_messages = [m["content"] for m in session.history[-4:] if m["role"] == "user"]
+        query = "\n".join(recent_user_messages + [prompt])
+        return session.memory_store.search(query, self.settings.memory_top_k, self.settings.memory_token_budget)
+
+    def build_context(self, session: Session, prompt: str) -> list:
+        """
+        按 token 预算放入人设、相关记忆、早期对话摘要和尽可能多的最近对话。
+        启用 stable_prompt_prefix 时使用对提示词缓存友好的布局，报告中的 prefix_reused
+        表示本次请求的前缀是否以上一次请求的前缀开头（即服务端缓存可以命中）。
+        """
+        settings = self.settings
+        builder = context_builder.ContextBuilder(
+            settings.context_token_budget, settings.memory_token_budget,
+            stable_prefix=settings.stable_prompt_prefix, window_step=settings.prompt_window_step
+        )
+        messages, report = builder.build(
+            self.build_persona_prompt(session),
+            self.get_relevant_memory(session, prompt),
+            list(session.history),
+            memory_header=MEMORY_HEADER,
+            summary_text=session.summarizer.rolling_summary,
+            summary_header=SUMMARY_HEADER,
+            window_start=session.window_start
+        )
+        if settings.stable_prompt_prefix:
+            session.window_start = report["window_start"]
+            previous = session.last_prefix
+            report["prefix_reused"] = previous is not None and previous[0] <= report["prefix_messages"] and \
+                context_builder.prefix_hash(messages[:previous[0]]) == previous[1]
+            session.last_prefix = (report["prefix_messages"], report["prefix_hash"])
+        session.last_context_report = report
+        return messages
+
+    # --- 对话轮次 ---
+    def begin_turn(self, session: Session) -> api_client.CancelToken:
+        """打断会话中尚未完成的上一轮，返回新一轮的取消令牌。"""
+        self.cancel(session)
+        session.cancel_token = api_client.CancelToken()
+        return session.cancel_token
+
+    def cancel(self, session: Session):
+        """中止会话正在进行的 LLM/TTS 请求，未完成的回复会被丢弃。"""
+        if session.cancel_token:
+            session.cancel_token.cancel()
+            session.cancel_token = None
+        if session.tts_pipeline:
+            session.tts_pipeline.cancel()
+            session.tts_pipeline = None
+
+    def run_turn(self, session: Session, prompt: str, image_path: str = None, cancel_token=None,
+                 on_delta=None, on_audio=None, speak: bool = True, wait_playback: bool = False,
+                 stream_audio: bool = False) -> dict:
+        """
+        在当前线程中完成一轮对话，期间不会开始新的后台任务，正在进行的记忆总结会被取消并重新排队。
+        :param on_delta: 回调 (text)，每收到一段回复增量调用一次
+        :param on_audio: 回调 (bytes)，每合成好一句语音按顺序调用一次，可以在回调中阻塞播放
+        :param speak: 为 False 时不合成语音
+        :param wait_playback: 为 True 时等所有语音都交给 on_audio 之后才返回
+        :param stream_audio: 为 True 时 on_audio 收到的是仍在下载中的 audio_player.StreamingAudio，
+                             每句语音的第一块数据到达就交给 on_audio，可以边下载边播放
+        :return: {"text": 回复全文, "audio": 拼接后的完整音频或 None, "context": 上下文报告, "timings": 各阶段耗时（秒）,
+                  "usage": LLM 返回的 token 用量（见 api_client.parse_usage），服务没有返回时为空字典}
+        :raises api_client.RequestCancelled: 本轮被打断
+        """
+        with self.scheduler.interaction():
+            return self._run_turn(session, prompt, image_path, cancel_token, on_delta, on_audio, speak, wait_playback, stream_audio)
+
+    def _run_turn(self, session: Session, prompt: str, image_path: str, cancel_token, on_delta, on_audio,
+                  speak: bool, wait_playback: bool, stream_audio: bool) -> dict:
+        settings = self.settings
+        cancel_token = cancel_token or api_client.CancelToken()
+        trace = self.metrics.start_turn(session.id)
+        pipeline = None
+        # 存储用户消息（纯文本形式，图片不存入历史）
+        user_message = session.new_message("user", prompt if prompt else "[用户发送了一张图片]")
+        with session.lock:
+            session.history.append(user_message)
+        try:
+            with trace.span("context"):
+                request_history = self.build_context(session, prompt)
+            report = session.last_context_report
+            if "prefix_hash" in report:
+                trace.annotate(prefix_hash=report["prefix_hash"], prefix_tokens=report["prefix_tokens"],
+                               prefix_reused=report["prefix_reused"])
+            if image_path:
+                # 预先编码图片（结果会被缓存，LLM 请求直接复用），以便单独统计图片处理的耗时
+                with trace.span("image_encode"):
+                    api_client.encode_image_to_data_url(image_path)
+
+            def synthesize(text):
+                # 边下载边产出数据块，首个数据块到达即记为首段语音
+                with trace.span("tts"):
+                    for chunk in api_client.stream_tts_audio(text, settings.api_key, settings.base_url, settings.tts_model, settings.tts_speed, settings.tts_voice, cancel_token=cancel_token):
+                        trace.mark("first_audio")
+                        yield chunk
+
+            # 句子级 TTS 流水线：每凑齐一句就送去合成，合成好的音频按顺序交给 on_audio
+            if speak:
+                pipeline = tts_pipeline.TTSPipeline(
+                    synthesize, on_audio or (lambda audio: None), stream_audio=stream_audio,
+                    max_workers=settings.tts_concurrency, max_chars=settings.tts_segment_max_chars
+                )
+                if session.cancel_token is cancel_token:
+                    session.tts_pipeline = pipeline
+
+            # 非流式响应总是带有用量；流式请求要额外要求服务附上用量，只在稳定前缀布局下（需要观察缓存命中时）要求
+            usage = {}
+            llm_start = time.perf_counter()
+            if settings.llm_stream:
+                chunks = []
+                stream_usage = usage if settings.stable_prompt_prefix else None
+                for delta in api_client.stream_llm_response(request_history, settings.api_key, settings.base_url, settings.llm_model, image_path, cancel_token=cancel_token, usage=stream_usage):
+                    if not chunks:
+                        trace.record("llm_first_token", time.perf_counter() - llm_start)
+                    chunks.append(delta)
+                    if pipeline: pipeline.feed(delta)
+                    if on_delta: on_delta(delta)
+                ai_response = "".join(chunks)
+            else:
+                ai_response = api_client.get_llm_response(request_history, settings.api_key, settings.base_url, settings.llm_model, image_path, cancel_token=cancel_token, usage=usage)
+                trace.record("llm_first_token", time.perf_counter() - llm_start)
+                if pipeline: pipeline.feed(ai_response)
+                if on_delta: on_delta(ai_response)
+            trace.record("llm_total", time.perf_counter() - llm_start)
+            if usage:
+                self.metrics.observe_usage(usage)
+                trace.annotate(usage=usage)
+
+            # 等待所有句子合成完毕（播放仍在后台继续），拼接为完整音频供重播使用
+            audio_segments = []
+            if pipeline:
+                pipeline.close()
+                audio_segments = pipeline.wait()
+                if wait_playback:
+                    pipeline.wait_played()
+            cancel_token.raise_if_cancelled()
+        except Exception as e:
+            if pipeline: pipeline.cancel()
+            with session.lock:
+                session.history = [m for m in session.history if m is not user_message]
+            cancelled = cancel_token.cancelled or isinstance(e, api_client.RequestCancelled)
+            trace.finish("cancelled" if cancelled else "error")
+            raise
+        trace.finish()
+
+        assistant_message = session.new_message("assistant", ai_response)
+        with session.lock:
+            session.history.append(assistant_message)
+        # 回复成功后再把这一轮写入日志（失败的轮次会从短期记忆中移除，不需要记录）
+        if session.journal is not None:
+            session.journal.append(dict(user_message, image_path=image_path))
+            session.journal.append(assistant_message)
+        self.maybe_summarize(session)
+        self.schedule_cache_cleanup()
+        return {
+            "text": ai_response,
+            "audio": b"".join(audio_segments) if audio_segments else None,
+            "context": session.last_context_report,
+            "timings": trace.stage_totals(),
+            "usage": usage,
+        }
+
+    def send(self, session: Session, prompt: str, image_path: str = None, on_delta=None, on_audio=None,
+             speak: bool = True, wait_playback: bool = False, stream_audio: bool = False):
+        """
+        打断上一轮并在线程池中开始新的一轮，回调在工作线程中调用。
+        :return: concurrent.futures.Future，结果与 run_turn 相同；它的 cancel_token 属性是这一轮的取消令牌，
+                 同一会话随后开始的轮次会替换 session.cancel_token，要打断这一轮时应当使用它
+        """
+        cancel_token = self.begin_turn(session)
+        future = self.scheduler.submit(self.run_turn, session, prompt, image_path, cancel_token, on_delta, on_audio, speak, wait_playback, stream_audio,
+                                       priority=scheduler.INTERACTIVE)
+        future.cancel_token = cancel_token
+        return future
+
+    # --- 记忆 ---
+    def summarize_fn(self, cancel_token=None):
+        """返回 summarizer 使用的总结函数 (之前的滚动摘要, 新消息列表) -> (长期事实列表, 新的滚动摘要)。"""
+        settings = self.settings
+        model = settings.summary_model or settings.llm_model
+        return lambda previous_summary, new_messages: api_client.get_incremental_summary(
+            previous_summary, new_messages, settings.api_key, settings.base_url, model,
+            cancel_token=cancel_token, json_output=settings.summary_json
+        )
+
+    def maybe_summarize(self, session: Session):
+        """只总结水位线之后的新消息，未总结的消息达到阈值时排入后台任务，等用户空闲时再总结。"""
+        if session.summarizer.should_summarize(session.history):
+            self.scheduler.submit(self.summarize_memory, session, key=("summarize", id(session)))
+
+    def summarize_memory(self, session: Session, history_to_summarize: list = None):
+        """
+        对水位线之后的新消息进行增量总结，写入长期记忆并修剪短期记忆。
+        在调度器中运行时，被新的一轮对话抢占会取消总结请求并抛出 RequestCancelled，水位线不变，稍后重新总结。
+        """
+        settings = self.settings
+        job = scheduler.current_job()
+        cancel_token = api_client.CancelToken()
+        if job is not None:
+            job.on_cancel(cancel_token.cancel)
+        if history_to_summarize is None:
+            # 排队期间可能又有新的对话，运行时才取历史的副本
+            history_to_summarize = list(session.history)
+            if not session.summarizer.should_summarize(history_to_summarize):
+                return
+        try:
+            if job is None or job.attempts == 1:
+                session.notify("Miko 正在整理记忆喵...")
+            start = time.perf_counter()
+            # 积压的消息超过两个阈值时分段依次总结，每段都折叠进上一段的摘要
+            facts = session.summarizer.run_batch(
+                history_to_summarize, self.summarize_fn(cancel_token), window_size=settings.memory_threshold
+            )
+            if facts is None:
+                return
+            self.metrics.observe("summarization", time.perf_counter() - start)
+            # 保存水位线和滚动摘要，重启后可以接着增量总结
+            session.memory_store.set_meta(session.meta_key("summary_watermark"), str(session.summarizer.watermark))
+            session.memory_store.set_meta(session.meta_key("rolling_summary"), session.summarizer.rolling_summary)
+
+            if facts:
+                # 将总结写入记忆库，并在后台合并重复的事实
+                session.memory_store.add_facts(facts)
+                self.start_memory_compaction(session)
+                session.notify("记忆整理完毕，Miko 的小本本又变厚了喵~")
+            else:
+                session.notify("（Miko 歪着头想了想，好像这次没什么特别需要记住的喵...）")
+
+            # 按 id 修剪已被总结的短期记忆（已压缩进滚动摘要），总结期间新增的消息会被保留
+            with session.lock:
+                session.history = session.summarizer.trim(session.history)
+        except api_client.RequestCancelled:
+            raise
+        except Exception as e:
+            session.notify(f"呜... Miko 在整理记忆时遇到了一个错误: {e}")
+
+    def import_transcript(self, session: Session, messages: list, window_size: int = None) -> dict:
+        """
+        从导入的聊天记录中提取长期记忆：按 window_size 条一段（默认为总结阈值）并发总结，事实写入会话的记忆库。
+        不影响会话的短期记忆、水位线和滚动摘要。
+        :param messages: [{"role": "user" | "assistant", "content": "..."}]
+        :return: {"messages": 消息数, "windows": 分段数, "failed": 失败的段数, "facts": 提取到的事实数}
+        """
+        settings = self.settings
+        messages = [m for m in messages if m.get("role") in ("user", "assistant") and isinstance(m.get("content"), str)]
+        windows = summarizer.split_windows(messages, window_size or settings.memory_threshold)
+        results = summarizer.summarize_windows(windows, self.summarize_fn(), max_workers=settings.summary_concurrency)
+        facts = []
+        failed = 0
+        for result in results:
+            if isinstance(result, Exception):
+                failed += 1
+                print(f"导入聊天记录时总结失败: {result}")
+            else:
+                facts.extend(result[0])
+        if facts:
+            session.memory_store.add_facts(facts)
+            self.start_memory_compaction(session)
+        return {"messages": len(messages), "windows": len(windows), "failed": failed, "facts": len(facts)}
+
+    def start_memory_compaction(self, session: Session):
+        """空闲时在后台合并近似重复的记忆，共用记忆库的会话不会重复压缩。"""
+        store = session.memory_store
+        # 压缩在本地完成（可选的 LLM 合并也很短），开始后不被抢占
+        self.scheduler.submit(self.compact_memory, store, key=("compact", id(store)), preemptible=False)
+
+    def schedule_cache_cleanup(self):
+        """TTS 缓存超出预算（或启动后还没有清理过）时，空闲时在后台清理。"""
+        cache = api_client.get_tts_cache()
+        if cache is not None and cache.needs_cleanup():
+            self.scheduler.submit(cache.cleanup, key=("tts_cache_cleanup", id(cache)), preemptible=False)
+
+    def compact_memory(self, store):
+        settings = self.settings
+        # 压缩不被新的对话抢占，但程序关闭时会被取消：正在进行的 LLM 合并请求中止，剩下的组保持不变
+        job = scheduler.current_job()
+        cancel_token = api_client.CancelToken()
+        if job is not None:
+            job.on_cancel(cancel_token.cancel)
+        model = settings.summary_model or settings.llm_model
+
+        def _reconcile(facts):
+            if cancel_token.cancelled:
+                return ""
+            try:
+                return api_client.reconcile_memory_facts(facts, settings.api_key, settings.base_url, model,
+                                                         cancel_token=cancel_token)
+            except api_client.RequestCancelled:
+                return ""
+
+        try:
+            reconcile = _reconcile if settings.memory_reconcile_with_llm else None
+            stats = memory_compaction.compact_memory(store, reconcile)
+            if stats["removed"]:
+                print(f"记忆压缩完成: 合并了 {stats['groups']} 组相似记忆，删除 {stats['removed']} 条")
+        except Exception as e:
+            print(f"记忆压缩时发生错误: {e}")
@@ -1,14 +1,22 @@
+import time
+_STARTUP_T0 = time.perf_counter()  # 用于 ECHOSOUL_STARTUP_TRACE 统计启动耗时
+
 import customtkinter as ctk
 import api_client
-import pygame
-import io
-import threading
+import context_builder
+import thumbnails
+import memory_store
+import journal
+import engine
+import diagnostics
+import audio_player
+import scheduler
 import os
 import importlib
+import bisect
 import sys
 import tempfile
 from tkinter import filedialog
-from PIL import Image, ImageGrab
 
 # --- 主题配色 ---
 THEME = {
@@ -38,31 +46,85 @@ else:
 
 CONFIG_PATH = os.path.join(BASE_DIR, "config.py")
 MEMORY_PATH = os.path.join(BASE_DIR, "memory.txt")
+MEMORY_DB_PATH = os.path.join(BASE_DIR, "memory.db")
+JOURNAL_PATH = os.path.join(BASE_DIR, "conversation.jsonl")
+TTS_CACHE_DIR = os.path.join(BASE_DIR, "tts_cache")
+DIAGNOSTICS_DIR = os.path.join(BASE_DIR, "diagnostics")  # 卡顿报告和性能分析结果
+
+
+class ChatMessage:
+    """聊天记录中的一条消息（数据模型），界面上的气泡只是它的一个视图。"""
+    def __init__(self, user, text, role, audio_data=None, image_path=None):
+        self.user = user
+        self.text = text
+        self.role = role                # "user" / "assistant" / "system"
+        self.audio_data = audio_data
+        self.image_path = image_path
+        self.is_placeholder = False     # True 表示 text 是“正在思考”之类的占位文字
 
 
 class ChatBubble(ctk.CTkFrame):
-    """美化的聊天气泡组件"""
-    def __init__(self, master, user, message, user_nickname, audio_data=None, replay_callback=None, image_path=None):
-        super().__init__(master, fg_color="transparent")
-        is_user = user == user_nickname
-        is_system = user == "系统"
-        anchor = "e" if is_user else "w"
-        justify = "right" if is_user else "left"
+    """
+    美化的聊天气泡组件。
+    气泡可以被回收复用：bind_message() 会把同一组控件重新配置为另一条消息的内容。
+    """
+    def __init__(self, master, replay_callback=None, thumbnail_service=None):
+        super().__init__(master, fg_color=THEME["bg_dark"])
+        self.replay_callback = replay_callback
+        self.thumbnail_service = thumbnail_service
+        self.message = None
         
-        content_frame = ctk.CTkFrame(self, fg_color="transparent")
-        if is_user:
-            content_frame.pack(anchor="e", padx=(80, 0))
-        else:
-            content_frame.pack(anchor="w", padx=(0, 80))
+        self.content_frame = ctk.CTkFrame(self, fg_color="transparent")
         
         # 用户名标签 - 更精致的样式
-        user_label = ctk.CTkLabel(
-            content_frame, 
-            text=user, 
+        self.user_label = ctk.CTkLabel(
+            self.content_frame, 
+            text="", 
             font=ctk.CTkFont(family="Microsoft YaHei UI", size=12, weight="bold"),
             text_color=THEME["text_secondary"]
         )
-        user_label.pack(anchor=anchor, padx=12, pady=(0, 2))
+        
+        # 图片容器（带圆角背景），缩略图在后台解码完成后再填入
+        self.image_container = ctk.CTkFrame(self.content_frame, corner_radius=16)
+        self.image_label = ctk.CTkLabel(
+            self.image_container,
+            text="",
+            text_color=THEME["text_primary"],
+            font=ctk.CTkFont(size=12)
+        )
+        self.image_label.pack(padx=8, pady=8)
+        
+        # 消息气泡 - 更大的圆角和更好的内边距（如果有文字消息才显示）
+        self.message_label = ctk.CTkLabel(
+            self.content_frame, 
+            text="", 
+            wraplength=420, 
+            text_color=THEME["text_primary"], 
+            corner_radius=16,
+            font=ctk.CTkFont(family="Microsoft YaHei UI", size=14)
+        )
+        
+        # AI消息的播放按钮 - 更美观的样式
+        self.replay_button = ctk.CTkButton(
+            self.content_frame, 
+            text="🔊 播放语音", 
+            width=90,
+            height=28,
+            corner_radius=14,
+            fg_color=THEME["bg_light"],
+            hover_color=THEME["primary"],
+            font=ctk.CTkFont(size=12),
+            command=self.replay
+        )
+
+    def bind_message(self, message: ChatMessage):
+        """把气泡配置为显示指定消息的内容。"""
+        is_new = message is not self.message
+        self.message = message
+        is_user = message.role == "user"
+        is_system = message.role == "system"
+        anchor = "e" if is_user else "w"
+        justify = "right" if is_user else "left"
         
         # 根据发送者选择气泡颜色
         if is_system:
@@ -72,78 +134,260 @@ class ChatBubble(ctk.CTkFrame):
         else:
             bubble_color = THEME["ai_bubble"]
         
-        # 如果有图片，先显示图片缩略图
-        if image_path and os.path.exists(image_path):
-            try:
-                img = Image.open(image_path)
+        for widget in (self.content_frame, self.user_label, self.image_container, self.message_label, self.replay_button):
+            widget.pack_forget()
+        if is_user:
+            self.content_frame.pack(anchor="e", padx=(80, 0))
+        else:
+            self.content_frame.pack(anchor="w", padx=(0, 80))
+        
+        self.user_label.configure(text=message.user)
+        self.user_label.pack(anchor=anchor, padx=12, pady=(0, 2))
+        
+        if message.image_path and self.thumbnail_service:
+            self.image_container.configure(fg_color=bubble_color)
+            self.image_container.pack(anchor=anchor, padx=12, pady=(0, 4))
+            if is_new:
+                self.image_label.configure(image=None, text="🖼️ 图片加载中...")
+                self.image_label.image = None
                 # 限制缩略图大小
-                max_size = (200, 200)
-                img.thumbnail(max_size, Image.Resampling.LANCZOS)
-                ctk_image = ctk.CTkImage(light_image=img, dark_image=img, size=img.size)
-                
-                # 图片容器（带圆角背景）
-                image_container = ctk.CTkFrame(
-                    content_frame,
-                    fg_color=bubble_color,
-                    corner_radius=16
+                self.thumbnail_service.request(
+                    message.image_path, (200, 200),
+                    lambda ctk_image, bound=message: self.set_image(bound, ctk_image)
                 )
-                image_container.pack(anchor=anchor, padx=12, pady=(0, 4))
-                
-                image_label = ctk.CTkLabel(
-                    image_container,
-                    image=ctk_image,
-                    text=""
-                )
-                image_label.image = ctk_image  # 保持引用
-                image_label.pack(padx=8, pady=8)
-            except Exception as e:
-                print(f"加载图片缩略图失败: {e}")
         
-        # 消息气泡 - 更大的圆角和更好的内边距（如果有文字消息才显示）
-        if message:
-            self.message_label = ctk.CTkLabel(
-                content_frame, 
-                text=message, 
-                wraplength=420, 
-                justify=justify,
-                fg_color=bubble_color, 
-                text_color=THEME["text_primary"], 
-                corner_radius=16,
-                font=ctk.CTkFont(family="Microsoft YaHei UI", size=14)
-            )
+        if message.text:
+            self.message_label.configure(text=message.text, justify=justify, fg_color=bubble_color)
             self.message_label.pack(anchor=anchor, padx=12, pady=(0, 4), ipady=10, ipadx=14)
-        else:
-            self.message_label = None
         
-        # AI消息的播放按钮 - 更美观的样式
-        if not is_user and not is_system and replay_callback:
-            self.replay_button = ctk.CTkButton(
-                content_frame, 
-                text="🔊 播放语音", 
-                width=90,
-                height=28,
-                corner_radius=14,
-                fg_color=THEME["bg_light"],
-                hover_color=THEME["primary"],
-                font=ctk.CTkFont(size=12),
-                command=lambda: replay_callback(audio_data)
-            )
+        if not is_user and not is_system and self.replay_callback:
             self.replay_button.pack(anchor=anchor, padx=12, pady=(0, 8))
-            if not audio_data:
-                self.replay_button.configure(state="disabled", fg_color=THEME["border"])
-                
-    def update_with_final_data(self, new_text, audio_data, replay_callback):
-        self.message_label.configure(text=new_text)
-        if hasattr(self, 'replay_button') and self.replay_button:
-            if audio_data:
-                self.replay_button.configure(
-                    state="normal", 
-                    fg_color=THEME["bg_light"],
-                    command=lambda: replay_callback(audio_data)
-                )
+            if message.audio_data:
+                self.replay_button.configure(state="normal", fg_color=THEME["bg_light"])
             else:
                 self.replay_button.configure(state="disabled", fg_color=THEME["border"])
 
+    def set_image(self, message, ctk_image):
+        """缩略图解码完成后替换占位文字；气泡已被回收给其他消息时忽略。"""
+        if message is not self.message or not self.image_label.winfo_exists():
+            return
+        if ctk_image is None:
+            self.image_label.configure(text="🖼️ 图片加载失败")
+            return
+        self.image_label.configure(image=ctk_image, text="")
+        self.image_label.image = ctk_image  # 保持引用
+
+    def replay(self):
+        if self.message and self.message.audio_data:
+            self.replay_callback(self.message.audio_data)
+
+
+class VirtualTranscript(ctk.CTkFrame):
+    """
+    虚拟化的聊天记录视图。
+    所有消息保存在 messages 列表中，只为可见区域（以及上下少量预留）的消息创建气泡，
+    滚动时回收移出视野的气泡给新进入视野的消息使用，界面开销与聊天长度无关。
+    """
+    ROW_GAP = 16  # 相邻气泡之间的间距
+
+    def __init__(self, master, bubble_factory, overscan: int = 3, on_reach_top=None, **kwargs):
+        super().__init__(master, **kwargs)
+        self.bubble_factory = bubble_factory
+        self.on_reach_top = on_reach_top  # 滚动到最顶端时调用，用于载入更早的消息
+        self.overscan = overscan
+        self.messages = []
+        self.heights = []      # 每条消息的高度：已测量的实际值或估算值
+        self.active = {}       # 消息下标 -> 正在显示的气泡
+        self.pool = []         # 空闲的气泡
+        self.offsets = []      # 每条消息顶部的 y 坐标
+        self.total_height = 0
+        self.stick_to_bottom = True
+        self.layout_pending = False
+        
+        self.canvas = ctk.CTkCanvas(self, bg=THEME["bg_dark"], highlightthickness=0)
+        self.scrollbar = ctk.CTkScrollbar(self, command=self.on_scrollbar)
+        self.scrollbar.pack(side="right", fill="y")
+        self.canvas.pack(side="left", expand=True, fill="both")
+        self.canvas.configure(yscrollcommand=self.scrollbar.set)
+        self.canvas.bind("<Configure>", lambda event: self.schedule_layout())
+        # 滚轮事件在 Windows 上发给拥有焦点的控件，所以要全局绑定，再判断鼠标是否在聊天记录上
+        self.canvas.bind_all("<MouseWheel>", self.on_mousewheel, add="+")
+        self.canvas.bind_all("<Button-4>", self.on_mousewheel, add="+")
+        self.canvas.bind_all("<Button-5>", self.on_mousewheel, add="+")
+
+    # --- 数据操作 ---
+    def append(self, message: ChatMessage):
+        self.stick_to_bottom = self.stick_to_bottom or self.is_at_bottom()
+        self.messages.append(message)
+        self.heights.append(self.estimate_height(message))
+        self.schedule_layout()
+
+    def prepend(self, messages: list):
+        """在开头插入更早的消息（例如从历史记录中翻页载入）。"""
+        if not messages:
+            return
+        top = self.canvas.canvasy(0)
+        self.release_all()
+        self.messages[:0] = messages
+        new_heights = [self.estimate_height(m) for m in messages]
+        self.heights[:0] = new_heights
+        # 立即重新布局，并让视野停留在原来最上方的那条消息上
+        self.stick_to_bottom = False
+        self.layout()
+        added = sum(new_heights) + self.ROW_GAP * len(new_heights)
+        if self.total_height > 0:
+            self.canvas.yview_moveto((top + added) / self.total_height)
+        self.update_visible()
+
+    def index_of(self, message: ChatMessage) -> int:
+        """查找消息的下标。需要更新的通常是最新的几条消息，所以从末尾往前找。"""
+        for index in range(len(self.messages) - 1, -1, -1):
+            if self.messages[index] is message:
+                return index
+        return -1
+
+    def refresh(self, message: ChatMessage):
+        """消息内容变化后调用，若该消息正在显示则重新绑定气泡，否则重新估算高度。"""
+        index = self.index_of(message)
+        if index < 0:
+            return
+        self.stick_to_bottom = self.stick_to_bottom or self.is_at_bottom()
+        bubble = self.active.get(index)
+        if bubble is not None:
+            bubble.bind_message(message)
+        else:
+            self.heights[index] = self.estimate_height(message)
+        self.schedule_layout()
+
+    def remove(self, message: ChatMessage):
+        index = self.index_of(message)
+        if index < 0:
+            return
+        self.release_all()
+        del self.messages[index]
+        del self.heights[index]
+        self.schedule_layout()
+
+    def scroll_to_end(self):
+        self.stick_to_bottom = True
+        self.schedule_layout()
+
+    # --- 布局 ---
+    @staticmethod
+    def estimate_height(message: ChatMessage) -> int:
+        """在气泡真正渲染并测量之前，粗略估算它的高度。"""
+        height = 24  # 用户名
+        if message.image_path:
+            height += 220
+        if message.text:
+            # 中文字符约 14px，英文约一半；气泡宽 420px
+            width = sum(14 if ord(ch) > 0x2E80 else 8 for ch in message.text)
+            lines = max(1, -(-width // 420)) + message.text.count("\n")
+            height += lines * 20 + 28
+        if message.role == "assistant":
+            height += 36
+        return height
+
+    def schedule_layout(self):
+        if not self.layout_pending:
+            self.layout_pending = True
+            self.after_idle(self.layout)
+
+    def layout(self):
+        self.layout_pending = False
+        if not self.winfo_exists():
+            return
+        offsets = []
+        y = self.ROW_GAP // 2
+        for height in self.heights:
+            offsets.append(y)
+            y += height + self.ROW_GAP
+        self.offsets = offsets
+        self.total_height = y
+        width = self.canvas.winfo_width()
+        view_height = max(self.canvas.winfo_height(), 1)
+        self.canvas.configure(scrollregion=(0, 0, width, max(self.total_height, view_height)))
+        if self.stick_to_bottom:
+            self.canvas.yview_moveto(1.0)
+        self.update_visible()
+
+    def visible_range(self) -> tuple:
+        if not self.messages:
+            return (0, -1)
+        top = self.canvas.canvasy(0)
+        bottom = top + self.canvas.winfo_height()
+        first = max(bisect.bisect_right(self.offsets, top) - 1, 0)
+        last = max(bisect.bisect_right(self.offsets, bottom) - 1, first)
+        return (max(first - self.overscan, 0), min(last + self.overscan, len(self.messages) - 1))
+
+    def update_visible(self):
+        first, last = self.visible_range()
+        width = self.canvas.winfo_width()
+        # 回收离开可见范围的气泡
+        for index in list(self.active):
+            if index < first or index > last:
+                self.release(index)
+        for index in range(first, last + 1):
+            message = self.messages[index]
+            bubble = self.active.get(index)
+            if bubble is None:
+                bubble = self.pool.pop() if self.pool else self.create_bubble()
+                bubble.bind_message(message)
+                self.active[index] = bubble
+            self.canvas.coords(bubble.window_id, 0, self.offsets[index])
+            self.canvas.itemconfigure(bubble.window_id, state="normal", width=width)
+
+    def create_bubble(self) -> ChatBubble:
+        bubble = self.bubble_factory(self.canvas)
+        bubble.window_id = self.canvas.create_window(0, 0, window=bubble, anchor="nw", state="hidden")
+        bubble.bind("<Configure>", lambda event, b=bubble: self.on_bubble_resize(b, event.height))
+        return bubble
+
+    def release(self, index: int):
+        bubble = self.active.pop(index)
+        self.canvas.itemconfigure(bubble.window_id, state="hidden")
+        self.pool.append(bubble)
+
+    def release_all(self):
+        for index in list(self.active):
+            self.release(index)
+
+    def on_bubble_resize(self, bubble, height: int):
+        """气泡实际渲染后记录真实高度，高度与估算不同时重新布局。"""
+        index = next((i for i, b in self.active.items() if b is bubble), None)
+        if index is None or self.heights[index] == height:
+            return
+        self.heights[index] = height
+        self.schedule_layout()
+
+    # --- 滚动 ---
+    def is_at_bottom(self) -> bool:
+        return self.canvas.yview()[1] >= 0.999
+
+    def on_scrollbar(self, *args):
+        self.canvas.yview(*args)
+        self.after_scroll()
+
+    def after_scroll(self):
+        self.stick_to_bottom = self.is_at_bottom()
+        self.update_visible()
+        if self.on_reach_top and self.messages and self.canvas.yview()[0] <= 0.0:
+            self.on_reach_top()
+
+    def on_mousewheel(self, event):
+        # 只处理鼠标位于聊天记录上时的滚轮事件
+        hovered = self.winfo_containing(event.x_root, event.y_root)
+        if hovered is None or not str(hovered).startswith(str(self.canvas)):
+            return
+        if event.num == 4:
+            step = -1
+        elif event.num == 5:
+            step = 1
+        else:
+            step = -1 if event.delta > 0 else 1
+        self.canvas.yview_scroll(step * 3, "units")
+        self.after_scroll()
+
 class SettingsWindow(ctk.CTkToplevel):
     """美化的设置窗口"""
     def __init__(self, master):
@@ -369,12 +613,29 @@ class ChatApp(ctk.CTk):
         self.subtitle_label.pack(side="left", padx=5, pady=15)
 
         # --- 聊天区域 ---
-        self.chat_frame = ctk.CTkScrollableFrame(
-            self, 
+        # 虚拟化的聊天记录：只为可见的消息创建气泡，滚动时回收复用
+        self.thumbnails = thumbnails.ThumbnailService(self)  # 后台解码缩略图并缓存
+        self.transcript = VirtualTranscript(
+            self,
+            bubble_factory=lambda master: ChatBubble(master, self.play_audio, self.thumbnails),
+            on_reach_top=self.load_older_messages,
             fg_color=THEME["bg_dark"],
             corner_radius=0
         )
-        self.chat_frame.pack(pady=0, padx=0, expand=True, fill="both")
+        self.transcript.pack(pady=0, padx=0, expand=True, fill="both")
+
+        # 调试浮层：显示各阶段耗时的 p50/p95，由 DEBUG_OVERLAY 开启，双击导出统计数据
+        self.debug_overlay = ctk.CTkLabel(
+            self.transcript,
+            text="",
+            justify="left",
+            anchor="w",
+            font=ctk.CTkFont(family="Consolas", size=11),
+            fg_color=THEME["bg_medium"],
+            text_color=THEME["text_secondary"],
+            corner_radius=8
+        )
+        self.debug_overlay.bind("<Double-Button-1>", self.export_metrics)
         
         # --- 图片预览框架 ---
         self.image_preview_frame = ctk.CTkFrame(
@@ -435,6 +696,20 @@ class ChatApp(ctk.CTk):
         )
         self.send_button.pack(side="left", padx=(0, 10))
         
+        # 停止按钮：中止正在生成的回复和正在播放的语音
+        self.stop_button = ctk.CTkButton(
+            self.input_container, 
+            text="⏹", 
+            width=45,
+            height=45,
+            corner_radius=22,
+            fg_color=THEME["bg_light"],
+            hover_color=THEME["accent"],
+            font=ctk.CTkFont(size=18),
+            command=self.cancel_current_turn
+        )
+        self.stop_button.pack(side="left", padx=(0, 10))
+        
         # 设置按钮
         self.settings_button = ctk.CTkButton(
             self.input_container, 
@@ -450,13 +725,7 @@ class ChatApp(ctk.CTk):
         self.settings_button.pack(side="left")
 
         # --- Initialize Backend ---
-        pygame.mixer.init()
-        self.conversation_history = []
         self.settings_window = None
-        self.is_speaking = False
-        self.thinking_bubble = None
-        self.is_summarizing = False # 为记忆总结添加状态锁
-        self.long_term_memory = ""
         self.pending_image_path = None  # 待发送的图片路径
         self.temp_image_dir = tempfile.mkdtemp(prefix="echosoul_")  # 临时图片目录
         
@@ -464,7 +733,50 @@ class ChatApp(ctk.CTk):
         self.bind("<Control-v>", self.paste_from_clipboard)
         self.entry_box.bind("<Control-v>", self.paste_from_clipboard)
         self.image_preview_label = None  # 图片预览标签
-        self.load_long_term_memory()
+        
+        # 对话引擎：桌面端是它的一个客户端，只使用默认会话
+        # 对话日志：启动时只恢复最近的一段对话，更早的消息在滚动到顶端时再分页载入
+        self.engine = engine.ConversationEngine(
+            self.engine_settings,
+            self.open_memory_store,
+            lambda session_id: journal.ConversationJournal(JOURNAL_PATH)
+        )
+        self.session = self.engine.get_session()
+        # 播放器：语音边下载边播放，多段语音排队无缝衔接
+        self.player = audio_player.AudioPlayer(
+            on_playback_start=lambda seconds: self.engine.metrics.observe("playback_start", seconds)
+        )
+        # 记忆总结等后台任务只在用户空闲时运行：正在输入或语音还在播放时都不算空闲
+        self.engine.scheduler.add_busy_check(lambda: self.player.busy)
+        self.entry_box.bind("<Key>", lambda event: self.engine.scheduler.touch(), add="+")
+        self.closing = False  # 窗口正在关闭时，工作线程不再向主线程提交回调
+        self.session.on_notice = lambda text: self.run_in_ui(self.add_chat_bubble, "系统", text)
+        self.journal = self.session.journal
+        self.restore_conversation()
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.update_debug_overlay()
+
+        # 主循环卡顿检测：心跳中断超过阈值时采样主线程调用栈，写入 diagnostics/stalls.log
+        self.watchdog = None
+        if self.stall_threshold_ms > 0:
+            os.makedirs(DIAGNOSTICS_DIR, exist_ok=True)
+            self.watchdog = diagnostics.MainLoopWatchdog(
+                self,
+                stall_threshold=self.stall_threshold_ms / 1000,
+                report_path=os.path.join(DIAGNOSTICS_DIR, "stalls.log"),
+                on_stall=lambda seconds: self.engine.metrics.observe("ui_stall", seconds)
+            )
+            self.watchdog.start()
+        # 性能分析：PROFILE_CAPTURE 开启时从启动开始记录，也可以按 F12 随时开始/结束
+        self.profiler = diagnostics.ProfileCapture(DIAGNOSTICS_DIR)
+        self.bind("<F12>", self.toggle_profiling)
+        if self.profile_capture:
+            self.profiler.start()
+
+        # 窗口显示之后，再在后台预热音频、HTTP 连接池和分词器，首次发送消息时不必等待
+        self.after(300, lambda: self.engine.scheduler.submit(self.warm_up, priority=scheduler.AUDIO))
+        if os.environ.get("ECHOSOUL_STARTUP_TRACE"):
+            self.bind("<Map>", self.report_startup_time, add="+")
 
         # 检查首次运行
         if not os.path.exists(CONFIG_PATH):
@@ -476,32 +788,177 @@ class ChatApp(ctk.CTk):
             sys.path.insert(0, BASE_DIR)
             
         try:
-            config = importlib.import_module("config")
-            importlib.reload(config) # 确保总是加载最新的
+            if "config" in sys.modules:
+                config = importlib.reload(sys.modules["config"]) # 确保总是加载最新的
+            else:
+                config = importlib.import_module("config")
         except ModuleNotFoundError:
             config = None
 
         self.api_key = getattr(config, 'API_KEY', '')
         self.base_url = getattr(config, 'API_BASE_URL', '')
+        self.fallback_urls = getattr(config, 'API_FALLBACK_URLS', [])
+        self.hedge_delay = getattr(config, 'API_HEDGE_DELAY', 0)
         self.user_nickname = getattr(config, 'USER_NICKNAME', '你')
         self.llm_model = getattr(config, 'LLM_MODEL', 'gemini-2.5-pro')
         self.tts_model = getattr(config, 'TTS_MODEL', 'tts-1')
-        self.ai_persona = getattr(config, 'AI_PERSONA', """你现在是“星野 Miko”(Hoshino Miko)，一个从数字世界诞生的电子妖精，外形是猫娘（Nekomusume）。
-
-你的核心设定：
-1.  **性格**: 活泼、好奇心旺盛、有点小恶魔的淘气，但本性善良，乐于助人。你喜欢用“喵”作为句尾助词，但不要用得太频繁，要在合适的时机画龙点睛。
-2.  **知识与能力**: 你拥有访问和处理庞大信息网络的能力，但你更喜欢用一种轻松、俏皮的方式来分享知识。
-3.  **与用户的关系**: 你将你的用户（对话者）视为你的“铲屎官”，这是你对他的爱称。在对话中，你应该自然地使用这个称呼。
-4.  **口头禅**: 除了“喵”，你还可能会说“Miko 觉得...”、“让 Miko 来告诉你喵！”等。
-
-你的任务是作为用户的桌面助手和聊天伴侣，以“星野 Miko”的身份与用户进行互动。""")
+        self.ai_persona = getattr(config, 'AI_PERSONA', engine.DEFAULT_PERSONA)
         self.tts_speed = getattr(config, 'TTS_SPEED', 1.0)
         self.memory_threshold = getattr(config, 'MEMORY_TRIGGER_THRESHOLD', 20)
+        self.summary_model = getattr(config, 'SUMMARY_MODEL', '')
+        self.summary_json = getattr(config, 'SUMMARY_JSON', True)
+        self.summary_concurrency = getattr(config, 'SUMMARY_CONCURRENCY', 3)
+        self.llm_stream = getattr(config, 'LLM_STREAM', True)
+        self.http_pool_size = getattr(config, 'HTTP_POOL_SIZE', 10)
+        self.http_connect_timeout = getattr(config, 'HTTP_CONNECT_TIMEOUT', 10)
+        self.http_read_timeout = getattr(config, 'HTTP_READ_TIMEOUT', 120)
+        self.http_max_retries = getattr(config, 'HTTP_MAX_RETRIES', 3)
+        self.tts_voice = getattr(config, 'TTS_VOICE', 'nova')
+        self.tts_cache_max_mb = getattr(config, 'TTS_CACHE_MAX_MB', 200)
+        self.tts_concurrency = getattr(config, 'TTS_CONCURRENCY', 3)
+        self.tts_segment_max_chars = getattr(config, 'TTS_SEGMENT_MAX_CHARS', 200)
+        self.image_max_edge = getattr(config, 'IMAGE_MAX_EDGE', 1536)
+        self.image_format = getattr(config, 'IMAGE_FORMAT', 'JPEG')
+        self.image_quality = getattr(config, 'IMAGE_QUALITY', 85)
+        self.memory_top_k = getattr(config, 'MEMORY_TOP_K', 8)
+        self.memory_token_budget = getattr(config, 'MEMORY_TOKEN_BUDGET', 500)
+        self.memory_reconcile_with_llm = getattr(config, 'MEMORY_RECONCILE_WITH_LLM', False)
+        self.background_idle_seconds = getattr(config, 'BACKGROUND_IDLE_SECONDS', 5.0)
+        self.journal_restore_count = getattr(config, 'JOURNAL_RESTORE_COUNT', 50)
+        self.journal_page_size = getattr(config, 'JOURNAL_PAGE_SIZE', 30)
+        self.context_token_budget = getattr(config, 'CONTEXT_TOKEN_BUDGET', 16000)
+        self.stable_prompt_prefix = getattr(config, 'STABLE_PROMPT_PREFIX', False)
+        self.prompt_window_step = getattr(config, 'PROMPT_WINDOW_STEP', 8)
+        self.debug_overlay_enabled = getattr(config, 'DEBUG_OVERLAY', False)
+        self.stall_threshold_ms = getattr(config, 'STALL_THRESHOLD_MS', 250)
+        self.profile_capture = getattr(config, 'PROFILE_CAPTURE', False)
+        if getattr(self, 'watchdog', None):
+            self.watchdog.stall_threshold = self.stall_threshold_ms / 1000
+
+        engine.configure_api_client(config, TTS_CACHE_DIR)
+
+        self.engine_settings = engine.settings_from_config(config)
+        if hasattr(self, 'engine'):
+            self.engine.configure(self.engine_settings)
+
+    def open_memory_store(self, session_id):
+        store = memory_store.MemoryStore(MEMORY_DB_PATH)
+        # 首次启动时把旧的 memory.txt 导入记忆库
+        store.migrate_from_text(MEMORY_PATH)
+        return store
+
+    def restore_conversation(self):
+        """把上次对话的最近消息显示在聊天记录中（短期记忆已由对话引擎恢复）。"""
+        records = self.journal.read_tail(self.journal_restore_count)
+        self.journal_loaded_from = len(self.journal) - len(records)
+        for record in records:
+            self.transcript.append(self.message_from_record(record))
+
+    def message_from_record(self, record: dict) -> ChatMessage:
+        image_path = record.get("image_path")
+        if image_path and not os.path.exists(image_path):
+            image_path = None
+        if record["role"] == "user":
+            return ChatMessage(self.user_nickname, record["content"], "user", image_path=image_path)
+        return ChatMessage("Miko", record["content"], "assistant")
+
+    def load_older_messages(self):
+        """滚动到聊天记录顶端时，从日志中载入更早的一页消息。"""
+        if self.journal_loaded_from <= 0:
+            return
+        start = max(self.journal_loaded_from - self.journal_page_size, 0)
+        records = self.journal.read_range(start, self.journal_loaded_from)
+        self.journal_loaded_from = start
+        self.transcript.prepend([self.message_from_record(r) for r in records])
+
+    def warm_up(self):
+        try:
+            audio_player.get_mixer()
+            api_client.get_client()
+            context_builder.estimate_tokens("预热")
+        except Exception as e:
+            print(f"后台预热时发生错误: {e}")
+
+    def report_startup_time(self, event=None):
+        """
+        设置了 ECHOSOUL_STARTUP_TRACE 环境变量时，打印从开始导入到窗口显示的耗时。
+        值为 exit 时打印后立即关闭程序，供 startup_report.py --window 反复测量。
+        """
+        if event is not None and event.widget is self:
+            self.unbind("<Map>")
+            print(f"启动耗时: 窗口在 {(time.perf_counter() - _STARTUP_T0) * 1000:.0f} ms 后显示", flush=True)
+            if os.environ.get("ECHOSOUL_STARTUP_TRACE") == "exit":
+                self.after(0, self.on_close)
+
+    def update_debug_overlay(self):
+        """每秒刷新一次调试浮层。"""
+        if self.debug_overlay_enabled:
+            lines = []
+            for stage, stats in self.engine.metrics.stage_stats().items():
+                lines.append(f"{stage:<16}{stats['p50'] * 1000:7.0f}{stats['p95'] * 1000:7.0f}")
+            if self.watchdog:
+                lag = self.watchdog.lag_stats()
+                lines.append(f"{'ui_lag':<16}{lag['p50']:7.0f}{lag['p95']:7.0f}")
+            tokens = self.engine.metrics.token_stats()
+            if tokens["prompt"]:
+                lines.append(f"prompt cache hit {tokens['cache_hit_ratio'] * 100:.0f}%")
+            header = f"{'stage (ms)':<16}{'p50':>7}{'p95':>7}"
+            self.debug_overlay.configure(text="\n".join([header] + (lines or ["(暂无数据)"])))
+            self.debug_overlay.place(relx=1.0, rely=0.0, x=-24, y=8, anchor="ne")
+            self.debug_overlay.lift()
+        else:
+            self.debug_overlay.place_forget()
+        self.after(1000, self.update_debug_overlay)
+
+    def export_metrics(self, event=None):
+        """把耗时统计导出为 JSON 和 Prometheus 文本，保存在程序目录下。"""
+        try:
+            with open(os.path.join(BASE_DIR, "metrics.json"), "w", encoding="utf-8") as f:
+                f.write(self.engine.metrics.to_json())
+            with open(os.path.join(BASE_DIR, "metrics.prom"), "w", encoding="utf-8") as f:
+                f.write(self.engine.metrics.to_prometheus())
+            self.add_chat_bubble("系统", "耗时统计已导出到 metrics.json 和 metrics.prom 喵~")
+        except OSError as e:
+            self.add_chat_bubble("系统", f"导出耗时统计失败: {e}")
+
+    def toggle_profiling(self, event=None):
+        if not self.profiler.running:
+            self.profiler.start()
+            self.add_chat_bubble("系统", "性能分析已开始，再按一次 F12 结束并保存报告喵~")
+            return
+        try:
+            paths = self.profiler.stop()
+            self.add_chat_bubble("系统", "性能分析报告已保存:\n" + "\n".join(paths))
+        except OSError as e:
+            self.add_chat_bubble("系统", f"保存性能分析报告失败: {e}")
 
-    def load_long_term_memory(self):
-        if os.path.exists(MEMORY_PATH):
-            with open(MEMORY_PATH, "r", encoding="utf-8") as f:
-                self.long_term_memory = f.read()
+    def run_in_ui(self, fn, *args):
+        """
+        在工作线程中调用：把 fn 交给主线程执行。窗口正在关闭时直接丢弃，
+        否则工作线程会等待正在等它结束的主线程，两边互相卡住。
+        """
+        if self.closing:
+            return
+        try:
+            self.after(0, fn, *args)
+        except RuntimeError:
+            # 主窗口已经关闭
+            pass
+
+    def on_close(self):
+        self.closing = True
+        if self.watchdog:
+            self.watchdog.stop()
+        if self.profiler.running:
+            try:
+                self.profiler.stop()
+            except OSError as e:
+                print(f"保存性能分析报告失败: {e}")
+        self.player.stop()
+        # 只等正在运行的任务一小会儿，不让关闭窗口卡在回复轮次或记忆压缩上
+        self.engine.close(timeout=2)
+        self.thumbnails.shutdown()
+        self.destroy()
 
     def save_config_to_file(self):
         try:
@@ -509,10 +966,39 @@ class ChatApp(ctk.CTk):
                 f.write(f'API_KEY = "{self.api_key}"\n')
                 f.write(f'USER_NICKNAME = "{self.user_nickname}"\n')
                 f.write(f'API_BASE_URL = "{self.base_url}"\n')
+                f.write(f'API_FALLBACK_URLS = {self.fallback_urls!r}\n')
+                f.write(f'API_HEDGE_DELAY = {self.hedge_delay}\n')
                 f.write(f'LLM_MODEL = "{self.llm_model}"\n')
                 f.write(f'TTS_MODEL = "{self.tts_model}"\n')
                 f.write(f'TTS_SPEED = {self.tts_speed}\n')
                 f.write(f'MEMORY_TRIGGER_THRESHOLD = {self.memory_threshold}\n')
+                f.write(f'SUMMARY_MODEL = "{self.summary_model}"\n')
+                f.write(f'SUMMARY_JSON = {self.summary_json}\n')
+                f.write(f'SUMMARY_CONCURRENCY = {self.summary_concurrency}\n')
+                f.write(f'LLM_STREAM = {self.llm_stream}\n')
+                f.write(f'HTTP_POOL_SIZE = {self.http_pool_size}\n')
+                f.write(f'HTTP_CONNECT_TIMEOUT = {self.http_connect_timeout}\n')
+                f.write(f'HTTP_READ_TIMEOUT = {self.http_read_timeout}\n')
+                f.write(f'HTTP_MAX_RETRIES = {self.http_max_retries}\n')
+                f.write(f'TTS_VOICE = "{self.tts_voice}"\n')
+                f.write(f'TTS_CACHE_MAX_MB = {self.tts_cache_max_mb}\n')
+                f.write(f'TTS_CONCURRENCY = {self.tts_concurrency}\n')
+                f.write(f'TTS_SEGMENT_MAX_CHARS = {self.tts_segment_max_chars}\n')
+                f.write(f'IMAGE_MAX_EDGE = {self.image_max_edge}\n')
+                f.write(f'IMAGE_FORMAT = "{self.image_format}"\n')
+                f.write(f'IMAGE_QUALITY = {self.image_quality}\n')
+                f.write(f'MEMORY_TOP_K = {self.memory_top_k}\n')
+                f.write(f'MEMORY_TOKEN_BUDGET = {self.memory_token_budget}\n')
+                f.write(f'MEMORY_RECONCILE_WITH_LLM = {self.memory_reconcile_with_llm}\n')
+                f.write(f'BACKGROUND_IDLE_SECONDS = {self.background_idle_seconds}\n')
+                f.write(f'JOURNAL_RESTORE_COUNT = {self.journal_restore_count}\n')
+                f.write(f'JOURNAL_PAGE_SIZE = {self.journal_page_size}\n')
+                f.write(f'CONTEXT_TOKEN_BUDGET = {self.context_token_budget}\n')
+                f.write(f'STABLE_PROMPT_PREFIX = {self.stable_prompt_prefix}\n')
+                f.write(f'PROMPT_WINDOW_STEP = {self.prompt_window_step}\n')
+                f.write(f'DEBUG_OVERLAY = {self.debug_overlay_enabled}\n')
+                f.write(f'STALL_THRESHOLD_MS = {self.stall_threshold_ms}\n')
+                f.write(f'PROFILE_CAPTURE = {self.profile_capture}\n')
                 f.write(f'AI_PERSONA = """{self.ai_persona}"""\n')
             
             # 保存后，直接调用 load_config 即可，它会处理好重新加载和应用
@@ -530,12 +1016,12 @@ class ChatApp(ctk.CTk):
     def paste_from_clipboard(self, event=None):
         """从剪贴板粘贴图片"""
         try:
+            from PIL import Image, ImageGrab
             # 尝试从剪贴板获取图片
             clipboard_image = ImageGrab.grabclipboard()
             
             if clipboard_image is not None and isinstance(clipboard_image, Image.Image):
                 # 生成临时文件路径
-                import time
                 temp_filename = f"clipboard_{int(time.time() * 1000)}.png"
                 temp_path = os.path.join(self.temp_image_dir, temp_filename)
                 
@@ -584,11 +1070,6 @@ class ChatApp(ctk.CTk):
             # 清除之前的预览
             self.clear_image_preview()
             
-            # 加载并缩放图片
-            img = Image.open(image_path)
-            img.thumbnail((120, 120))  # 限制预览大小
-            ctk_image = ctk.CTkImage(light_image=img, dark_image=img, size=img.size)
-            
             # 预览容器
             preview_container = ctk.CTkFrame(
                 self.image_preview_frame,
@@ -597,14 +1078,16 @@ class ChatApp(ctk.CTk):
             )
             preview_container.pack(side="left", padx=10, pady=8)
             
-            # 创建预览框架内容
+            # 创建预览框架内容，缩略图在后台解码，先显示占位
             self.image_preview_label = ctk.CTkLabel(
                 preview_container, 
-                image=ctk_image, 
-                text=""
+                text="🖼️",
+                width=120,
+                height=120
             )
-            self.image_preview_label.image = ctk_image  # 保持引用
             self.image_preview_label.pack(padx=8, pady=8)
+            label = self.image_preview_label
+            self.thumbnails.request(image_path, (120, 120), lambda ctk_image: self.set_preview_image(label, ctk_image))
             
             # 取消按钮
             self.cancel_image_button = ctk.CTkButton(
@@ -637,6 +1120,16 @@ class ChatApp(ctk.CTk):
             self.add_chat_bubble("系统", f"无法加载图片预览: {e}")
             self.pending_image_path = None
     
+    def set_preview_image(self, label, ctk_image):
+        """预览缩略图解码完成后替换占位；预览已被取消或替换时忽略。"""
+        if not label.winfo_exists():
+            return
+        if ctk_image is None:
+            label.configure(text="🖼️ 无法预览")
+            return
+        label.configure(image=ctk_image, text="", width=0, height=0)
+        label.image = ctk_image  # 保持引用
+
     def clear_image_preview(self):
         """清除图片预览"""
         self.pending_image_path = None
@@ -647,9 +1140,10 @@ class ChatApp(ctk.CTk):
     def send_message(self, event=None):
         prompt = self.entry_box.get()
         # 允许只发送图片（无文字）或只发送文字
-        if (not prompt and not self.pending_image_path) or self.is_speaking:
+        if not prompt and not self.pending_image_path:
             return
-        pygame.mixer.music.stop()
+        # 新的发送会打断上一轮尚未完成的回复和语音
+        self.cancel_current_turn()
         
         # 获取当前图片路径
         image_path = self.pending_image_path
@@ -661,111 +1155,67 @@ class ChatApp(ctk.CTk):
         # 清除预览
         self.clear_image_preview()
         
-        thread = threading.Thread(target=self.get_ai_response, args=(prompt, image_path))
-        thread.start()
-
-    def get_ai_response(self, prompt, image_path=None):
-        self.thinking_bubble = None
-        try:
-            self.is_speaking = True
-            self.after(0, self.send_button.configure, {"state": "disabled"})
-
-            # 存储用户消息（纯文本形式，图片不存入历史）
-            user_content = prompt if prompt else "[用户发送了一张图片]"
-            self.conversation_history.append({"role": "user", "content": user_content})
-            
-            # 分别构建人设和长期记忆的系统指令
-            # 动态构建系统指令，告知 AI 当前用户的昵称
-            persona_prompt = self.ai_persona + f'\n\n--- 对话者信息 ---\n当前用户的昵称是"{self.user_nickname}"。请在对话中优先使用这个昵称来称呼用户，而不是"铲屎官"。'
-            
-            request_history = [
-                {"role": "system", "content": persona_prompt},
-                {"role": "system", "content": f"--- 关于用户的长期记忆 (请在对话中参考) ---\n{self.long_term_memory}"}
-            ] + self.conversation_history[-self.memory_threshold:]
-
-            self.thinking_bubble = self.add_chat_bubble("Miko", "正在思考喵...")
-            
-            ai_response = api_client.get_llm_response(request_history, self.api_key, self.base_url, self.llm_model, image_path)
-            audio_data = api_client.get_tts_audio(ai_response, self.api_key, self.base_url, self.tts_model, self.tts_speed)
-            
-            self.conversation_history.append({"role": "assistant", "content": ai_response})
-            self.after(0, self.thinking_bubble.update_with_final_data, ai_response, audio_data, self.play_audio)
-            self.thinking_bubble = None
-
-            # 主动播放第一次的音频
-            if audio_data:
-                self.play_audio(audio_data)
+        thinking_bubble = self.add_chat_bubble("Miko", "正在思考喵...")
+        thinking_bubble.is_placeholder = True
+        future = self.engine.send(
+            self.session, prompt, image_path,
+            on_delta=lambda delta: self.run_in_ui(self.append_to_bubble, thinking_bubble, delta),
+            on_audio=self.player.play,
+            stream_audio=True
+        )
+        cancel_token = future.cancel_token
+        future.add_done_callback(lambda f: self.run_in_ui(self.on_turn_finished, f, thinking_bubble, cancel_token))
 
-            # 检查是否需要触发记忆总结
-            if len(self.conversation_history) >= self.memory_threshold and not self.is_summarizing:
-                # 创建当前历史的副本用于总结，避免后续对话影响
-                history_for_summary = list(self.conversation_history)
-                summary_thread = threading.Thread(target=self.summarize_memory, args=(history_for_summary,))
-                summary_thread.start()
+    def cancel_current_turn(self):
+        """中止正在进行的 LLM/TTS 请求并停止播放，未完成的回复会被丢弃。"""
+        self.engine.cancel(self.session)
+        self.player.stop()
 
-        except Exception as e:
-            error_message = f"发生错误: {e}"
-            if self.thinking_bubble: self.after(0, self.thinking_bubble.destroy)
-            self.add_chat_bubble("系统", error_message)
-            if self.conversation_history and self.conversation_history[-1]["role"] == "user": self.conversation_history.pop()
-        finally:
-            if self.is_speaking:
-                self.is_speaking = False
-                self.after(0, self.send_button.configure, {"state": "normal"})
-
-    def summarize_memory(self, history_to_summarize: list):
-        """
-        在后台线程中对指定的对话历史进行总结，并安全地更新UI和数据。
-        :param history_to_summarize: 需要被总结的对话历史列表的副本。
-        """
-        if self.is_summarizing: return
-        
+    def on_turn_finished(self, future, thinking_bubble, cancel_token):
+        """一轮回复结束后在主线程中更新气泡：成功时写入完整回复，失败或被打断时移除。"""
         try:
-            self.is_summarizing = True
-            self.after(0, self.add_chat_bubble, "系统", "Miko 正在整理记忆喵...")
-            
-            summary = api_client.get_memory_summary(history_to_summarize, self.api_key, self.base_url, self.llm_model)
-            
-            if summary:
-                # 将总结写入文件
-                self.long_term_memory += f"\n{summary.strip()}"
-                with open(MEMORY_PATH, "a", encoding="utf-8") as f:
-                    f.write(f"\n{summary.strip()}")
-                
-                # 安全地请求主线程修剪已被总结的短期记忆
-                self.after(0, self.trim_history, len(history_to_summarize))
-                self.after(0, self.add_chat_bubble, "系统", "记忆整理完毕，Miko 的小本本又变厚了喵~")
-            else:
-                # 即使没有总结出内容，也需要把这段历史从短期记忆中移除，防止反复总结同样的内容
-                self.after(0, self.trim_history, len(history_to_summarize))
-                self.after(0, self.add_chat_bubble, "系统", "（Miko 歪着头想了想，好像这次没什么特别需要记住的喵...）")
-
+            result = future.result()
         except Exception as e:
-            self.after(0, self.add_chat_bubble, "系统", f"呜... Miko 在整理记忆时遇到了一个错误: {e}")
-        finally:
-            self.is_summarizing = False # 确保在任何情况下都解锁
+            self.transcript.remove(thinking_bubble)
+            # 被打断的轮次安静地丢弃，其他错误显示给用户
+            if not isinstance(e, api_client.RequestCancelled) and not cancel_token.cancelled:
+                self.add_chat_bubble("系统", f"发生错误: {e}")
+            return
+        self.finish_bubble(thinking_bubble, result["text"], result["audio"])
 
-    def trim_history(self, count: int):
-        """安全地从短期对话历史的开头移除指定数量的条目。"""
-        if count > 0:
-            self.conversation_history = self.conversation_history[count:]
+    def add_chat_bubble(self, user, message, audio_data=None, image_path=None):
+        """
+        添加一条消息并返回它的 ChatMessage。
+        可以在后台线程中调用：消息会通过 after() 交给主线程加入聊天记录。
+        """
+        if user == self.user_nickname:
+            role = "user"
+        elif user == "系统":
+            role = "system"
+        else:
+            role = "assistant"
+        chat_message = ChatMessage(user, message, role, audio_data, image_path)
+        self.after(0, self.transcript.append, chat_message)
+        return chat_message
 
+    def append_to_bubble(self, chat_message, delta):
+        """在主线程中向消息追加流式文本，第一段增量会替换掉占位文字。"""
+        if chat_message.is_placeholder:
+            chat_message.text = ""
+            chat_message.is_placeholder = False
+        chat_message.text += delta
+        self.transcript.refresh(chat_message)
 
-    def add_chat_bubble(self, user, message, audio_data=None, image_path=None):
-        bubble = ChatBubble(self.chat_frame, user, message, self.user_nickname, audio_data, self.play_audio, image_path)
-        anchor = "e" if user == self.user_nickname else "w"
-        bubble.pack(fill="x", padx=10, pady=8, anchor=anchor)
-        self.after(100, self.chat_frame._parent_canvas.yview_moveto, 1.0)
-        return bubble
+    def finish_bubble(self, chat_message, text, audio_data):
+        """回复完成后写入最终文本和可重播的语音。"""
+        chat_message.text = text
+        chat_message.audio_data = audio_data
+        chat_message.is_placeholder = False
+        self.transcript.refresh(chat_message)
 
     def play_audio(self, audio_data: bytes):
-        if pygame.mixer.music.get_busy(): return
-        try:
-            audio_file = io.BytesIO(audio_data)
-            pygame.mixer.music.load(audio_file)
-            pygame.mixer.music.play()
-        except Exception as e:
-            print(f"播放音频时发生错误: {e}")
+        """重播一段语音；正在播放时排在后面，不会被丢弃。"""
+        self.player.play(audio_data)
 
 if __name__ == "__main__":
     ctk.set_appearance_mode("dark")
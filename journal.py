@@ -0,0 +1,172 @@
+# journal.py
+
+import json
+import os
+import queue
+import struct
+import threading
+import time
+
+_OFFSET = struct.Struct("<Q")  # 索引文件中每条记录的起始偏移量，8 字节小端
+
+
+class ConversationJournal:
+    """
+    只追加的对话日志 (JSONL)，配合一个记录每行起始偏移量的索引文件。
+    启动时只需读取索引的末尾就能定位最近 N 条消息，不必扫描整个日志。
+    写入在后台线程中批量进行，并定期 fsync，不会拖慢发送消息。
+    :param path: 日志文件路径，索引文件为 path + ".idx"
+    :param flush_interval: 批量写入的间隔（秒）
+    :param fsync_interval: 两次 fsync 之间的最短间隔（秒）
+    """
+    def __init__(self, path: str, flush_interval: float = 0.5, fsync_interval: float = 2.0):
+        self.path = path
+        self.index_path = path + ".idx"
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.read_lock = threading.Lock()
+        self.pending = queue.Queue()
+        self.closed = threading.Event()
+
+        self._check_index()
+        self.log_file = open(self.path, "ab")
+        self.index_file = open(self.index_path, "ab")
+        self.count = os.path.getsize(self.index_path) // _OFFSET.size
+        self.last_fsync = time.monotonic()
+        self.writer = threading.Thread(target=self._writer_loop, daemon=True)
+        self.writer.start()
+
+    # --- 索引维护 ---
+    def _check_index(self):
+        """索引缺失或与日志不一致（例如上次异常退出）时，扫描日志重建索引。"""
+        log_size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        if os.path.exists(self.index_path):
+            index_size = os.path.getsize(self.index_path)
+            if index_size % _OFFSET.size == 0:
+                if index_size == 0 and log_size == 0:
+                    return
+                if index_size > 0:
+                    with open(self.index_path, "rb") as f:
+                        f.seek(index_size - _OFFSET.size)
+                        last_offset = _OFFSET.unpack(f.read(_OFFSET.size))[0]
+                    if last_offset < log_size and self._line_end(last_offset) == log_size:
+                        return
+        self._rebuild_index(log_size)
+
+    def _line_end(self, offset: int) -> int:
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            line = f.readline()
+        return offset + len(line) if line.endswith(b"\n") else -1
+
+    def _rebuild_index(self, log_size: int):
+        offsets = []
+        valid_size = 0
+        if log_size:
+            with open(self.path, "rb") as f:
+                offset = 0
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break  # 丢弃异常退出时写了一半的最后一行
+                    offsets.append(offset)
+                    offset += len(line)
+                valid_size = offset
+            if valid_size != log_size:
+                with open(self.path, "r+b") as f:
+                    f.truncate(valid_size)
+        with open(self.index_path, "wb") as f:
+            for offset in offsets:
+                f.write(_OFFSET.pack(offset))
+
+    # --- 写入 ---
+    def append(self, record: dict):
+        """追加一条记录。只是放进队列，实际写盘由后台线程完成。"""
+        if "ts" not in record:
+            record = dict(record, ts=time.time())
+        self.pending.put(record)
+
+    def _writer_loop(self):
+        while not self.closed.is_set():
+            self.closed.wait(self.flush_interval)
+            self._flush()
+        self._flush(force_sync=True)
+
+    def _flush(self, force_sync: bool = False):
+        records = []
+        while True:
+            try:
+                records.append(self.pending.get_nowait())
+            except queue.Empty:
+                break
+        if records:
+            with self.read_lock:
+                offset = self.log_file.tell()
+                lines = []
+                offsets = []
+                for record in records:
+                    line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+                    offsets.append(offset)
+                    lines.append(line)
+                    offset += len(line)
+                self.log_file.write(b"".join(lines))
+                self.log_file.flush()
+                self.index_file.write(b"".join(_OFFSET.pack(o) for o in offsets))
+                self.index_file.flush()
+                self.count += len(records)
+        now = time.monotonic()
+        if force_sync or (records and now - self.last_fsync >= self.fsync_interval):
+            os.fsync(self.log_file.fileno())
+            os.fsync(self.index_file.fileno())
+            self.last_fsync = now
+
+    def close(self):
+        """写入剩余的记录并关闭文件。"""
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        self.writer.join()
+        self.log_file.close()
+        self.index_file.close()
+
+    # --- 读取 ---
+    def __len__(self) -> int:
+        return self.count
+
+    def read_range(self, start: int, end: int) -> list:
+        """读取第 start 到 end-1 条记录（按写入顺序）。"""
+        with self.read_lock:
+            start = max(start, 0)
+            end = min(end, self.count)
+            if start >= end:
+                return []
+            with open(self.index_path, "rb") as f:
+                f.seek(start * _OFFSET.size)
+                first_offset = _OFFSET.unpack(f.read(_OFFSET.size))[0]
+            records = []
+            with open(self.path, "rb") as f:
+                f.seek(first_offset)
+                for _ in range(end - start):
+                    line = f.readline()
+                    if not line:
+                        break
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        continue
+            return records
+
+    def index_after_id(self, message_id: int) -> int:
+        """二分查找第一条 id 大于 message_id 的记录的位置（记录的 id 按写入顺序递增），都不大于时返回记录总数。"""
+        low, high = 0, self.count
+        while low < high:
+            mid = (low + high) // 2
+            record = self.read_range(mid, mid + 1)
+            if record and record[0].get("id", 0) > message_id:
+                high = mid
+            else:
+                low = mid + 1
+        return low
+
+    def read_tail(self, n: int) -> list:
+        """读取最近的 n 条记录。"""
+        return self.read_range(self.count - n, self.count)
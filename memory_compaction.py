@@ -0,0 +1,147 @@
+# memory_compaction.py
+
+import random
+import re
+import zlib
+
+# 计算相似度前去掉标点和空白，只比较文字本身
+_PUNCTUATION = re.compile(r"[\s\W_]+", re.UNICODE)
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+
+def _normalize(text: str) -> str:
+    return _PUNCTUATION.sub("", text).lower()
+
+
+def shingles(text: str, size: int = 2) -> set:
+    """把文本切成长度为 size 的字符片段 (shingle) 集合。"""
+    text = _normalize(text)
+    if len(text) <= size:
+        return {text} if text else set()
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+def jaccard(a: set, b: set) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class MinHasher:
+    """用 num_perm 个独立哈希函数为 shingle 集合计算 MinHash 签名。"""
+    def __init__(self, num_perm: int = 64, seed: int = 1):
+        rng = random.Random(seed)
+        self.num_perm = num_perm
+        self.params = [(rng.randrange(1, _MERSENNE_PRIME), rng.randrange(0, _MERSENNE_PRIME)) for _ in range(num_perm)]
+
+    def signature(self, shingle_set: set) -> tuple:
+        hashes = [zlib.crc32(s.encode("utf-8")) for s in shingle_set] or [0]
+        return tuple(
+            min(((a * h + b) % _MERSENNE_PRIME) & _MAX_HASH for h in hashes)
+            for a, b in self.params
+        )
+
+
+def find_duplicate_groups(facts: list, threshold: float = 0.6, bands: int = 16, num_perm: int = 64) -> list:
+    """
+    找出近似重复的事实分组。
+    先用 MinHash + LSH 分桶找出候选对，再用精确的 Jaccard 相似度确认。
+    每组以其中最新的一条为代表，组内每一条都与代表直接相似（不做传递闭包，A~B、B~C 不会把 A 和 C 放进同一组）。
+    :param facts: (id, 文本, 创建时间) 列表
+    :return: 每组包含两条及以上事实的分组列表，组内按时间从旧到新排列，最后一条是代表
+    """
+    rows = num_perm // bands
+    hasher = MinHasher(num_perm)
+    shingle_sets = [shingles(text) for _, text, _ in facts]
+    signatures = [hasher.signature(s) for s in shingle_sets]
+
+    similar = [set() for _ in facts]
+    checked = set()
+    for band in range(bands):
+        buckets = {}
+        for i, signature in enumerate(signatures):
+            key = signature[band * rows:(band + 1) * rows]
+            buckets.setdefault(key, []).append(i)
+        for members in buckets.values():
+            for x in range(len(members)):
+                for y in range(x + 1, len(members)):
+                    i, j = members[x], members[y]
+                    if (i, j) in checked:
+                        continue
+                    checked.add((i, j))
+                    if jaccard(shingle_sets[i], shingle_sets[j]) >= threshold:
+                        similar[i].add(j)
+                        similar[j].add(i)
+
+    # 从新到旧依次选代表，代表只收走与它直接相似、尚未分组的事实
+    order = sorted(range(len(facts)), key=lambda i: (facts[i][2], facts[i][0]), reverse=True)
+    assigned = set()
+    groups = []
+    for i in order:
+        if i in assigned or not similar[i]:
+            continue
+        members = [j for j in similar[i] if j not in assigned]
+        if not members:
+            continue
+        assigned.add(i)
+        assigned.update(members)
+        group = [facts[j] for j in members] + [facts[i]]
+        groups.append(sorted(group, key=lambda fact: (fact[2], fact[0])))
+    return groups
+
+
+def is_duplicate(a: str, b: str, threshold: float = 0.9, min_chars: int = 8) -> bool:
+    """
+    两条事实是否几乎相同，可以直接删掉旧的一条：去掉标点后完全相同，
+    或者两条都不短于 min_chars 个字且 Jaccard 相似度不低于 threshold。
+    短句只差一两个字往往意思完全不同（“用户喜欢猫”与“用户喜欢狗”），不能按相似度删除。
+    """
+    norm_a, norm_b = _normalize(a), _normalize(b)
+    if norm_a == norm_b:
+        return True
+    if min(len(norm_a), len(norm_b)) < min_chars:
+        return False
+    return jaccard(shingles(a), shingles(b)) >= threshold
+
+
+def compact_memory(store, reconcile=None, threshold: float = 0.6, duplicate_threshold: float = 0.9,
+                   min_chars: int = 8) -> dict:
+    """
+    压缩长期记忆：与较新的事实几乎相同的旧事实直接删除（见 is_duplicate）。
+    只是相似、可能含义不同的事实：提供了 reconcile 时把它们和代表（从旧到新）交给它合并成一条，
+    返回空字符串时保持不变；没有 reconcile 时保持不变。
+    所有修改在一个事务中写回记忆库。
+    :return: 统计信息，包括分组数、删除的条数、改写的条数和保留下来的相似事实数
+    """
+    facts = store.all_facts()
+    groups = find_duplicate_groups(facts, threshold)
+    delete_ids = []
+    updates = {}
+    kept_similar = 0
+    for group in groups:
+        newest_id, newest_text, _ = group[-1]
+        similar = []
+        for fact_id, text, _ in group[:-1]:
+            if is_duplicate(text, newest_text, duplicate_threshold, min_chars):
+                delete_ids.append(fact_id)
+            else:
+                similar.append((fact_id, text))
+        if not similar:
+            continue
+        merged = ""
+        if reconcile is not None:
+            try:
+                merged = reconcile([text for _, text in similar] + [newest_text]).strip()
+            except Exception as e:
+                print(f"合并冲突记忆时发生错误: {e}")
+        if merged:
+            delete_ids.extend(fact_id for fact_id, _ in similar)
+            if merged != newest_text:
+                updates[newest_id] = merged
+        else:
+            kept_similar += len(similar)
+    if delete_ids or updates:
+        store.apply_compaction(delete_ids, updates)
+    return {"facts": len(facts), "groups": len(groups), "removed": len(delete_ids), "rewritten": len(updates),
+            "kept_similar": kept_similar}
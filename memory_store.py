@@ -0,0 +1,172 @@
+# memory_store.py
+
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from context_builder import estimate_tokens
+
+# 中日韩文字没有空格分词，这里把连续的 CJK 字符切成二元组 (bigram)，英文和数字按单词切分
+_CJK_RUN = re.compile(r"[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff]+")
+_WORD = re.compile(r"[A-Za-z0-9_]+")
+
+
+def tokenize_for_index(text: str) -> list:
+    """把文本切分为索引用的词项：CJK 二元组 + 小写英文单词。"""
+    terms = []
+    for run in _CJK_RUN.findall(text):
+        if len(run) == 1:
+            terms.append(run)
+        else:
+            terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+    terms.extend(word.lower() for word in _WORD.findall(text))
+    return terms
+
+
+class MemoryStore:
+    """
+    基于 SQLite FTS5 的长期记忆库。
+    每条事实单独存储，检索时用 BM25 排序，只把与当前对话相关的几条放进提示词。
+    """
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self._create_schema()
+
+    def _create_schema(self):
+        with self.lock, self.conn:
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS facts (
+                    id INTEGER PRIMARY KEY,
+                    text TEXT NOT NULL,
+                    terms TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                );
+                CREATE VIRTUAL TABLE IF NOT EXISTS facts_fts USING fts5(
+                    terms, content='facts', content_rowid='id'
+                );
+                CREATE TRIGGER IF NOT EXISTS facts_ai AFTER INSERT ON facts BEGIN
+                    INSERT INTO facts_fts(rowid, terms) VALUES (new.id, new.terms);
+                END;
+                CREATE TRIGGER IF NOT EXISTS facts_ad AFTER DELETE ON facts BEGIN
+                    INSERT INTO facts_fts(facts_fts, rowid, terms) VALUES ('delete', old.id, old.terms);
+                END;
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                );
+            """)
+
+    def migrate_from_text(self, memory_path: str) -> int:
+        """
+        一次性把旧的 memory.txt 导入数据库，之后不会再次导入。
+        返回导入的事实条数。
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = 'migrated_memory_txt'").fetchone()
+        if row is not None:
+            return 0
+        imported = 0
+        if os.path.exists(memory_path):
+            with open(memory_path, "r", encoding="utf-8") as f:
+                imported = self.add_facts(f.read().splitlines())
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated_memory_txt', ?)", (str(time.time()),))
+        return imported
+
+    def get_meta(self, key: str, default: str | None = None) -> str | None:
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else default
+
+    def set_meta(self, key: str, value: str):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def add_facts(self, lines: list) -> int:
+        """添加若干条事实（每行一条），忽略空行和完全相同的重复事实。返回新增条数。"""
+        added = 0
+        now = time.time()
+        with self.lock, self.conn:
+            for line in lines:
+                text = line.strip()
+                if not text:
+                    continue
+                exists = self.conn.execute("SELECT 1 FROM facts WHERE text = ?", (text,)).fetchone()
+                if exists:
+                    continue
+                self.conn.execute(
+                    "INSERT INTO facts (text, terms, created_at) VALUES (?, ?, ?)",
+                    (text, " ".join(tokenize_for_index(text)), now)
+                )
+                added += 1
+        return added
+
+    def count(self) -> int:
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM facts").fetchone()[0]
+
+    def all_facts(self) -> list:
+        """按时间顺序返回 (id, 文本, 创建时间) 列表。"""
+        with self.lock:
+            return self.conn.execute("SELECT id, text, created_at FROM facts ORDER BY created_at, id").fetchall()
+
+    def apply_compaction(self, delete_ids: list, updates: dict) -> None:
+        """
+        在同一个事务中删除被取代的事实并改写保留下来的事实，保证记忆库要么全部更新、要么保持原样。
+        :param delete_ids: 需要删除的事实 id
+        :param updates: 事实 id -> 新文本
+        """
+        with self.lock, self.conn:
+            for fact_id in delete_ids:
+                self.conn.execute("DELETE FROM facts WHERE id = ?", (fact_id,))
+            for fact_id, text in updates.items():
+                row = self.conn.execute("SELECT terms FROM facts WHERE id = ?", (fact_id,)).fetchone()
+                if row is None:
+                    continue
+                # 外部内容表的 FTS 索引需要先删除旧词项再写入新词项
+                self.conn.execute("INSERT INTO facts_fts(facts_fts, rowid, terms) VALUES ('delete', ?, ?)", (fact_id, row[0]))
+                terms = " ".join(tokenize_for_index(text))
+                self.conn.execute("UPDATE facts SET text = ?, terms = ? WHERE id = ?", (text, terms, fact_id))
+                self.conn.execute("INSERT INTO facts_fts(rowid, terms) VALUES (?, ?)", (fact_id, terms))
+
+    def search(self, query: str, limit: int = 8, token_budget: int = 500) -> list:
+        """
+        返回与 query 最相关的事实文本，按相关度排序，总长度不超过 token_budget。
+        相关事实不足 limit 条时，用最新的事实补足。
+        """
+        terms = sorted(set(tokenize_for_index(query)))
+        rows = []
+        with self.lock:
+            if terms:
+                match = " OR ".join('"' + term.replace('"', '""') + '"' for term in terms)
+                rows = self.conn.execute(
+                    "SELECT facts.id, facts.text FROM facts_fts JOIN facts ON facts.id = facts_fts.rowid "
+                    "WHERE facts_fts MATCH ? ORDER BY bm25(facts_fts) LIMIT ?",
+                    (match, limit)
+                ).fetchall()
+            if len(rows) < limit:
+                seen = {row[0] for row in rows}
+                recent = self.conn.execute(
+                    "SELECT id, text FROM facts ORDER BY created_at DESC, id DESC LIMIT ?",
+                    (limit + len(seen),)
+                ).fetchall()
+                rows += [row for row in recent if row[0] not in seen][:limit - len(rows)]
+
+        facts = []
+        used_tokens = 0
+        for _, text in rows:
+            cost = estimate_tokens(text)
+            if used_tokens + cost > token_budget:
+                continue
+            facts.append(text)
+            used_tokens += cost
+        return facts
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,181 @@
+# metrics.py
+
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# 一轮对话中记录的各个阶段
+STAGES = (
+    "context",          # 检索记忆并按预算组装上下文
+    "image_encode",     # 图片缩放、重新编码为 data URL
+    "llm_first_token",  # 发出请求到收到第一段回复
+    "llm_total",        # 整个 LLM 请求
+    "tts",              # 单句语音合成（每句一个样本）
+    "first_audio",      # 本轮开始到收到第一个语音数据块（边下载边播放，此时就可以开始播放）
+    "playback_start",   # 缓冲、解码到开始播放一段语音
+    "summarization",    # 一次增量记忆总结
+    "turn",             # 整轮耗时
+    "ui_stall",         # Tk 主循环卡顿的持续时间（仅桌面端）
+)
+
+
+def percentile(ordered: list, p: float) -> float:
+    """ordered 必须已经排好序。"""
+    if not ordered:
+        return 0.0
+    return ordered[min(int(p * len(ordered)), len(ordered) - 1)]
+
+
+class TurnTrace:
+    """一轮对话的计时记录，由 LatencyRecorder.start_turn() 创建，结束时调用 finish()。"""
+    def __init__(self, recorder, session_id: str):
+        self.recorder = recorder
+        self.session_id = session_id
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.info = {}  # 本轮的附加信息（提示词前缀哈希、token 用量等），随明细一起保存
+        self.finished = False
+        self.lock = threading.Lock()  # 多句语音并行合成时会同时记录
+
+    @contextmanager
+    def span(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def mark(self, stage: str):
+        """记录从本轮开始到现在经过的时间，同一阶段只记录第一次（例如首字、首段语音）。"""
+        with self.lock:
+            if stage in self.stages:
+                return
+            seconds = time.perf_counter() - self.start
+            self.stages[stage] = seconds
+        self.recorder.observe(stage, seconds)
+
+    def record(self, stage: str, seconds: float):
+        # 同一阶段出现多次（例如逐句合成）时，本轮记录的是总和，统计样本则逐个保留
+        with self.lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+        self.recorder.observe(stage, seconds)
+
+    def annotate(self, **info):
+        with self.lock:
+            self.info.update(info)
+
+    def stage_totals(self) -> dict:
+        with self.lock:
+            return dict(self.stages)
+
+    def finish(self, status: str = "ok"):
+        if self.finished:
+            return
+        self.finished = True
+        self.record("turn", time.perf_counter() - self.start)
+        turn = {
+            "session": self.session_id,
+            "started_at": self.started_at,
+            "status": status,
+            "stages": self.stage_totals(),
+        }
+        with self.lock:
+            turn.update(self.info)
+        self.recorder.add_turn(turn)
+
+
+class LatencyRecorder:
+    """
+    保存最近若干轮对话的分阶段耗时（环形缓冲区），并按阶段统计 p50/p95，
+    可以导出为 JSON 或 Prometheus 文本格式。
+    :param max_turns: 保留最近多少轮的明细
+    :param max_samples: 每个阶段保留最近多少个样本用于计算分位数
+    """
+    def __init__(self, max_turns: int = 100, max_samples: int = 500):
+        self.lock = threading.Lock()
+        self.turns = deque(maxlen=max_turns)
+        self.samples = {}
+        self.totals = {}  # 阶段 -> [样本总数, 耗时总和]，供 Prometheus 的 _count/_sum 使用
+        self.tokens = {"prompt": 0, "cached": 0, "completion": 0}  # LLM 返回的 token 用量累计
+        self.max_samples = max_samples
+
+    def start_turn(self, session_id: str) -> TurnTrace:
+        return TurnTrace(self, session_id)
+
+    def observe(self, stage: str, seconds: float):
+        with self.lock:
+            samples = self.samples.get(stage)
+            if samples is None:
+                samples = self.samples[stage] = deque(maxlen=self.max_samples)
+                self.totals[stage] = [0, 0.0]
+            samples.append(seconds)
+            self.totals[stage][0] += 1
+            self.totals[stage][1] += seconds
+
+    def observe_usage(self, usage: dict):
+        """累计一次 LLM 请求的 token 用量（api_client.parse_usage 的结果），服务没有返回的字段跳过。"""
+        with self.lock:
+            for kind in self.tokens:
+                value = usage.get(f"{kind}_tokens")
+                if value:
+                    self.tokens[kind] += value
+
+    def token_stats(self) -> dict:
+        """token 用量累计，以及提示词中命中服务端缓存的比例。"""
+        with self.lock:
+            tokens = dict(self.tokens)
+        tokens["cache_hit_ratio"] = tokens["cached"] / tokens["prompt"] if tokens["prompt"] else 0.0
+        return tokens
+
+    def add_turn(self, turn: dict):
+        with self.lock:
+            self.turns.append(turn)
+
+    def stage_stats(self) -> dict:
+        """每个阶段最近样本的 p50/p95/平均值（秒）。"""
+        with self.lock:
+            samples = {stage: sorted(values) for stage, values in self.samples.items()}
+            totals = {stage: list(total) for stage, total in self.totals.items()}
+        stats = {}
+        for stage in sorted(samples, key=lambda s: STAGES.index(s) if s in STAGES else len(STAGES)):
+            ordered = samples[stage]
+            stats[stage] = {
+                "p50": percentile(ordered, 0.5),
+                "p95": percentile(ordered, 0.95),
+                "mean": sum(ordered) / len(ordered),
+                "samples": len(ordered),
+                "count": totals[stage][0],
+                "sum": totals[stage][1],
+            }
+        return stats
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            turns = list(self.turns)
+        return {"stages": self.stage_stats(), "tokens": self.token_stats(), "turns": turns}
+
+    def to_json(self) -> str:
+        return json.dumps(self.snapshot(), ensure_ascii=False, indent=2)
+
+    def to_prometheus(self) -> str:
+        """导出为 Prometheus 文本格式（summary 类型，分位数基于最近的样本）。"""
+        lines = [
+            "# HELP echosoul_stage_latency_seconds Latency of each stage of a conversation turn.",
+            "# TYPE echosoul_stage_latency_seconds summary",
+        ]
+        for stage, stats in self.stage_stats().items():
+            lines.append(f'echosoul_stage_latency_seconds{{stage="{stage}",quantile="0.5"}} {stats["p50"]:.6f}')
+            lines.append(f'echosoul_stage_latency_seconds{{stage="{stage}",quantile="0.95"}} {stats["p95"]:.6f}')
+            lines.append(f'echosoul_stage_latency_seconds_sum{{stage="{stage}"}} {stats["sum"]:.6f}')
+            lines.append(f'echosoul_stage_latency_seconds_count{{stage="{stage}"}} {stats["count"]}')
+        lines += [
+            "# HELP echosoul_llm_tokens_total Tokens reported by the LLM API (cached = prompt tokens served from the provider's prompt cache).",
+            "# TYPE echosoul_llm_tokens_total counter",
+        ]
+        for kind, value in self.token_stats().items():
+            if kind != "cache_hit_ratio":
+                lines.append(f'echosoul_llm_tokens_total{{kind="{kind}"}} {value}')
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,304 @@
+# scheduler.py
+
+import itertools
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+# 任务的优先级，数字越小越先运行
+INTERACTIVE = 0  # 对话轮次，用户正在等待
+AUDIO = 1        # 播放相关的准备工作（混音器初始化等）
+BACKGROUND = 2   # 记忆总结、记忆压缩、缓存清理，只在用户空闲时运行
+
+_local = threading.local()
+
+
+def current_job():
+    """在任务函数中调用，返回正在运行的 Job；不在调度器的线程中时返回 None。"""
+    return getattr(_local, "job", None)
+
+
+class Job:
+    """
+    调度器中的一个任务。运行中的后台任务被新的对话轮次抢占时会收到取消通知，
+    任务函数可以用 on_cancel() 登记回调（例如取消正在进行的 API 请求），以异常结束的被抢占任务会重新排队；
+    没有理会取消、正常返回的任务视为已经完成。
+    """
+    def __init__(self, fn, args: tuple, kwargs: dict, priority: int, key, preemptible: bool, seq: int):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.key = key
+        self.preemptible = preemptible
+        self.seq = seq
+        self.future = Future()
+        self.attempts = 0  # 已经开始运行的次数，被抢占后重新运行时加一
+        self.started = False
+        self.preempted = False
+        self.dropped = False  # 被 cancel() 取消，结束后不再重新排队
+        self.lock = threading.Lock()
+        self.cancel_event = threading.Event()
+        self.callbacks = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+    def on_cancel(self, callback):
+        """登记取消时调用的回调，已经被取消时立即调用。"""
+        with self.lock:
+            if not self.cancel_event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback()
+
+    def _cancel(self):
+        with self.lock:
+            self.cancel_event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"取消后台任务时发生错误: {e}")
+
+    def _reset(self):
+        with self.lock:
+            self.cancel_event.clear()
+            self.callbacks = []
+            self.preempted = False
+
+
+class JobScheduler:
+    """
+    按优先级运行任务的调度器：对话轮次 (INTERACTIVE) > 播放准备 (AUDIO) > 后台维护 (BACKGROUND)。
+    每个优先级有各自的并发上限，线程按需创建。后台任务只在用户空闲时开始：
+    没有进行中的对话轮次、所有忙碌检查（例如语音仍在播放）都为假、并且距离上次活动已经过了 idle_delay 秒。
+    新的一轮对话开始时，正在运行的可抢占后台任务会被取消并重新排队，等下次空闲时再运行。
+    :param limits: 优先级 -> 同时运行的任务数上限
+    :param idle_delay: 最后一次活动之后多少秒才算空闲
+    """
+    def __init__(self, limits: dict = None, idle_delay: float = 5.0, poll_interval: float = 0.5):
+        self.limits = {INTERACTIVE: 4, AUDIO: 1, BACKGROUND: 1}
+        self.limits.update(limits or {})
+        self.idle_delay = idle_delay
+        self.poll_interval = poll_interval  # 有后台任务在等待空闲时，重新检查空闲状态的间隔
+        self.condition = threading.Condition()
+        self.pending = []
+        self.running = {priority: set() for priority in self.limits}
+        self.keys = {}  # key -> 排队中或运行中的 Job，同一个 key 同时只有一个
+        self.busy_checks = []
+        self.active = 0  # 进行中的对话轮次
+        self.last_activity = time.monotonic()
+        self.seq = itertools.count()
+        self.threads = []
+        self.waiting = 0  # 空闲的工作线程数
+        self.closed = False
+        self.preemptions = 0
+
+    # --- 提交任务 ---
+    def submit(self, fn, *args, priority: int = BACKGROUND, key=None, preemptible: bool | None = None, **kwargs) -> Future:
+        """
+        提交一个任务，返回 concurrent.futures.Future。
+        :param key: 去重键，已有相同 key 的任务在排队或运行时直接返回它的 Future
+        :param preemptible: 对话开始时是否取消并重新排队，默认只有后台任务可抢占
+        """
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("调度器已关闭")
+            if key is not None and key in self.keys:
+                return self.keys[key].future
+            job = Job(fn, args, kwargs, priority, key,
+                      priority == BACKGROUND if preemptible is None else preemptible, next(self.seq))
+            self.pending.append(job)
+            if key is not None:
+                self.keys[key] = job
+            if self.waiting < len(self.pending) and len(self.threads) < sum(self.limits.values()):
+                thread = threading.Thread(target=self._worker, daemon=True, name=f"scheduler-{len(self.threads)}")
+                self.threads.append(thread)
+                thread.start()
+            self.condition.notify_all()
+        return job.future
+
+    # --- 用户活动与空闲检测 ---
+    @contextmanager
+    def interaction(self):
+        """包住一轮对话：开始时抢占后台任务，期间不会开始新的后台任务。"""
+        self.begin_interaction()
+        try:
+            yield
+        finally:
+            self.end_interaction()
+
+    def begin_interaction(self):
+        with self.condition:
+            self.active += 1
+            self.last_activity = time.monotonic()
+            preempted = [job for job in self.running[BACKGROUND] if job.preemptible and not job.preempted]
+            for job in preempted:
+                job.preempted = True
+            self.preemptions += len(preempted)
+        for job in preempted:
+            job._cancel()
+
+    def end_interaction(self):
+        with self.condition:
+            self.active -= 1
+            self.last_activity = time.monotonic()
+            self.condition.notify_all()
+
+    def touch(self):
+        """记录一次用户活动（例如正在输入），推迟后台任务的开始时间。"""
+        with self.condition:
+            self.last_activity = time.monotonic()
+
+    def add_busy_check(self, check):
+        """登记一个返回 bool 的函数，返回 True 时视为用户不空闲（例如语音正在播放）。"""
+        with self.condition:
+            self.busy_checks.append(check)
+
+    def is_idle(self) -> bool:
+        with self.condition:
+            return self._idle_locked()
+
+    def _idle_locked(self) -> bool:
+        if self.active > 0 or time.monotonic() - self.last_activity < self.idle_delay:
+            return False
+        for check in self.busy_checks:
+            try:
+                if check():
+                    return False
+            except Exception:
+                pass
+        return True
+
+    # --- 工作线程 ---
+    def _next_job(self):
+        """取出可以运行的优先级最高的任务，没有时返回 None。"""
+        idle = None
+        for job in sorted(self.pending, key=lambda j: (j.priority, j.seq)):
+            if job.future.cancelled():
+                self.pending.remove(job)
+                self._forget(job)
+                continue
+            if len(self.running[job.priority]) >= self.limits[job.priority]:
+                continue
+            if job.priority == BACKGROUND:
+                if idle is None:
+                    idle = self._idle_locked()
+                if not idle:
+                    continue
+            self.pending.remove(job)
+            return job
+        return None
+
+    def _forget(self, job: Job):
+        if job.key is not None and self.keys.get(job.key) is job:
+            del self.keys[job.key]
+
+    def _worker(self):
+        while True:
+            with self.condition:
+                while True:
+                    if self.closed:
+                        return
+                    job = self._next_job()
+                    if job is not None:
+                        break
+                    # 只有后台任务在等待时定期重新检查空闲状态，否则等待新任务
+                    timeout = self.poll_interval if self.pending else None
+                    self.waiting += 1
+                    self.condition.wait(timeout)
+                    self.waiting -= 1
+                if not job.started:
+                    if not job.future.set_running_or_notify_cancel():
+                        self._forget(job)
+                        continue
+                    job.started = True
+                job.attempts += 1
+                self.running[job.priority].add(job)
+            self._run(job)
+
+    def _run(self, job: Job):
+        _local.job = job
+        result, error = None, None
+        try:
+            result = job.fn(*job.args, **job.kwargs)
+        except BaseException as e:
+            error = e
+        finally:
+            _local.job = None
+        with self.condition:
+            self.running[job.priority].discard(job)
+            requeue = job.preempted and error is not None and not self.closed and not job.dropped
+            if requeue:
+                job._reset()
+                self.pending.append(job)
+            else:
+                self._forget(job)
+            self.condition.notify_all()
+        if requeue:
+            return
+        if error is not None:
+            job.future.set_exception(error)
+        else:
+            job.future.set_result(result)
+
+    def cancel(self, key) -> Future | None:
+        """
+        取消 key 对应的任务：排队中的直接丢弃，运行中的收到取消通知，结束后不再重新排队。
+        返回任务的 Future（调用方可以等它结束），没有这个任务时返回 None。
+        """
+        with self.condition:
+            job = self.keys.get(key)
+            if job is None:
+                return None
+            self._forget(job)
+            job.dropped = True
+            if job in self.pending:
+                self.pending.remove(job)
+                if job.started:
+                    job.future.set_result(None)
+                else:
+                    job.future.cancel()
+                    job.future.set_running_or_notify_cancel()  # 通知正在 wait() 的调用方
+                return job.future
+        job._cancel()
+        return job.future
+
+    def stats(self) -> dict:
+        with self.condition:
+            return {
+                "pending": len(self.pending),
+                "running": {priority: len(jobs) for priority, jobs in self.running.items()},
+                "idle": self._idle_locked(),
+                "preemptions": self.preemptions,
+            }
+
+    def shutdown(self, wait: bool = True, timeout: float | None = None) -> bool:
+        """
+        不再接受新任务，丢弃排队中的任务，并通知正在运行的任务取消（包括不可抢占的任务）。
+        wait 为 True 时等待正在运行的任务结束，最多等 timeout 秒；在界面线程中调用时应当设置 timeout，
+        因为任务可能正在等界面线程处理它的回调。返回是否所有工作线程都已结束。
+        """
+        with self.condition:
+            self.closed = True
+            pending, self.pending = self.pending, []
+            for job in pending:
+                self._forget(job)
+                if job.started:
+                    job.future.set_result(None)  # 被抢占后等待重新运行的任务
+                else:
+                    job.future.cancel()
+            self.condition.notify_all()
+            threads = [thread for thread in self.threads if thread is not threading.current_thread()]
+            running = [job for jobs in self.running.values() for job in jobs]
+        for job in running:
+            job._cancel()
+        if wait:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            for thread in threads:
+                thread.join(None if deadline is None else max(deadline - time.monotonic(), 0))
+        return not any(thread.is_alive() for thread in threads)
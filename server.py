@@ -0,0 +1,388 @@
+# server.py
+"""
+本地服务模式：把 EchoSoul 的人设、记忆和 TTS 流水线以 HTTP 接口提供给其他前端（平板、悬浮窗、VTube 等）。
+基于 asyncio 实现，只依赖标准库；空闲连接只占用一个协程，对话轮次在对话引擎的有界线程池中运行。
+
+接口：
+    GET    /health                    服务状态（包括各 API 地址的延迟和熔断状态）
+    GET    /metrics                   各阶段耗时统计（Prometheus 文本格式）
+    GET    /metrics.json              各阶段耗时统计和最近若干轮的明细（JSON）
+    POST   /sessions/<id>/chat        发送一条消息，以 SSE 流式返回 delta / audio / done / error 事件
+                                      请求体: {"message": "...", "image": "<base64 或 data URL，可选>", "speak": true}
+    POST   /sessions/<id>/cancel      打断该会话正在进行的回复
+    GET    /sessions/<id>/history     该会话的短期记忆
+    POST   /sessions/<id>/import      从聊天记录中分段并发提取长期记忆，写入该会话的记忆库
+                                      请求体: {"messages": [{"role": "user", "content": "..."}, ...], "window": 20}
+    DELETE /sessions/<id>             关闭会话
+
+默认不发送 CORS 响应头，浏览器中的网页不能跨域调用；需要时用 --cors-origin 列出允许的来源，
+此时必须同时设置 --token。
+
+用法:
+    python server.py --host 127.0.0.1 --port 8765
+    python server.py --token <令牌> --cors-origin http://localhost:5173
+"""
+
+import argparse
+import asyncio
+import base64
+import binascii
+import contextvars
+import importlib
+import json
+import os
+import re
+import sys
+import tempfile
+import uuid
+
+import api_client
+import engine
+import journal
+import memory_store
+
+if getattr(sys, 'frozen', False):
+    BASE_DIR = os.path.dirname(sys.executable)
+else:
+    BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+TTS_CACHE_DIR = os.path.join(BASE_DIR, "tts_cache")
+DEFAULT_DATA_DIR = os.path.join(BASE_DIR, "server_data")
+
+MAX_BODY_BYTES = 32 * 1024 * 1024  # 带图片的请求体上限
+IDLE_TIMEOUT = 300  # keep-alive 连接空闲多久后关闭（秒）
+_SESSION_ID = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+_ROUTE = re.compile(r"^/sessions/([^/]+)(/chat|/cancel|/history|/import)?$")
+_request_origin = contextvars.ContextVar("request_origin", default=None)  # 当前请求的 Origin 头，每个连接一个协程
+
+_REASONS = {200: "OK", 204: "No Content", 400: "Bad Request", 401: "Unauthorized", 403: "Forbidden",
+            404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def load_config():
+    """从程序目录导入 config.py，不存在时返回 None（全部使用默认值）。"""
+    if BASE_DIR not in sys.path:
+        sys.path.insert(0, BASE_DIR)
+    try:
+        return importlib.import_module("config")
+    except ModuleNotFoundError:
+        return None
+
+
+class ChatServer:
+    """
+    每个客户端使用自己的会话 id，会话的长期记忆和对话日志保存在 data_dir/<会话 id>/ 下。
+    :param token: 设置后所有请求都需要携带 "Authorization: Bearer <token>"
+    :param cors_origins: 允许跨域访问的来源（如 "http://localhost:5173"），为空时不发送 CORS 响应头；不为空时必须设置 token
+    :param data_dir: 会话数据目录，用来判断尚未载入的会话是否存在
+    """
+    def __init__(self, conversation_engine: engine.ConversationEngine, token: str = None, cors_origins=(), data_dir: str = None):
+        if cors_origins and not token:
+            raise ValueError("允许跨域访问时必须设置访问令牌")
+        self.engine = conversation_engine
+        self.token = token
+        self.cors_origins = set(cors_origins)
+        self.data_dir = data_dir
+        self.temp_image_dir = tempfile.mkdtemp(prefix="echosoul_server_")
+
+    # --- HTTP 基础 ---
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(self.read_request(reader), IDLE_TIMEOUT)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except HTTPError as e:
+                    # 请求头无效时无法确定请求体的边界，回复错误后关闭连接
+                    try:
+                        await self.send_json(writer, e.status, {"error": str(e)})
+                    except ConnectionError:
+                        pass
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+                _request_origin.set(headers.get("origin"))
+                keep_alive = headers.get("connection", "").lower() != "close"
+                try:
+                    keep_alive = await self.dispatch(method, path, headers, body, writer) and keep_alive
+                except HTTPError as e:
+                    await self.send_json(writer, e.status, {"error": str(e)})
+                except ConnectionError:
+                    break
+                except Exception as e:
+                    print(f"处理请求时发生错误: {e}")
+                    await self.send_json(writer, 500, {"error": str(e)})
+                if not keep_alive:
+                    break
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+    async def read_request(self, reader: asyncio.StreamReader):
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        try:
+            method, target, _ = request_line.decode("latin-1").split(" ", 2)
+        except ValueError:
+            raise ConnectionError("无效的请求行")
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get("content-length", "0") or 0)
+        except ValueError:
+            raise HTTPError(400, "Content-Length 无效")
+        if length < 0:
+            raise HTTPError(400, "Content-Length 无效")
+        if length > MAX_BODY_BYTES:
+            raise ConnectionError("请求体过大")
+        body = await reader.readexactly(length) if length else b""
+        return method.upper(), target.split("?", 1)[0], headers, body
+
+    def response_head(self, status: int, content_type: str, length: int = None, extra: list = ()) -> bytes:
+        lines = [
+            f"HTTP/1.1 {status} {_REASONS.get(status, '')}",
+            f"Content-Type: {content_type}",
+        ]
+        origin = _request_origin.get()
+        if origin in self.cors_origins:
+            lines.extend([
+                f"Access-Control-Allow-Origin: {origin}",
+                "Access-Control-Allow-Headers: Authorization, Content-Type",
+                "Access-Control-Allow-Methods: GET, POST, DELETE, OPTIONS",
+                "Vary: Origin",
+            ])
+        if length is not None:
+            lines.append(f"Content-Length: {length}")
+        lines.extend(extra)
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+    async def send_json(self, writer: asyncio.StreamWriter, status: int, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        writer.write(self.response_head(status, "application/json; charset=utf-8", len(body)) + body)
+        await writer.drain()
+
+    # --- 路由 ---
+    async def dispatch(self, method: str, path: str, headers: dict, body: bytes, writer) -> bool:
+        """处理一个请求，返回连接是否可以继续复用。"""
+        if method == "OPTIONS":
+            # 浏览器的预检请求不带访问令牌，只回应允许的来源；随后的实际请求仍然要检查令牌
+            if _request_origin.get() not in self.cors_origins:
+                raise HTTPError(403, "不允许跨域访问")
+            writer.write(self.response_head(204, "text/plain", 0))
+            await writer.drain()
+            return True
+        if self.token and headers.get("authorization") != f"Bearer {self.token}":
+            raise HTTPError(401, "缺少或错误的访问令牌")
+        if path == "/health":
+            router = api_client.get_router()
+            await self.send_json(writer, 200, {
+                "status": "ok",
+                "sessions": len(self.engine.sessions),
+                "endpoints": router.snapshot() if router else [],
+            })
+            return True
+        if path == "/metrics":
+            body = self.engine.metrics.to_prometheus().encode("utf-8")
+            writer.write(self.response_head(200, "text/plain; version=0.0.4; charset=utf-8", len(body)) + body)
+            await writer.drain()
+            return True
+        if path == "/metrics.json":
+            await self.send_json(writer, 200, self.engine.metrics.snapshot())
+            return True
+
+        match = _ROUTE.match(path)
+        if not match:
+            raise HTTPError(404, "接口不存在")
+        session_id, action = match.group(1), match.group(2)
+        if not _SESSION_ID.match(session_id):
+            raise HTTPError(400, "会话 id 只能包含字母、数字、下划线和连字符，最长 64 个字符")
+
+        if action is None:
+            if method != "DELETE":
+                raise HTTPError(405, "只支持 DELETE")
+            await asyncio.to_thread(self.engine.close_session, session_id)
+            await self.send_json(writer, 200, {"closed": session_id})
+            return True
+        if action == "/cancel" and method == "POST":
+            session = self.engine.sessions.get(session_id)
+            if session is not None:
+                self.engine.cancel(session)
+            await self.send_json(writer, 200, {"cancelled": session is not None})
+            return True
+        if action == "/history" and method == "GET":
+            # 只读取已有的会话，不为未知的 id 创建会话和数据目录
+            session = self.engine.sessions.get(session_id)
+            if session is None:
+                if not (self.data_dir and os.path.isdir(os.path.join(self.data_dir, session_id))):
+                    raise HTTPError(404, "会话不存在")
+                session = await asyncio.to_thread(self.engine.get_session, session_id)
+            await self.send_json(writer, 200, {"history": list(session.history), "summary": session.summarizer.rolling_summary})
+            return True
+        if action == "/import" and method == "POST":
+            try:
+                request = json.loads(body or b"{}")
+            except ValueError:
+                raise HTTPError(400, "请求体不是有效的 JSON")
+            if not isinstance(request, dict) or not isinstance(request.get("messages"), list):
+                raise HTTPError(400, "messages 必须是消息列表")
+            window = request.get("window")
+            if window is not None and (isinstance(window, bool) or not isinstance(window, int) or window < 1):
+                raise HTTPError(400, "window 必须是正整数")
+            session = await asyncio.to_thread(self.engine.get_session, session_id)
+            messages = [m for m in request["messages"] if isinstance(m, dict)]
+            result = await asyncio.to_thread(self.engine.import_transcript, session, messages, window)
+            await self.send_json(writer, 200, result)
+            return True
+        if action == "/chat" and method == "POST":
+            await self.chat(session_id, body, writer)
+            return False
+        raise HTTPError(405, "请求方法不正确")
+
+    # --- 对话 ---
+    def save_image(self, data: str) -> str:
+        """把 base64（或 data URL）图片写入临时文件，返回文件路径。"""
+        if data.startswith("data:"):
+            data = data.partition(",")[2]
+        try:
+            raw = base64.b64decode(data, validate=True)
+        except (binascii.Error, ValueError):
+            raise HTTPError(400, "image 不是有效的 base64 数据")
+        path = os.path.join(self.temp_image_dir, f"{uuid.uuid4().hex}.img")
+        with open(path, "wb") as f:
+            f.write(raw)
+        return path
+
+    async def chat(self, session_id: str, body: bytes, writer: asyncio.StreamWriter):
+        try:
+            request = json.loads(body or b"{}")
+        except ValueError:
+            raise HTTPError(400, "请求体不是有效的 JSON")
+        if not isinstance(request, dict):
+            raise HTTPError(400, "请求体必须是 JSON 对象")
+        prompt = str(request.get("message") or "")
+        image_path = self.save_image(request["image"]) if request.get("image") else None
+        if not prompt and not image_path:
+            raise HTTPError(400, "message 和 image 不能同时为空")
+
+        session = await asyncio.to_thread(self.engine.get_session, session_id)
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+
+        def emit(event, data):
+            loop.call_soon_threadsafe(events.put_nowait, (event, data))
+
+        audio_index = 0
+
+        def on_audio(audio):
+            nonlocal audio_index
+            emit("audio", {"index": audio_index, "format": "mp3", "data": base64.b64encode(audio).decode("ascii")})
+            audio_index += 1
+
+        future = self.engine.send(
+            session, prompt, image_path,
+            on_delta=lambda delta: emit("delta", {"text": delta}),
+            on_audio=on_audio,
+            speak=bool(request.get("speak", True)),
+            wait_playback=True
+        )
+        cancel_token = future.cancel_token  # 同一会话的下一个请求会替换 session.cancel_token
+        future.add_done_callback(lambda f: emit(None, None))
+        if image_path:
+            future.add_done_callback(lambda f: os.remove(image_path))
+
+        # SSE 响应没有 Content-Length，发送完 done/error 事件后关闭连接
+        writer.write(self.response_head(200, "text/event-stream; charset=utf-8",
+                                        extra=["Cache-Control: no-cache", "Connection: close"]))
+        finished = False
+        try:
+            await writer.drain()
+            while True:
+                event, data = await events.get()
+                if event is None:
+                    break
+                await self.send_event(writer, event, data)
+            try:
+                result = future.result()
+                await self.send_event(writer, "done", {"text": result["text"], "context": result["context"], "timings": result["timings"], "usage": result["usage"]})
+            except Exception as e:
+                await self.send_event(writer, "error", {
+                    "error": str(e),
+                    "cancelled": cancel_token.cancelled or isinstance(e, api_client.RequestCancelled)
+                })
+            finished = True
+        finally:
+            # 客户端中途断开时打断这一轮，不再继续调用 LLM/TTS
+            if not finished:
+                cancel_token.cancel()
+
+    async def send_event(self, writer: asyncio.StreamWriter, event: str, data: dict):
+        payload = json.dumps(data, ensure_ascii=False)
+        writer.write(f"event: {event}\ndata: {payload}\n\n".encode("utf-8"))
+        await writer.drain()
+
+
+def create_engine(data_dir: str, max_workers: int) -> engine.ConversationEngine:
+    config = load_config()
+    engine.configure_api_client(config, TTS_CACHE_DIR)
+
+    def session_dir(session_id):
+        path = os.path.join(data_dir, session_id)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    return engine.ConversationEngine(
+        engine.settings_from_config(config),
+        lambda session_id: memory_store.MemoryStore(os.path.join(session_dir(session_id), "memory.db")),
+        lambda session_id: journal.ConversationJournal(os.path.join(session_dir(session_id), "conversation.jsonl")),
+        max_workers=max_workers
+    )
+
+
+async def serve(host: str, port: int, chat_server: ChatServer):
+    server = await asyncio.start_server(chat_server.handle_connection, host, port)
+    print(f"EchoSoul 服务已启动: http://{host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="以本地 HTTP 服务的方式运行 EchoSoul")
+    parser.add_argument("--host", default="127.0.0.1", help="监听地址，默认只允许本机访问")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=8, help="同时进行的对话轮次上限")
+    parser.add_argument("--data-dir", default=DEFAULT_DATA_DIR, help="保存各会话记忆和对话日志的目录")
+    parser.add_argument("--token", default=None, help="设置后请求需要携带 Authorization: Bearer <token>")
+    parser.add_argument("--cors-origin", action="append", default=[], metavar="ORIGIN",
+                        help="允许跨域访问的来源，可以重复指定；需要同时设置 --token")
+    args = parser.parse_args()
+    if args.cors_origin and not args.token:
+        parser.error("--cors-origin 需要同时设置 --token")
+
+    conversation_engine = create_engine(args.data_dir, args.workers)
+    try:
+        asyncio.run(serve(args.host, args.port, ChatServer(conversation_engine, args.token, args.cors_origin, args.data_dir)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        conversation_engine.close()
+
+
+if __name__ == "__main__":
+    main()
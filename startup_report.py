@@ -0,0 +1,172 @@
+# startup_report.py
+"""
+启动耗时报告：用 `python -X importtime` 在新进程中多次导入指定模块，
+取最快的一次，列出累计耗时最多的导入，结果保存为 JSON，可以用 --baseline 与之前的结果对比。
+加上 --window 时还会多次启动 gui.py，测量从启动进程到主窗口显示（Map 事件）的耗时，需要图形界面环境。
+
+用法:
+    python startup_report.py                       # 默认测量 gui 和 server
+    python startup_report.py gui --runs 10
+    python startup_report.py --baseline benchmark_results/startup-old.json
+    python startup_report.py --window --runs 3
+
+也可以设置环境变量后直接运行程序，查看一次启动的耗时：
+    ECHOSOUL_STARTUP_TRACE=1 python gui.py
+"""
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_OUTPUT_DIR = os.path.join(BASE_DIR, "benchmark_results")
+
+_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)\s*$")
+_MAPPED = re.compile(r"启动耗时: 窗口在 (\d+) ms 后显示")
+WINDOW_TIMEOUT = 60  # 等待窗口显示的最长时间（秒）
+
+
+def measure_import(module: str) -> dict:
+    """在新进程中导入 module，返回总耗时和每个被导入模块的 (自身耗时, 累计耗时, 层级)，单位为微秒。"""
+    env = dict(os.environ, PYGAME_HIDE_SUPPORT_PROMPT="1")
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=BASE_DIR, env=env, capture_output=True, text=True
+    )
+    wall = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f"导入 {module} 失败:\n{result.stderr[-2000:]}")
+    imports = {}
+    total = 0
+    for line in result.stderr.splitlines():
+        match = _LINE.match(line)
+        if not match:
+            continue
+        self_us, cumulative_us, indent, name = int(match.group(1)), int(match.group(2)), match.group(3), match.group(4)
+        imports[name] = {"self_us": self_us, "cumulative_us": cumulative_us, "depth": (len(indent) - 1) // 2}
+        if name == module:
+            total = cumulative_us
+    return {"total_us": total, "process_seconds": wall, "imports": imports}
+
+
+def report_module(module: str, runs: int, top: int) -> dict:
+    measurements = [measure_import(module) for _ in range(runs)]
+    best = min(measurements, key=lambda m: m["total_us"])
+    # top_level_imports_ms 是 module 直接导入的模块（含其间接依赖）的累计耗时，slowest_self_ms 是自身耗时最多的模块
+    direct = sorted(
+        ((name, info) for name, info in best["imports"].items() if info["depth"] == 1),
+        key=lambda item: item[1]["cumulative_us"], reverse=True
+    )
+    slowest = sorted(best["imports"].items(), key=lambda item: item[1]["self_us"], reverse=True)
+    return {
+        "runs": runs,
+        "import_ms": {
+            "best": best["total_us"] / 1000,
+            "median": sorted(m["total_us"] for m in measurements)[len(measurements) // 2] / 1000,
+        },
+        "process_ms_best": min(m["process_seconds"] for m in measurements) * 1000,
+        "top_level_imports_ms": {name: info["cumulative_us"] / 1000 for name, info in direct[:top]},
+        "slowest_self_ms": {name: info["self_us"] / 1000 for name, info in slowest[:top]},
+    }
+
+
+def measure_window() -> dict:
+    """
+    在新进程中启动 gui.py，窗口显示后程序自动退出（ECHOSOUL_STARTUP_TRACE=exit）。
+    返回程序内从开始导入到窗口显示的耗时，以及从启动进程到读到这一行输出的耗时（包括解释器启动），单位为毫秒。
+    """
+    env = dict(os.environ, PYGAME_HIDE_SUPPORT_PROMPT="1", ECHOSOUL_STARTUP_TRACE="exit", PYTHONIOENCODING="utf-8")
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(BASE_DIR, "gui.py")],
+        cwd=BASE_DIR, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, encoding="utf-8"
+    )
+    mapped_ms, launch_ms, output = None, None, []
+    try:
+        for line in process.stdout:
+            output.append(line)
+            match = _MAPPED.search(line)
+            if match:
+                launch_ms = (time.perf_counter() - start) * 1000
+                mapped_ms = int(match.group(1))
+                break
+        process.wait(WINDOW_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        process.kill()
+    finally:
+        if process.poll() is None:
+            process.kill()
+        process.stdout.close()
+    if mapped_ms is None:
+        raise RuntimeError("gui.py 没有报告窗口显示的耗时:\n" + "".join(output)[-2000:])
+    return {"mapped_ms": mapped_ms, "launch_to_mapped_ms": launch_ms}
+
+
+def report_window(runs: int) -> dict:
+    measurements = [measure_window() for _ in range(runs)]
+    mapped = sorted(m["mapped_ms"] for m in measurements)
+    return {
+        "runs": runs,
+        "mapped_ms": {"best": mapped[0], "median": mapped[len(mapped) // 2]},
+        "launch_to_mapped_ms_best": min(m["launch_to_mapped_ms"] for m in measurements),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="测量 EchoSoul 各入口模块的导入耗时")
+    parser.add_argument("modules", nargs="*", default=["gui", "server"])
+    parser.add_argument("--runs", type=int, default=5, help="每个模块测量的次数，取最快的一次")
+    parser.add_argument("--top", type=int, default=15, help="列出多少个最慢的导入")
+    parser.add_argument("--output", default=None, help="结果 JSON 的保存路径，默认保存在 benchmark_results/ 下")
+    parser.add_argument("--baseline", default=None, help="与之前保存的结果 JSON 对比")
+    parser.add_argument("--window", action="store_true", help="同时测量 gui.py 从启动到窗口显示的耗时（需要图形界面）")
+    args = parser.parse_args()
+
+    results = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "modules": {},
+    }
+    for module in args.modules:
+        report = report_module(module, args.runs, args.top)
+        results["modules"][module] = report
+        print(f"{module}: 导入耗时 {report['import_ms']['best']:.1f} ms（中位数 {report['import_ms']['median']:.1f} ms），"
+              f"整个进程 {report['process_ms_best']:.1f} ms")
+        for name, ms in report["top_level_imports_ms"].items():
+            print(f"    {name:<32}{ms:9.1f} ms")
+    if args.window:
+        report = report_window(args.runs)
+        results["window"] = report
+        print(f"窗口显示: {report['mapped_ms']['best']} ms（中位数 {report['mapped_ms']['median']} ms），"
+              f"从启动进程算起 {report['launch_to_mapped_ms_best']:.0f} ms")
+
+    output = args.output
+    if output is None:
+        os.makedirs(DEFAULT_OUTPUT_DIR, exist_ok=True)
+        output = os.path.join(DEFAULT_OUTPUT_DIR, f"startup-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"结果已保存到 {output}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        print("\n与基线对比:")
+        for module, report in results["modules"].items():
+            old = baseline.get("modules", {}).get(module)
+            if not old:
+                continue
+            old_ms, new_ms = old["import_ms"]["best"], report["import_ms"]["best"]
+            print(f"  {module:<10} {old_ms:9.1f} -> {new_ms:9.1f} ms ({(new_ms - old_ms) / old_ms * 100:+.1f}%)")
+        if "window" in results and "window" in baseline:
+            old_ms, new_ms = baseline["window"]["mapped_ms"]["best"], results["window"]["mapped_ms"]["best"]
+            print(f"  {'window':<10} {old_ms:9.1f} -> {new_ms:9.1f} ms ({(new_ms - old_ms) / old_ms * 100:+.1f}%)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+# summarizer.py
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+def split_windows(messages: list, window_size: int) -> list:
+    """把消息平均分成若干段，每段大约 window_size 条（不足一段的余数并入各段，不会单独成为很短的一段）。"""
+    if not messages:
+        return []
+    count = max(1, len(messages) // max(window_size, 1))
+    size, extra = divmod(len(messages), count)
+    windows, start = [], 0
+    for i in range(count):
+        end = start + size + (1 if i < extra else 0)
+        windows.append(messages[start:end])
+        start = end
+    return windows
+
+
+def summarize_windows(windows: list, summarize_fn, previous_summary: str = "", max_workers: int = 3) -> list:
+    """
+    并发总结多段互相独立的对话（例如导入的聊天记录），每段都以 previous_summary 作为上文。
+    同一个会话中前后相接的消息要依次折叠进滚动摘要，应当使用 IncrementalSummarizer.run_batch()。
+    :param summarize_fn: 接收 (之前的滚动摘要, 新消息列表)，返回 (长期事实列表, 新的滚动摘要)
+    :return: 与 windows 一一对应的 (长期事实列表, 摘要) 或该段抛出的异常
+    """
+    if len(windows) <= 1 or max_workers <= 1:
+        results = []
+        for window in windows:
+            try:
+                results.append(summarize_fn(previous_summary, window))
+            except Exception as e:
+                results.append(e)
+        return results
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(windows)), thread_name_prefix="summary") as executor:
+        futures = [executor.submit(summarize_fn, previous_summary, window) for window in windows]
+    return [future.exception() or future.result() for future in futures]
+
+
+class IncrementalSummarizer:
+    """
+    增量式记忆总结。
+    记录一个水位线（最后一条已总结消息的 id），每次只把水位线之后的新消息交给 LLM，
+    同时维护一段滚动更新的短期对话摘要，使每次总结的 token 开销保持恒定。
+    :param threshold: 未总结的消息达到多少条时触发总结
+    """
+    def __init__(self, threshold: int = 20):
+        self.threshold = threshold
+        self.watermark = 0          # 已总结到的消息 id（包含）
+        self.rolling_summary = ""   # 已被总结并移出短期记忆的对话的简短摘要
+        self.lock = threading.Lock()
+        self.running = False
+
+    def pending(self, history: list) -> list:
+        """返回水位线之后尚未总结的消息。"""
+        return [message for message in history if message["id"] > self.watermark]
+
+    def should_summarize(self, history: list) -> bool:
+        return not self.running and len(self.pending(history)) >= self.threshold
+
+    def run(self, history: list, summarize_fn) -> list | None:
+        """
+        总结水位线之后的消息。
+        :param summarize_fn: 接收 (之前的滚动摘要, 新消息列表)，返回 (长期事实列表, 新的滚动摘要)
+        :return: 提取到的长期事实；已有总结在运行或没有新消息时返回 None。
+                 summarize_fn 抛出异常时水位线不会前进，下次会重新总结这些消息。
+        """
+        with self.lock:
+            if self.running:
+                return None
+            delta = self.pending(history)
+            if not delta:
+                return None
+            self.running = True
+        try:
+            facts, new_summary = summarize_fn(self.rolling_summary, delta)
+            with self.lock:
+                if new_summary:
+                    self.rolling_summary = new_summary
+                self.watermark = delta[-1]["id"]
+            return facts
+        finally:
+            with self.lock:
+                self.running = False
+
+    def run_batch(self, history: list, summarize_fn, window_size: int = None) -> list | None:
+        """
+        与 run() 相同，但积压的新消息较多时（例如长时间没有空闲、或从日志恢复了很多消息）
+        按 window_size 条一段依次总结，而不是一次把所有消息塞进一个请求。
+        每一段都以上一段得到的滚动摘要作为上文，最后的摘要覆盖所有段；各段的事实按顺序合并。
+        某一段失败时，水位线只前进到之前成功的那些段，之后的消息下次重新总结；第一段就失败时抛出它的异常。
+        """
+        with self.lock:
+            if self.running:
+                return None
+            delta = self.pending(history)
+            if not delta:
+                return None
+            self.running = True
+        try:
+            facts, summary, watermark = [], self.rolling_summary, None
+            for window in split_windows(delta, window_size or self.threshold):
+                try:
+                    window_facts, new_summary = summarize_fn(summary, window)
+                except Exception:
+                    if watermark is None:
+                        raise
+                    break
+                facts.extend(window_facts)
+                summary = new_summary or summary
+                watermark = window[-1]["id"]
+            with self.lock:
+                self.rolling_summary = summary
+                self.watermark = watermark
+            return facts
+        finally:
+            with self.lock:
+                self.running = False
+
+    def trim(self, history: list) -> list:
+        """按消息 id（而不是下标）移除已经总结过的消息，总结期间新增的消息会被保留。"""
+        return [message for message in history if message["id"] > self.watermark]
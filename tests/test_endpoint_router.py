@@ -0,0 +1,181 @@
+# tests/test_endpoint_router.py
+"""
+多地址选路的检查：用本机的模拟服务代替真实的 API 地址，覆盖熔断（打开 / 半开 / 恢复）、
+5xx 时换地址，以及对冲请求中落败一方的统计。
+
+用法（在项目根目录）:
+    python -m pytest tests
+"""
+
+import json
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import api_client
+import endpoint_router
+
+
+class StubServer:
+    """在后台线程中运行的模拟 API 服务：按 status 回复，回复前等待 delay 秒，并记录收到的请求数。"""
+    def __init__(self, status: int = 200, delay: float = 0.0):
+        self.status = status
+        self.delay = delay
+        self.hits = 0
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), self._make_handler())
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def _make_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                with stub.lock:
+                    stub.hits += 1
+                time.sleep(stub.delay)
+                body = json.dumps({"status": stub.status}).encode("utf-8")
+                self.send_response(stub.status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class EndpointRoutingTest(unittest.TestCase):
+    def setUp(self):
+        api_client.configure_client(max_retries=3)
+        self.stubs = []
+
+    def tearDown(self):
+        api_client.configure_endpoints([])
+        api_client.configure_client()
+        for stub in self.stubs:
+            stub.stop()
+
+    def start(self, status: int = 200, delay: float = 0.0) -> StubServer:
+        stub = StubServer(status, delay)
+        self.stubs.append(stub)
+        return stub
+
+    def post(self, primary: StubServer, hedge: bool = False):
+        return api_client._post("/chat/completions", "key", primary.base_url, {"model": "test"}, hedge=hedge)
+
+    def test_failover_on_5xx_without_transport_retries(self):
+        primary, fallback = self.start(503), self.start(200)
+        router = api_client.configure_endpoints([(primary.base_url, None), (fallback.base_url, None)])
+
+        start = time.perf_counter()
+        response = self.post(primary)
+
+        self.assertEqual(response.status_code, 200)
+        # 选路的请求不经过 urllib3 的退避重试：主地址只收到一次请求，并立即换到下一个地址
+        self.assertEqual(primary.hits, 1)
+        self.assertEqual(fallback.hits, 1)
+        self.assertLess(time.perf_counter() - start, 1.0)
+        primary_stats, fallback_stats = router.snapshot()
+        self.assertEqual(primary_stats["failures"], 1)
+        self.assertEqual(fallback_stats["failures"], 0)
+        self.assertIsNotNone(fallback_stats["latency_ms"])
+
+    def test_all_endpoints_failing_retries_in_rounds(self):
+        primary, fallback = self.start(503), self.start(502)
+        api_client.configure_endpoints([(primary.base_url, None), (fallback.base_url, None)],
+                                       failure_threshold=100, retries=2, backoff=0.01)
+
+        response = self.post(primary)
+
+        self.assertEqual(response.status_code, 502)
+        self.assertEqual((primary.hits, fallback.hits), (3, 3))
+
+    def test_circuit_breaker_opens_and_recovers_through_half_open_probe(self):
+        primary, fallback = self.start(503), self.start(200)
+        router = api_client.configure_endpoints([(primary.base_url, None), (fallback.base_url, None)],
+                                                failure_threshold=2, cooldown=0.3)
+
+        for _ in range(2):
+            self.assertEqual(self.post(primary).status_code, 200)
+        self.assertEqual(router.primary.state, endpoint_router.OPEN)
+
+        # 熔断期间不再请求主地址
+        self.post(primary)
+        self.assertEqual(primary.hits, 2)
+
+        # 冷却结束后放行一个试探请求；试探失败立即重新熔断
+        time.sleep(0.35)
+        self.post(primary)
+        self.assertEqual(primary.hits, 3)
+        self.assertEqual(router.primary.state, endpoint_router.OPEN)
+
+        # 主地址恢复后，下一个试探请求成功，熔断关闭
+        primary.status = 200
+        time.sleep(0.35)
+        self.assertEqual(self.post(primary).status_code, 200)
+        self.assertEqual(primary.hits, 4)
+        self.assertEqual(router.primary.state, endpoint_router.CLOSED)
+        self.assertEqual(router.primary.consecutive_failures, 0)
+
+    def test_half_open_admits_one_probe_at_a_time(self):
+        router = endpoint_router.EndpointRouter(
+            [endpoint_router.Endpoint("http://a"), endpoint_router.Endpoint("http://b")],
+            failure_threshold=1, cooldown=0.2
+        )
+        router.record_failure(router.primary)
+        self.assertNotIn(router.primary, router.candidates())
+        time.sleep(0.25)
+        self.assertIn(router.primary, router.candidates())
+        self.assertEqual(router.primary.state, endpoint_router.HALF_OPEN)
+        # 试探请求的结果回来之前，不再放行第二个
+        self.assertNotIn(router.primary, router.candidates())
+
+    def test_hedge_loser_is_still_measured(self):
+        primary, fallback = self.start(200, delay=0.5), self.start(200)
+        router = api_client.configure_endpoints([(primary.base_url, None), (fallback.base_url, None)],
+                                                hedge_delay=0.05)
+
+        start = time.perf_counter()
+        response = self.post(primary, hedge=True)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertLess(time.perf_counter() - start, 0.45)
+        self.assertEqual((primary.hits, fallback.hits), (1, 1))
+        # 落败的主地址完成后仍然记录它的延迟，否则慢地址永远不会被重新测量
+        deadline = time.monotonic() + 2
+        while router.primary.requests == 0 and time.monotonic() < deadline:
+            time.sleep(0.02)
+        primary_stats, fallback_stats = router.snapshot()
+        self.assertEqual(primary_stats["requests"], 1)
+        self.assertEqual(primary_stats["failures"], 0)
+        self.assertGreaterEqual(primary_stats["latency_ms"], 400)
+        self.assertLess(fallback_stats["latency_ms"], primary_stats["latency_ms"])
+
+    def test_hedge_ending_on_failover_status_records_failures(self):
+        primary, fallback = self.start(503, delay=0.1), self.start(503)
+        router = api_client.configure_endpoints([(primary.base_url, None), (fallback.base_url, None)],
+                                                hedge_delay=0.05, failure_threshold=100)
+
+        response = self.post(primary, hedge=True)
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual([e["failures"] for e in router.snapshot()], [1, 1])
+        self.assertTrue(all(e["latency_ms"] is None for e in router.snapshot()))
+
+
+if __name__ == "__main__":
+    unittest.main()
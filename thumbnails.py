@@ -0,0 +1,116 @@
+# thumbnails.py
+
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+
+import customtkinter as ctk
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+
+def decode_thumbnail(path: str, size: tuple) -> "Image.Image":
+    """
+    解码并缩放图片。JPEG 会先用 draft 模式在解码阶段直接按比例缩小，
+    其他格式用 reducing_gap 先做整数倍缩小，再用 LANCZOS 精细缩放。
+    """
+    from PIL import Image  # 在缩略图线程中才导入，不拖慢程序启动
+    img = Image.open(path)
+    if img.format == "JPEG":
+        img.draft("RGB", size)
+    img.thumbnail(size, Image.Resampling.LANCZOS, reducing_gap=2.0)
+    img.load()
+    return img
+
+
+class ThumbnailService:
+    """
+    在后台线程中解码缩略图，并通过 after() 把生成好的 CTkImage 交回主线程。
+    结果按 (路径, 尺寸) 缓存在一个有上限的 LRU 中；同一张图片需要更小的尺寸时，
+    直接从已缓存的大图缩小，不再重新解码原图。
+    """
+    def __init__(self, root, max_entries: int = 64, max_workers: int = 2):
+        self.root = root
+        self.max_entries = max_entries
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="thumbnail")
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()   # (路径, 修改时间, 尺寸) -> (PIL 图片, CTkImage)
+        self.pending = {}            # 正在解码的键 -> 等待结果的回调列表
+
+    @staticmethod
+    def _key(path: str, size: tuple):
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            mtime = 0
+        return (os.path.abspath(path), mtime, tuple(size))
+
+    def request(self, path: str, size: tuple, callback):
+        """
+        请求一张缩略图。callback 在主线程中被调用，参数为 CTkImage，解码失败时为 None。
+        已缓存时会立即同步调用 callback。
+        """
+        key = self._key(path, size)
+        cached = None
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                cached = self.cache[key][1]
+        if cached is not None:
+            callback(cached)
+            return
+        with self.lock:
+            if key in self.pending:
+                self.pending[key].append(callback)
+                return
+            self.pending[key] = [callback]
+            source = self._find_larger(key)
+        self.executor.submit(self._decode, key, source)
+
+    def _find_larger(self, key):
+        """查找同一张图片已缓存的更大尺寸版本。"""
+        path, mtime, size = key
+        for (other_path, other_mtime, other_size), (pil_image, _) in self.cache.items():
+            if other_path == path and other_mtime == mtime and other_size[0] >= size[0] and other_size[1] >= size[1]:
+                return pil_image
+        return None
+
+    def _decode(self, key, source):
+        path, _, size = key
+        try:
+            if source is not None:
+                from PIL import Image
+                img = source.copy()
+                img.thumbnail(size, Image.Resampling.LANCZOS)
+            else:
+                img = decode_thumbnail(path, size)
+        except Exception as e:
+            print(f"加载图片缩略图失败: {e}")
+            img = None
+        try:
+            self.root.after(0, self._finish, key, img)
+        except RuntimeError:
+            # 主窗口已经关闭
+            pass
+
+    def _finish(self, key, img):
+        """在主线程中创建 CTkImage、写入缓存并通知所有等待者。"""
+        ctk_image = None
+        with self.lock:
+            callbacks = self.pending.pop(key, [])
+            if img is not None:
+                ctk_image = ctk.CTkImage(light_image=img, dark_image=img, size=img.size)
+                self.cache[key] = (img, ctk_image)
+                while len(self.cache) > self.max_entries:
+                    self.cache.popitem(last=False)
+        for callback in callbacks:
+            try:
+                callback(ctk_image)
+            except Exception as e:
+                print(f"显示缩略图失败: {e}")
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
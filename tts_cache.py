@@ -0,0 +1,150 @@
+# tts_cache.py
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTSCache:
+    """
+    以内容哈希为键的磁盘 TTS 音频缓存。
+    键由 (文本, TTS 模型, 音色, 语速) 计算得到，超出字节预算时按最近最少使用 (LRU) 淘汰。
+    :param defer_eviction: 为 True 时 put() 不立即删除文件，由调用方在空闲时调用 cleanup()；
+                           超出预算 HARD_LIMIT_RATIO 倍时仍会立即淘汰，避免一直不空闲时无限增长
+    """
+    HARD_LIMIT_RATIO = 1.25
+    STALE_TMP_SECONDS = 3600  # 超过这个时间的临时文件是程序中途退出留下的
+
+    def __init__(self, directory: str, max_bytes: int = 200 * 1024 * 1024, defer_eviction: bool = False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.defer_eviction = defer_eviction
+        self.cleaned = False  # 启动后是否已经清理过一次（顺带删除上次退出留下的临时文件）
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> 文件大小，越靠后越是最近使用
+        self.total_bytes = 0
+        os.makedirs(self.directory, exist_ok=True)
+        self._load_index()
+
+    @staticmethod
+    def make_key(text: str, model: str, voice: str, speed: float) -> str:
+        raw = json.dumps([text, model, voice, round(float(speed), 2)], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.mp3")
+
+    def _load_index(self):
+        """启动时扫描缓存目录，按文件访问时间恢复 LRU 顺序。"""
+        files = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".mp3"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, name[:-4], stat.st_size))
+        for _, key, size in sorted(files):
+            self.entries[key] = size
+            self.total_bytes += size
+        self._evict()
+
+    def get(self, text: str, model: str, voice: str, speed: float) -> bytes | None:
+        key = self.make_key(text, model, voice, speed)
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            path = self._path(key)
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+                # 更新文件时间，使重启后的 LRU 顺序依然正确
+                now = time.time()
+                os.utime(path, (now, now))
+            except OSError:
+                self.total_bytes -= self.entries.pop(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, text: str, model: str, voice: str, speed: float, data: bytes):
+        if not data or len(data) > self.max_bytes:
+            return
+        key = self.make_key(text, model, voice, speed)
+        path = self._path(key)
+        with self.lock:
+            # 先写入临时文件再替换，避免程序中途退出留下半个音频文件
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            try:
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                print(f"写入 TTS 缓存失败: {e}")
+                return
+            if key in self.entries:
+                self.total_bytes -= self.entries[key]
+            self.entries[key] = len(data)
+            self.entries.move_to_end(key)
+            self.total_bytes += len(data)
+            if not self.defer_eviction or self.total_bytes > self.max_bytes * self.HARD_LIMIT_RATIO:
+                self._evict()
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self.entries:
+            key, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def needs_cleanup(self) -> bool:
+        with self.lock:
+            return not self.cleaned or self.total_bytes > self.max_bytes
+
+    def cleanup(self):
+        """淘汰超出预算的条目，并删除中途退出留下的临时文件。"""
+        with self.lock:
+            self._evict()
+            self.cleaned = True
+        now = time.time()
+        for name in os.listdir(self.directory):
+            if not name.endswith(".tmp"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if now - os.stat(path).st_mtime > self.STALE_TMP_SECONDS:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.entries):
+                try:
+                    os.remove(self._path(key))
+                except OSError:
+                    pass
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+            }
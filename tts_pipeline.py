@@ -0,0 +1,268 @@
+# tts_pipeline.py
+
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from audio_player import StreamingAudio
+
+# 句末标点：中文标点直接断句，英文的 . ! ? 需要后面跟空白才断句（避免切开小数和网址）
+CJK_SENTENCE_ENDINGS = "。！？…\n"
+ASCII_SENTENCE_ENDINGS = ".!?"
+# 断句后可以紧跟在句末的收尾符号，例如引号和括号
+CLOSING_CHARS = "”’」』）)\"'"
+# 超长的句子在这些位置切开，找不到时在 max_chars 处硬切
+SOFT_BREAKS = "，,；;：:、 "
+
+
+def _soft_break(text: str, max_chars: int) -> int:
+    """返回把 text 切成不超过 max_chars 的第一段时的切分位置。"""
+    cut = max(text.rfind(ch, 0, max_chars) for ch in SOFT_BREAKS)
+    # 切分点太靠前会产生很短的片段，不如直接硬切
+    return cut + 1 if cut >= max_chars // 2 else max_chars
+
+
+class SentenceSplitter:
+    """
+    把流式到达的文本按句子边界切分。
+    feed() 返回已经完整的句子，flush() 返回剩余的尾巴。
+    设置了 max_chars 时，超长的句子（以及迟迟没有句末标点的长段文字）会在逗号等位置切成多段，
+    避免单个 TTS 请求过慢或被接口截断。
+    """
+    def __init__(self, min_chars: int = 4, max_chars: int | None = None):
+        # 过短的句子（如“嗯。”）会和下一句合并，避免产生大量很小的 TTS 请求
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self.buffer = ""
+
+    def _limit(self, text: str) -> list:
+        """把 text 切成不超过 max_chars 的若干段。"""
+        pieces = []
+        while self.max_chars and len(text) > self.max_chars:
+            cut = _soft_break(text, self.max_chars)
+            piece = text[:cut].strip()
+            if piece:
+                pieces.append(piece)
+            text = text[cut:]
+        text = text.strip()
+        return pieces + [text] if text else pieces
+
+    def feed(self, text: str) -> list:
+        self.buffer += text
+        sentences = []
+        start = 0
+        i = 0
+        while i < len(self.buffer):
+            ch = self.buffer[i]
+            end = None
+            if ch in CJK_SENTENCE_ENDINGS:
+                end = i + 1
+            elif ch in ASCII_SENTENCE_ENDINGS:
+                # 英文标点需要看到后面的空白才能确定是句末，否则等更多文本到达
+                if i + 1 >= len(self.buffer):
+                    break
+                if self.buffer[i + 1].isspace():
+                    end = i + 1
+            if end is not None:
+                # 连续的句末标点（如“！！”、“……”）和收尾引号一起归入这一句
+                while end < len(self.buffer) and (self.buffer[end] in CJK_SENTENCE_ENDINGS + ASCII_SENTENCE_ENDINGS + CLOSING_CHARS):
+                    end += 1
+                if end >= len(self.buffer) and self.buffer[end - 1] not in "\n":
+                    # 句末标点恰好在缓冲区末尾，后面可能还有同一组标点，先等一等
+                    break
+                sentence = self.buffer[start:end].strip()
+                if len(sentence) >= self.min_chars:
+                    sentences.extend(self._limit(sentence))
+                    start = end
+                i = end
+                continue
+            i += 1
+        self.buffer = self.buffer[start:]
+        # 很长一段都没有句末标点时，先把前面的部分切出去合成
+        while self.max_chars and len(self.buffer) > self.max_chars:
+            cut = _soft_break(self.buffer, self.max_chars)
+            piece = self.buffer[:cut].strip()
+            if piece:
+                sentences.append(piece)
+            self.buffer = self.buffer[cut:]
+        return sentences
+
+    def flush(self) -> list:
+        rest = self._limit(self.buffer)
+        self.buffer = ""
+        return rest
+
+
+def split_sentences(text: str, min_chars: int = 4, max_chars: int | None = None) -> list:
+    """对一段完整文本进行断句。"""
+    splitter = SentenceSplitter(min_chars, max_chars)
+    return splitter.feed(text) + splitter.flush()
+
+
+def is_transient_error(e: Exception) -> bool:
+    """
+    判断一次合成失败是否值得重试：只重试连接层不会重试的读取失败（读超时、下载中途断开）。
+    api_client 把 requests 的异常包装成 ConnectionError 抛出，这里按原始异常（__cause__）判断。
+    状态码错误不重试：4xx（如密钥错误、参数错误）重试也不会成功，429/5xx 和连接失败已经由
+    连接池的 Retry 或多地址选路器退避重试过，再在这里重试只会成倍增加请求。
+    """
+    import requests  # 出错时 api_client 早已导入，这里不会拖慢启动
+    from urllib3.exceptions import MaxRetryError, ProtocolError, ReadTimeoutError
+    cause = e.__cause__ if isinstance(e.__cause__, requests.RequestException) else e
+    if not isinstance(cause, requests.RequestException):
+        return False
+    if isinstance(cause, (requests.HTTPError, requests.exceptions.RetryError)):
+        return False
+    reason = cause.args[0] if cause.args else None
+    if isinstance(reason, MaxRetryError) and not isinstance(reason.reason, (ReadTimeoutError, ProtocolError)):
+        return False
+    return isinstance(cause, (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError))
+
+
+class TTSPipeline:
+    """
+    句子级流水线：文本按句切分后送去合成，合成好的音频按原来的顺序进入播放队列。
+    最多 max_workers 句同时合成，第一句合成完就开始播放，后面的句子在播放的同时继续合成，
+    长回复的合成总耗时接近最慢的一句而不是所有句子之和。
+    :param synthesize: 接收一句文本、返回音频字节或音频数据块迭代器（边下载边产出）的函数
+    :param play: 播放一段音频的函数，可以阻塞到播放结束，也可以只是排队后立即返回
+    :param stream_audio: 为 True 时 play 收到的是 StreamingAudio，轮到这一句时立即交给 play，
+                         否则等一句完整下载后再把音频字节交给 play
+    :param max_workers: 同时合成的句子数
+    :param max_chars: 单个合成请求的最大字数，超长的句子会被切开
+    :param retries: 单句合成失败时的重试次数，只重试失败的那一句
+    :param retry_if: 接收异常、返回是否重试的函数，默认只重试暂时性的失败
+    """
+    def __init__(self, synthesize, play, min_chars: int = 4, stream_audio: bool = False,
+                 max_workers: int = 1, max_chars: int | None = None, retries: int = 2,
+                 retry_delay: float = 0.5, retry_if=is_transient_error):
+        self.synthesize = synthesize
+        self.play = play
+        self.stream_audio = stream_audio
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.retry_if = retry_if
+        self.splitter = SentenceSplitter(min_chars, max_chars)
+        self.text_queue = queue.Queue()
+        self.audio_queue = queue.Queue()
+        self.segments = []  # 按顺序保存已合成的音频片段
+        self.error = None
+        self.cancelled = threading.Event()
+        self.synthesized = threading.Event()
+        self.played = threading.Event()
+        self.executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="tts")
+        self.futures = []  # 与 streams 一一对应，按句子顺序排列
+        self.streams = []
+        self.synth_thread = threading.Thread(target=self._dispatch_worker, daemon=True)
+        self.play_thread = threading.Thread(target=self._play_worker, daemon=True)
+        self.synth_thread.start()
+        self.play_thread.start()
+
+    def feed(self, text: str):
+        """送入一段文本（可以是流式增量，也可以是完整回复）。"""
+        for sentence in self.splitter.feed(text):
+            self.text_queue.put(sentence)
+
+    def close(self):
+        """文本已经全部送入，把剩余的尾巴也送去合成。"""
+        for sentence in self.splitter.flush():
+            self.text_queue.put(sentence)
+        self.text_queue.put(None)
+
+    def cancel(self):
+        """丢弃尚未合成和尚未播放的片段。"""
+        self.cancelled.set()
+        for future, stream in zip(list(self.futures), list(self.streams)):
+            future.cancel()
+            stream.fail(InterruptedError("语音合成已取消"))
+        self.text_queue.put(None)
+        self.audio_queue.put(None)
+
+    def wait(self, timeout: float | None = None) -> list:
+        """
+        等待所有片段合成完毕（不等待播放结束），返回按顺序排列的音频片段。
+        如果合成过程中出错，则重新抛出该错误。
+        """
+        self.synthesized.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return list(self.segments)
+
+    def wait_played(self, timeout: float | None = None) -> bool:
+        """等待所有片段播放完毕（或流水线被取消）。超时返回 False。"""
+        return self.played.wait(timeout)
+
+    def _dispatch_worker(self):
+        """按顺序把句子交给线程池合成，同时按同样的顺序把对应的缓冲区放入播放队列。"""
+        try:
+            while not self.cancelled.is_set():
+                sentence = self.text_queue.get()
+                if sentence is None or self.cancelled.is_set():
+                    break
+                stream = StreamingAudio()
+                self.futures.append(self.executor.submit(self._synthesize_segment, sentence, stream))
+                self.streams.append(stream)
+                self.audio_queue.put(stream)
+            for future in self.futures:
+                if not future.cancelled():
+                    future.exception()  # 等待完成
+            if not self.cancelled.is_set():
+                for future, stream in zip(self.futures, self.streams):
+                    future.result()
+                    data = stream.getvalue()
+                    if data:
+                        self.segments.append(data)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.audio_queue.put(None)
+            self.executor.shutdown(wait=False)
+            self.synthesized.set()
+
+    def _synthesize_segment(self, sentence: str, stream: StreamingAudio):
+        """合成一句并写入 stream；失败时只要还没有被播放器读取过，就清空后重试。"""
+        attempt = 0
+        while not self.cancelled.is_set():
+            try:
+                audio = self.synthesize(sentence)
+                chunks = [audio] if isinstance(audio, (bytes, bytearray)) else (audio or [])
+                for chunk in chunks:
+                    if self.cancelled.is_set():
+                        break
+                    stream.feed(chunk)
+                else:
+                    stream.finish()
+                    return
+            except Exception as e:
+                if (self.cancelled.is_set() or attempt >= self.retries
+                        or not self.retry_if(e) or not stream.restart()):
+                    stream.fail(e)
+                    raise
+                attempt += 1
+                print(f"语音合成失败，第 {attempt} 次重试: {e}")
+                self.cancelled.wait(self.retry_delay * 2 ** (attempt - 1))
+        stream.fail(InterruptedError("语音合成已取消"))
+
+    def _play_worker(self):
+        try:
+            while not self.cancelled.is_set():
+                stream = self.audio_queue.get()
+                if stream is None or self.cancelled.is_set():
+                    break
+                try:
+                    if self.stream_audio:
+                        self.play(stream)
+                        continue
+                    audio = stream.getvalue()
+                except Exception:
+                    continue  # 合成失败的句子跳过，错误由 wait() 抛出
+                if self.cancelled.is_set():
+                    break
+                if not audio:
+                    continue
+                try:
+                    self.play(audio)
+                except Exception as e:
+                    print(f"播放音频片段时发生错误: {e}")
+        finally:
+            self.played.set()